@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import numpy as np
+from numpy.lib.format import open_memmap
+from numpy.lib.stride_tricks import sliding_window_view
+from cache import DecodedCache
+from source import decode
+
+BATCH_HOPS = 512          #grains per batched rfft while analysing, bounds the float64 scratch to a few MB
+
+
+def analyze(signal, grain_len, stride, out=None):
+    """Magnitude and phase of every hop's Hann-windowed grain --> (2, hops) + channels + (bins,), [0] magnitudes and
+    [1] phases. Grain n is what PitchShifter feeds the FFT on hop n: OVERLAP_LEN zeros then the signal, stride apart.
+    out: Array to fill, e.g. a float16 memmap, else a new float32 one"""
+    signal = np.asarray(signal, dtype=np.float32)
+    lead = signal.shape[1:]
+    hops = len(signal) // stride #PitchShifter.callback stops on the first short buffer
+    padded = np.zeros((grain_len - stride + hops * stride,) + lead, dtype=np.float32)
+    padded[grain_len - stride:] = signal[:hops * stride]
+    grains = sliding_window_view(padded, grain_len, axis=0)[::stride] #(hops,) + channels + (grain_len,)
+    if out is None:
+        out = np.zeros((2, hops) + lead + (grain_len // 2 + 1,), dtype=np.float32)
+    window = np.hanning(grain_len)
+    for start in range(0, hops, BATCH_HOPS):
+        X = np.fft.rfft(grains[start:start + BATCH_HOPS] * window, axis=-1)
+        out[0, start:start + len(X)] = np.abs(X)
+        out[1, start:start + len(X)] = np.angle(X)
+    return out
+
+
+class AnalysisCache(DecodedCache):
+    """Per-song STFT analysis on disk --> magnitudes and phases of every hop, float16 in one memory-mapped .npy.
+    They do not depend on the shift factor, so a replay or a re-key gathers them instead of running window, rfft and
+    the phase/magnitude split, see FrameWorkspace.resynthesize and OfflineShifter.frames. Entries are keyed on the
+    file like DecodedCache's plus grain_len, stride and mono, so another grain or hop never reads a stale one, and
+    share its LRU eviction; 4096/1024 analysis is about 0.35 MB per second of mono audio, 5x the decoded PCM.
+    float16 keeps magnitudes to 3 significant digits and phases to ~2e-3 rad. Phase propagation amplifies that like
+    any rounding, but less than 1e-6 of noise on the input would: magnitude spectra of a render stay within ~8%
+    (spectral convergence) of a fresh one, see main"""
+    def __init__(self, directory=None, max_bytes=4<<30, hash_content=False):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'pitch_shifter', 'analysis')
+        super().__init__(directory, max_bytes, hash_content)
+
+    def key(self, path, mono=True, grain_len=4096, stride=1024):
+        digest = hashlib.sha1(super().key(path, mono).encode())
+        digest.update(f'|{grain_len}|{stride}'.encode())
+        return digest.hexdigest()
+
+    def contains(self, path, mono=True, grain_len=4096, stride=1024):
+        return os.path.exists(self.entry_paths(self.key(path, mono, grain_len, stride))[0])
+
+    def load(self, path, mono=True, grain_len=4096, stride=1024, signal=None):
+        """Returns the song's analysis --> read-only np.memmap like analyze's, analysed and stored first on a miss.
+        signal: The decoded song if at hand, else it is decoded"""
+        key = self.key(path, mono, grain_len, stride)
+        data_path, _ = self.entry_paths(key)
+        if os.path.exists(data_path):
+            with self.lock:
+                self.hits += 1
+            os.utime(data_path) #mtime doubles as the LRU clock
+        else:
+            with self.lock:
+                self.misses += 1
+            self.store(path, key, mono, grain_len, stride, signal)
+        return np.load(data_path, mmap_mode='r')
+
+    def store(self, path, key=None, mono=True, grain_len=4096, stride=1024, signal=None):
+        """Analyses the song straight into a float16 memmap and moves it in place --> readers never see half an entry"""
+        key = key or self.key(path, mono, grain_len, stride)
+        if signal is None:
+            signal = decode(path, mono)[0]
+        hops = len(signal) // stride
+        with self.replacing(key) as (tmp_path, tmp_meta_path):
+            out = open_memmap(tmp_path, 'w+', np.float16, (2, hops) + np.shape(signal)[1:] + (grain_len // 2 + 1,))
+            analyze(signal, grain_len, stride, out)
+            out.flush()
+            del out
+            with open(tmp_meta_path, 'w') as f:
+                json.dump({'path': os.path.abspath(path), 'hops': hops, 'grain_len': grain_len, 'stride': stride}, f)
+        self.evict(keep=key)
+
+    def store_async(self, path, mono=True, grain_len=4096, stride=1024, source=None):
+        """Fills the cache on a background thread --> returns the thread.
+        source: Optional source (see source.py) of the song, whose load() then supplies the signal"""
+        key = self.key(path, mono, grain_len, stride)
+        with self.lock:
+            thread = self.pending.get(key)
+            if thread is None or not thread.is_alive():
+                self.misses += 1
+                store = lambda: self.store(path, key, mono, grain_len, stride, None if source is None else source.load())
+                thread = self.pending[key] = threading.Thread(target=store, daemon=True)
+                thread.start()
+        return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the analysis cache: storing on a miss against loading on a hit, '
+                                                 'and live and offline shifting from it against fresh FFTs')
+    parser.add_argument('song')
+    parser.add_argument('-s', '--semitones', type=float, default=3.0)
+    parser.add_argument('--grain', type=int, default=4096)
+    parser.add_argument('--stride', type=int, default=1024)
+    parser.add_argument('--hops', type=int, default=2000, help='hops of the live run')
+    parser.add_argument('--dir', help='cache directory, a fresh temporary one by default')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    import tempfile
+    from pitch_shift import PitchShifter
+    from offline import OfflineShifter
+    directory = args.dir or tempfile.mkdtemp(prefix='analysis')
+    cache = AnalysisCache(directory)
+    shift_factor = 2**(args.semitones/12)
+    signal, samp_freq = decode(args.song)
+    cache.remove(cache.key(args.song, True, args.grain, args.stride))
+    t = time.perf_counter()
+    cache.load(args.song, True, args.grain, args.stride, signal)
+    miss = time.perf_counter() - t
+    t = time.perf_counter()
+    spectra = cache.load(args.song, True, args.grain, args.stride)
+    hit = time.perf_counter() - t
+    print(json.dumps({'stage': 'load', 'miss_ms': miss * 1e3, 'hit_ms': hit * 1e3, 'bytes': spectra.nbytes,
+                      'duration_s': len(signal) / samp_freq}))
+    #live: the analysis stages (window through rescale) per hop, fresh and gathered
+    stages = {}
+    for label, analysis in (('fresh', None), ('cached', cache)):
+        shifter = PitchShifter(args.song, shift_factor, 'array', grain_len=args.grain, stride=args.stride, output=False,
+                               analysis=analysis)
+        t = time.perf_counter()
+        for count in range(min(args.hops, len(spectra[0]))):
+            shifter.hop(count)
+        wall = time.perf_counter() - t
+        stats = shifter.getStats()['stages']
+        stages[label] = {'hop_ms': wall * 1e3 / args.hops,
+                         'analysis_ms': sum(stats[s]['mean_ms'] for s in ('window', 'rfft', 'rescale')),
+                         'phase_ms': stats['phase']['mean_ms']}
+        shifter.close()
+    print(json.dumps({'stage': 'live', 'hops': args.hops, **{f'{label}_{k}': v for label in stages for k, v in stages[label].items()}}))
+    #offline: whole render, and how far the float16 analysis moves the output
+    renders = {}
+    for label, analysis in (('fresh', None), ('cached', cache)):
+        shifter = OfflineShifter(args.song, grain_len=args.grain, stride=args.stride, analysis=analysis)
+        t = time.perf_counter()
+        renders[label] = (shifter.render(shift_factor), time.perf_counter() - t)
+    magnitudes = [analyze(renders[label][0], args.grain, args.stride)[0] for label in ('fresh', 'cached')]
+    convergence = np.linalg.norm(magnitudes[1] - magnitudes[0]) / np.linalg.norm(magnitudes[0])
+    print(json.dumps({'stage': 'offline', 'fresh_s': renders['fresh'][1], 'cached_s': renders['cached'][1],
+                      'speedup': renders['fresh'][1] / renders['cached'][1], 'spectral_convergence': float(convergence)}))
+
+
+if __name__ == '__main__':
+    main()
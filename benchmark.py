@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import itertools
+import tracemalloc
+from math import log2
+import numpy as np
+from source import ArraySource
+from pitch_shift import PitchShifter
+from utils import build_dft_rescale_lookup, PHASE_MODES
+from signals import SIGNALS, synthesize, percentiles
+
+SONGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'songs')
+CASE_KEYS = ('signal', 'samp_freq', 'grain_len', 'stride', 'shift_factor', 'threshold', 'phase_mode', 'algorithm')
+CASE_DEFAULTS = {'algorithm': 'vocoder'} #keys older records lack
+ALGORITHMS = ('vocoder', 'wsola')
+#Cold import budgets in seconds --> entry points must start fast, the audio path without any of HEAVY_MODULES
+IMPORT_BUDGETS = {'pitch_shift': 0.3, 'engine': 0.3, 'server': 0.4, 'player': 0.5}
+HEAVY_MODULES = ('librosa', 'scipy', 'matplotlib', 'numba')
+
+
+def load_signal(name, samp_freq, seconds):
+    """Synthetic signal by name, or the first `seconds` of a song resampled to samp_freq"""
+    if name in SIGNALS:
+        return synthesize(name, samp_freq, seconds)
+    import librosa #where it is used only, its import alone takes seconds
+    signal, _ = librosa.load(name, sr=samp_freq, mono=True, duration=seconds)
+    return signal
+
+
+def case_key(record):
+    return tuple(record.get(k, CASE_DEFAULTS.get(k)) for k in CASE_KEYS)
+
+
+def reference_shift(signal, samp_freq, shift_factor):
+    """What a shift should sound like --> librosa's offline phase vocoder plus high quality resampling"""
+    import librosa
+    return librosa.effects.pitch_shift(signal, sr=samp_freq, n_steps=12*log2(shift_factor))
+
+
+def spectral_convergence(output, reference, delay=0, n_fft=2048, hop_length=512):
+    """Distance of output from reference, ||R - g*A|| / ||R|| over magnitude spectrograms --> 0 is identical,
+    1 as far as silence. output is advanced by its delay in samples and scaled by the least-squares gain g first,
+    so engines are compared on what they sound like, not on their latency or level"""
+    import librosa
+    output = output[delay:]
+    n = min(len(output), len(reference))
+    A = np.abs(librosa.stft(output[:n], n_fft=n_fft, hop_length=hop_length))
+    R = np.abs(librosa.stft(reference[:n], n_fft=n_fft, hop_length=hop_length))
+    gain = (A*R).sum() / max((A*A).sum(), 1e-12)
+    return float(np.linalg.norm(R - gain*A) / np.linalg.norm(R))
+
+
+def run_case(signal, samp_freq, grain_len=4096, stride=1024, shift_factor=1.0, threshold=0.05, phase_mode='heap',
+             algorithm='vocoder', reference=None, warmup=8, memory_hops=32):
+    """Plays signal through a headless PitchShifter hop by hop --> flat dict of latency, real-time factor and memory.
+    realtime_factor is processing time over audio time, so anything below 1 keeps up on average;
+    cpu_per_audio_s is the process CPU time per second of audio, all threads included;
+    deadline_misses counts hops slower than the stride they have to fill.
+    peak_alloc_bytes is the tracemalloc peak over memory_hops hops, i.e. the transient allocations of one hop.
+    reference: Optional ideal output (see reference_shift) --> adds spectral_convergence of what was played"""
+    shifter = PitchShifter(ArraySource(signal, samp_freq), shift_factor, phase_mode,
+                           grain_len=grain_len, stride=stride, output=False, algorithm=algorithm)
+    shifter.phase_vocoder.threshold = threshold
+    vocoder = shifter.phase_vocoder
+    calc_phase = vocoder.calc_phase
+    phase_times = []
+    def timed_calc_phase(frame, out=None):
+        start = time.perf_counter()
+        frame = calc_phase(frame, out)
+        phase_times.append(time.perf_counter() - start)
+        return frame
+    vocoder.calc_phase = timed_calc_phase #dft_rescale looks it up on the instance every hop
+
+    count = 0
+    while count < warmup and shifter.hop(count):
+        count += 1
+    del phase_times[:]
+    hop_times = []
+    played = np.zeros(len(signal), dtype=np.float32) #sample for sample, the warmup hops left silent
+    cpu = time.process_time()
+    while True:
+        start = time.perf_counter()
+        if not shifter.hop(count):
+            break
+        hop_times.append(time.perf_counter() - start)
+        played[count*stride:(count+1)*stride] = shifter.output_buffer
+        count += 1
+    cpu = time.process_time() - cpu
+    assert hop_times, "Signal too short for a single timed hop"
+    del vocoder.calc_phase
+
+    tracemalloc.start()
+    for c in range(warmup, min(warmup + memory_hops, count)):
+        shifter.hop(c)
+    peak_alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latency_ms = shifter.getLatency()['algorithmic_ms']
+    lookup_times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        build_dft_rescale_lookup(shifter.N_BINS, shift_factor)
+        lookup_times.append(time.perf_counter() - start)
+    shifter.close()
+
+    budget = stride / samp_freq
+    record = {'hops': len(hop_times), 'budget_ms': budget * 1e3}
+    record.update(percentiles(hop_times, 'hop'))
+    if phase_times: #the wsola algorithm has no phase stage
+        record.update(percentiles(phase_times, 'phase'))
+    record['cpu_per_audio_s'] = cpu / (len(hop_times) * budget)
+    if reference is not None: #input sample t is played at t + delay
+        delay = round(latency_ms * samp_freq / 1e3)
+        skip = warmup * stride
+        record['spectral_convergence'] = spectral_convergence(played[skip:], reference[skip:], delay)
+    record.update({'lookup_ms': float(np.median(lookup_times)) * 1e3,
+                   'realtime_factor': sum(hop_times) / (len(hop_times) * budget),
+                   'deadline_misses': int(sum(t > budget for t in hop_times)),
+                   'peak_alloc_bytes': peak_alloc,
+                   'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})
+    return record
+
+
+def sweep(signals, rates, grain_lens, strides, shift_factors, thresholds, phase_modes, seconds=5.0,
+          algorithms=('vocoder',), quality=False):
+    """Runs every combination --> yields one flat record per case, parameters first.
+    The wsola algorithm has no phase mode or threshold, it runs once per remaining combination with both None.
+    quality: Also score every case against reference_shift, computed once per signal and shift"""
+    for name, samp_freq in itertools.product(signals, rates):
+        signal = load_signal(name, samp_freq, seconds)
+        references = {}
+        for grain_len, stride, shift_factor, threshold, phase_mode, algorithm in itertools.product(
+                grain_lens, strides, shift_factors, thresholds, phase_modes, algorithms):
+            if grain_len % stride or grain_len < 2*stride:
+                continue
+            if algorithm == 'wsola':
+                if (threshold, phase_mode) != (thresholds[0], phase_modes[0]):
+                    continue
+                threshold = phase_mode = None
+            if quality and shift_factor not in references:
+                references[shift_factor] = reference_shift(signal, samp_freq, shift_factor)
+            case = dict(zip(CASE_KEYS, (os.path.basename(name), samp_freq, grain_len, stride, shift_factor, threshold,
+                                        phase_mode, algorithm)))
+            case.update(run_case(signal, samp_freq, grain_len, stride, shift_factor, threshold or 0.05, phase_mode or 'array',
+                                 algorithm, references.get(shift_factor)))
+            yield case
+
+
+def compare(baseline, records, metric='hop_p99_ms', tolerance=0.2):
+    """Cases whose metric grew by more than tolerance (a fraction) over the baseline run --> list of (case, old, new)"""
+    old = {case_key(r): r[metric] for r in baseline}
+    regressions = []
+    for r in records:
+        case = case_key(r)
+        if case in old and r[metric] > old[case] * (1 + tolerance):
+            regressions.append((dict(zip(CASE_KEYS, case)), old[case], r[metric]))
+    return regressions
+
+
+def import_times(budgets=IMPORT_BUDGETS, repeat=3):
+    """Cold import time of each module in a fresh interpreter, from python -X importtime --> list of flat dicts with
+    the HEAVY_MODULES it pulled in and whether it stayed within budget and free of them. Best of `repeat` runs"""
+    records = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module, budget in budgets.items():
+        code = f'import sys, json, {module}; print(json.dumps(sorted(m for m in sys.modules if m.split(".")[0] in {HEAVY_MODULES})))'
+        seconds, heavy = [], []
+        for _ in range(repeat):
+            run = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=here, capture_output=True, text=True, check=True)
+            #"import time: self [us] | cumulative | name", the module's own line has no indent
+            total = [line.split('|') for line in run.stderr.splitlines() if line.startswith('import time:')]
+            seconds.append(sum(int(cumulative) for _, cumulative, name in total if name.strip() == module) * 1e-6)
+            heavy = sorted({m.split('.')[0] for m in json.loads(run.stdout)})
+        records.append({'module': module, 'import_s': min(seconds), 'budget_s': budget, 'heavy_modules': heavy,
+                        'passed': min(seconds) <= budget and not heavy})
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless benchmark of the pitch-shift hot path, one JSON record per case')
+    parser.add_argument('--signal', nargs='+', default=['sine', 'noise', os.path.join(SONGS, 'rocketeer.mp3')],
+                        help=f'{", ".join(SIGNALS)} or paths to songs')
+    parser.add_argument('--rate', nargs='+', type=int, default=[44100])
+    parser.add_argument('--grain', nargs='+', type=int, default=[4096])
+    parser.add_argument('--stride', nargs='+', type=int, default=[1024])
+    parser.add_argument('--shift', nargs='+', type=float, default=[2**(4/12)])
+    parser.add_argument('--threshold', nargs='+', type=float, default=[0.05])
+    parser.add_argument('--mode', nargs='+', choices=PHASE_MODES, default=list(PHASE_MODES))
+    parser.add_argument('--algorithm', nargs='+', choices=ALGORITHMS, default=['vocoder'])
+    parser.add_argument('--quality', action='store_true', help='score each case against an offline reference shift')
+    parser.add_argument('--seconds', type=float, default=5.0, help='audio per case')
+    parser.add_argument('--out', help='append records to this .jsonl file as well as stdout')
+    parser.add_argument('--baseline', help='.jsonl from an earlier run --> exit 1 if any case regressed')
+    parser.add_argument('--metric', default='hop_p99_ms')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--imports', action='store_true', help='report cold import times against IMPORT_BUDGETS instead, exit 1 past one')
+    args = parser.parse_args(argv)
+    if args.imports:
+        records = import_times()
+        for record in records:
+            print(json.dumps(record))
+        return 0 if all(record['passed'] for record in records) else 1
+
+    records = []
+    out = open(args.out, 'a') if args.out else None
+    for record in sweep(args.signal, args.rate, args.grain, args.stride, args.shift, args.threshold, args.mode, args.seconds,
+                        args.algorithm, args.quality):
+        line = json.dumps(record)
+        print(line, flush=True)
+        if out:
+            out.write(line + '\n')
+        records.append(record)
+    if out:
+        out.close()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        regressions = compare(baseline, records, args.metric, args.tolerance)
+        for case, old, new in regressions:
+            print(f'REGRESSION {case}: {args.metric} {old:.3f} -> {new:.3f}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
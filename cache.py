@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+from source import decode
+
+
+class DecodedCache:
+    """Decoded float32 PCM kept on disk as .npy --> a hit is memory-mapped, so no decode and no copy.
+    Mono and multichannel decodes of a song are separate entries, multichannel stored as (frames, channels).
+    Each entry is <key>.npy plus a <key>.json sidecar with the song path and sample rate.
+    Least recently used entries are evicted once the directory grows past max_bytes."""
+    def __init__(self, directory=None, max_bytes=2<<30, hash_content=False):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'pitch_shifter', 'decoded')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def key(self, path, mono=True):
+        """Path + mtime + size, or a hash of the file bytes if hash_content (survives moves and touches)"""
+        digest = hashlib.sha1()
+        if self.hash_content:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1<<20), b''):
+                    digest.update(chunk)
+        else:
+            st = os.stat(path)
+            digest.update(f'{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}'.encode())
+        if not mono:
+            digest.update(b'|channels')
+        return digest.hexdigest()
+
+    def entry_paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.npy', base + '.json'
+
+    def contains(self, path, mono=True):
+        """True if the song is cached --> does not count as a hit or miss"""
+        return os.path.exists(self.entry_paths(self.key(path, mono))[0])
+
+    def load(self, path, mono=True):
+        """Returns (signal, samp_freq) --> signal is a read-only np.memmap, decoded and stored first on a miss"""
+        key = self.key(path, mono)
+        data_path, meta_path = self.entry_paths(key)
+        #the sidecar lands just after the data --> a hit in between is served like a miss
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            with self.lock:
+                self.hits += 1
+            os.utime(data_path) #mtime doubles as the LRU clock
+        else:
+            with self.lock:
+                self.misses += 1
+            self.store(path, key, mono)
+        with open(meta_path) as f:
+            samp_freq = json.load(f)['samp_freq']
+        return np.load(data_path, mmap_mode='r'), samp_freq
+
+    def store(self, path, key=None, mono=True):
+        """Decodes the song and writes it atomically --> readers never see a half-written entry"""
+        key = key or self.key(path, mono)
+        signal, samp_freq = decode(path, mono)
+        with self.replacing(key) as (data_path, meta_path):
+            with open(data_path, 'wb') as f:
+                np.save(f, signal.astype(np.float32, copy=False))
+            with open(meta_path, 'w') as f:
+                json.dump({'path': os.path.abspath(path), 'samp_freq': samp_freq, 'frames': len(signal)}, f)
+        self.evict(keep=key)
+
+    @contextmanager
+    def replacing(self, key):
+        """Temporary (data, sidecar) paths to write an entry to --> moved in place on exit, the data first, so
+        entries() never reads a truncated sidecar nor one without data. Removed instead if writing fails"""
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        paths = self.entry_paths(key)
+        tmp_paths = [p + suffix for p in paths]
+        try:
+            yield tmp_paths
+            for tmp_path, entry_path in zip(tmp_paths, paths):
+                os.replace(tmp_path, entry_path)
+        finally:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def store_async(self, path, mono=True):
+        """Fills the cache on a background thread (e.g. while the song streams) --> returns the thread"""
+        key = self.key(path, mono)
+        with self.lock:
+            thread = self.pending.get(key)
+            if thread is None or not thread.is_alive():
+                self.misses += 1
+                thread = self.pending[key] = threading.Thread(target=self.store, args=(path, key, mono), daemon=True)
+                thread.start()
+        return thread
+
+    def entries(self):
+        """Cached songs, most recently used first --> list of dicts with key, path, samp_freq, frames, bytes, last_used"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            key = name[:-4]
+            data_path, meta_path = self.entry_paths(key)
+            try:
+                st = os.stat(data_path)
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            entries.append(dict(meta, key=key, bytes=st.st_size, last_used=st.st_mtime))
+        return sorted(entries, key=lambda e: e['last_used'], reverse=True)
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits in max_bytes """
+        entries = self.entries()
+        total = sum(e['bytes'] for e in entries)
+        for e in reversed(entries):
+            if total <= self.max_bytes:
+                break
+            if e['key'] == keep:
+                continue
+            self.remove(e['key'])
+            total -= e['bytes']
+
+    def remove(self, key):
+        for entry_path in self.entry_paths(key):
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Removes every entry and resets the counters """
+        for e in self.entries():
+            self.remove(e['key'])
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Returns hit/miss counters and current size """
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+                'bytes': sum(e['bytes'] for e in entries), 'max_bytes': self.max_bytes}
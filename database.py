@@ -1,32 +1,73 @@
 import sqlite3
 import os
-from datetime import datetime
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import soundfile as sf
 
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.aiff')
+SCHEMA = """CREATE TABLE IF NOT EXISTS Musics( M_Name text not null primary key collate nocase,
+                                    M_Path text not null,
+                                    M_Duration real,
+                                    M_SampFreq integer,
+                                    M_Channels integer,
+                                    M_Mtime real);
+            CREATE INDEX IF NOT EXISTS Musics_Path ON Musics(M_Path);
+            CREATE TABLE IF NOT EXISTS Peaks( M_Name text not null primary key collate nocase,
+                                    P_Mtime real,
+                                    P_Index blob); """
+#One statement each, for use inside a transaction --> executescript would commit it first
+SCHEMA_STATEMENTS = [statement for statement in SCHEMA.split(';') if statement.strip()]
 
-class Database:
 
-    def __init__(self):
+def read_metadata(file_):
+    """Header-only read --> (duration, samp_freq, channels, mtime), None for what the file does not tell"""
+    mtime = os.path.getmtime(file_)
+    try:
+        info = sf.info(file_)
+        return info.duration, info.samplerate, info.channels, mtime
+    except RuntimeError: #formats libsndfile cannot open
+        return None, None, None, mtime
 
-        file_ = ''
-        files = [f for f in os.listdir() if f.endswith('.db')]
 
-        if len(files) == 1:
-            file_ = files[0]
-            self.reset = False
-        elif len(files) == 0:
-            file_ = f'music_record.db'
-            self.reset = True
+class Database:
 
+    def __init__(self, file_=None, workers=None):
+        """file_: The .db to open, by default the single .db in the CWD (music_record.db if there is none)
+        workers: Threads for metadata reads during imports, defaults to ThreadPoolExecutor's choice"""
+        if file_ is None:
+            files = [f for f in os.listdir() if f.endswith('.db')]
+            file_ = files[0] if len(files) == 1 else 'music_record.db'
+        self.workers = workers
+        self.file_ = file_
+        self.indexing = {}      #song --> thread building its waveform index, see index_peaks_async
+        self.index_errors = {}  #song --> why its last waveform index build failed
 
         self.conn = sqlite3.connect(file_)
         self.cur = self.conn.cursor()
+        self.cur.execute("PRAGMA journal_mode=WAL") #readers never block the writer
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+        self.cur.executescript(SCHEMA)
+        self.conn.commit()
 
-        if self.reset:
-            self.cur.executescript(""" drop table if exists Musics;
-                                    CREATE TABLE Musics( M_Name text not null,
-                                    M_Path text not null); """
-            )
-            self.conn.commit()
+    def migrate(self):
+        """Moves a table from before the key existed into the indexed schema, first row of a duplicate name wins.
+        One transaction, so a crash leaves either table intact. A Musics_Old left behind by a crash of an earlier,
+        non-atomic version of this is copied over too"""
+        tables = {row[0] for row in self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        columns = [row[1] for row in self.cur.execute("PRAGMA table_info(Musics)")]
+        rename = bool(columns) and 'M_Duration' not in columns
+        if not rename and 'Musics_Old' not in tables:
+            return
+        with self.conn:
+            self.cur.execute("BEGIN") #DDL does not open a transaction by itself
+            if rename:
+                self.cur.execute("ALTER TABLE Musics RENAME TO Musics_Old")
+            for statement in SCHEMA_STATEMENTS:
+                self.cur.execute(statement)
+            self.cur.execute("INSERT OR IGNORE INTO Musics (M_Name, M_Path) SELECT M_Name, M_Path FROM Musics_Old ORDER BY rowid")
+            self.cur.execute("DROP TABLE Musics_Old")
 
     def print_contents(self):
         print('All Music')
@@ -36,23 +77,158 @@ class Database:
             print(row)
 
     def add_to_music(self, music, path):
-        self.cur.execute("SELECT * FROM Musics WHERE M_Name = :name", {'name': music})
-        result = self.cur.fetchall()
-        if len(result) >0:
-            return -1
-        self.cur.execute("""INSERT INTO Musics (M_Name, M_Path) VALUES
+        """Adds one song --> -1 if the name is taken"""
+        self.cur.execute("""INSERT OR IGNORE INTO Musics (M_Name, M_Path) VALUES
             (:m_name, :m_path)""", {'m_name': music, 'm_path': path})
         self.conn.commit()
-        return 0
+        return 0 if self.cur.rowcount == 1 else -1
+
+    def add_musics(self, musics, metadata=True):
+        """Adds many (name, directory) pairs in one transaction --> list of names that were already taken.
+        metadata: Read duration, sample rate and channels from the file headers on a thread pool first.
+        Files are found as directory + name + extension, like player.play expects (.mp3 first)"""
+        musics = list(musics)
+        meta = [(None, None, None, None)] * len(musics)
+        if metadata:
+            with ThreadPoolExecutor(self.workers) as pool:
+                meta = list(pool.map(lambda m: self.metadata_or_none(*m), musics))
+        with self.conn:
+            taken = []
+            for (name, path), (duration, samp_freq, channels, mtime) in zip(musics, meta):
+                self.cur.execute("""INSERT OR IGNORE INTO Musics VALUES
+                    (:m_name, :m_path, :duration, :samp_freq, :channels, :mtime)""",
+                    {'m_name': name, 'm_path': path, 'duration': duration, 'samp_freq': samp_freq,
+                     'channels': channels, 'mtime': mtime})
+                if self.cur.rowcount == 0:
+                    taken.append(name)
+        return taken
+
+    def metadata_or_none(self, music, path):
+        file_ = self.find_file(music, path)
+        return read_metadata(file_) if file_ else (None, None, None, None)
+
+    def find_file(self, music, path):
+        """directory + name + extension of a song that exists --> None if no AUDIO_EXTENSIONS one does.
+        Upper-case extensions count too, import_directory takes them"""
+        for ext in AUDIO_EXTENSIONS + tuple(e.upper() for e in AUDIO_EXTENSIONS):
+            if os.path.exists(f'{path}{music}{ext}'):
+                return f'{path}{music}{ext}'
+        return None
+
+    def import_directory(self, directory, recursive=True):
+        """Scans directory for songs and adds them all in one transaction --> (added, taken) name lists"""
+        musics = []
+        for root, dirs, names in os.walk(directory):
+            musics += [(os.path.splitext(n)[0], os.path.join(os.path.abspath(root), '')) for n in sorted(names)
+                       if n.lower().endswith(AUDIO_EXTENSIONS)]
+            if not recursive:
+                break
+        taken = set(self.add_musics(musics))
+        return [name for name, _ in musics if name not in taken], sorted(taken)
+
+    def refresh_metadata(self, stale_only=True):
+        """Re-reads headers of songs without metadata or changed on disk since --> number of rows updated"""
+        rows = self.cur.execute("SELECT M_Name, M_Path, M_Mtime FROM Musics").fetchall()
+        todo = []
+        for name, path, mtime in rows:
+            file_ = self.find_file(name, path)
+            if file_ and (not stale_only or mtime is None or os.path.getmtime(file_) != mtime):
+                todo.append((name, path))
+        with ThreadPoolExecutor(self.workers) as pool:
+            meta = list(pool.map(lambda m: self.metadata_or_none(*m), todo))
+        with self.conn:
+            self.cur.executemany("""UPDATE Musics SET M_Duration = ?, M_SampFreq = ?, M_Channels = ?, M_Mtime = ?
+                WHERE M_Name = ?""", [m + (name,) for (name, _), m in zip(todo, meta)])
+        return len(todo)
 
     def del_from_music(self, music):
         self.cur.execute("DELETE FROM Musics WHERE M_Name = :m_name", {'m_name': music})
+        self.cur.execute("DELETE FROM Peaks WHERE M_Name = :m_name", {'m_name': music})
         self.conn.commit()
 
-    def get_musics(self):
-        self.cur.execute("SELECT * FROM Musics")
+    def get_musics(self, limit=None, offset=0):
+        """(name, directory) rows in name order --> all of them, or one page"""
+        self.cur.execute("SELECT M_Name, M_Path FROM Musics ORDER BY M_Name LIMIT :limit OFFSET :offset",
+                         {'limit': -1 if limit is None else limit, 'offset': offset})
         return self.cur.fetchall()
 
+    def search(self, prefix, limit=50, offset=0):
+        """(name, directory) rows whose name starts with prefix, case-insensitive --> uses the primary key index"""
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        self.cur.execute("""SELECT M_Name, M_Path FROM Musics WHERE M_Name LIKE :pattern ESCAPE '\\'
+            ORDER BY M_Name LIMIT :limit OFFSET :offset""", {'pattern': pattern, 'limit': limit, 'offset': offset})
+        return self.cur.fetchall()
+
+    def count(self):
+        return self.cur.execute("SELECT COUNT(*) FROM Musics").fetchone()[0]
+
+    def get_metadata(self, music):
+        """Cached header info --> dict with duration, samp_freq, channels, mtime, or None for an unknown song"""
+        self.cur.execute("""SELECT M_Duration, M_SampFreq, M_Channels, M_Mtime FROM Musics
+            WHERE M_Name = :m_name""", {'m_name': music})
+        row = self.cur.fetchone()
+        return dict(zip(('duration', 'samp_freq', 'channels', 'mtime'), row)) if row else None
+
     def get_directory(self, music):
         self.cur.execute("SELECT M_Path FROM Musics WHERE M_Name = :m_name", {'m_name': music})
-        return self.cur.fetchall()[0][0]
+        return self.cur.fetchone()[0]
+
+    def get_peaks(self, music):
+        """Waveform index of the song --> peaks.PeakIndex, None if not built or the file changed since"""
+        self.cur.execute("""SELECT Peaks.P_Mtime, Peaks.P_Index, Musics.M_Path FROM Peaks JOIN Musics USING (M_Name)
+            WHERE M_Name = :m_name""", {'m_name': music})
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        mtime, blob, path = row
+        file_ = self.find_file(music, path)
+        if file_ is None or os.path.getmtime(file_) != mtime:
+            return None
+        from peaks import PeakIndex
+        return PeakIndex.frombytes(blob)
+
+    def store_peaks(self, music, index, mtime):
+        """Saves a waveform index built from the file as it was at mtime --> own connection, so any thread may call it"""
+        with sqlite3.connect(self.file_, timeout=30) as conn:
+            conn.execute("INSERT OR REPLACE INTO Peaks VALUES (:m_name, :mtime, :index)",
+                         {'m_name': music, 'mtime': mtime, 'index': index.tobytes()})
+        conn.close()
+
+    def index_peaks_async(self, music, cache=None):
+        """Builds and stores the song's waveform index on a background thread unless it is there already --> the thread,
+        or None. cache: Optional cache.DecodedCache --> waits on (or starts) the cache fill and indexes the
+        memory-mapped PCM, so the song is decoded once for playback and index alike"""
+        if self.get_peaks(music) is not None:
+            return None
+        file_ = self.find_file(music, self.get_directory(music))
+        if file_ is None:
+            return None
+        thread = self.indexing.get(music)
+        if thread is None or not thread.is_alive():
+            thread = self.indexing[music] = threading.Thread(target=self.index_peaks, args=(music, file_, cache), daemon=True)
+            thread.start()
+        return thread
+
+    def index_peaks(self, music, file_, cache=None):
+        """Builds and stores the song's waveform index --> a failure (undecodable file, cache error) is kept in
+        index_errors and reported instead of ending the thread unseen, so callers stop waiting for the index"""
+        from peaks import PeakIndex
+        try:
+            mtime = os.path.getmtime(file_)
+            if cache is None:
+                from source import decode
+                signal, samp_freq = decode(file_, mono=False)
+            else:
+                if not cache.contains(file_):
+                    cache.store_async(file_).join()
+                signal, samp_freq = cache.load(file_)
+            self.store_peaks(music, PeakIndex.build(signal, samp_freq), mtime)
+            self.index_errors.pop(music, None)
+        except Exception as e:
+            self.index_errors[music] = e
+            print(f'no waveform for {music}: {e!r}', file=sys.stderr)
+
+    def indexing_peaks(self, music):
+        """Whether the song's waveform index is being built right now --> False once stored, failed or never started"""
+        thread = self.indexing.get(music)
+        return thread is not None and thread.is_alive()
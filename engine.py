@@ -0,0 +1,318 @@
+import sys
+import threading
+from collections import deque
+import numpy as np
+import soundfile as sf
+from pitch_shift import PitchShifter
+from sink import PyAudioSink, paContinue
+
+
+class AudioEngine:
+    """One long-lived output stream that plays a queue of songs back to back.
+    Each song is a headless PitchShifter (output=False) whose callback the engine's own stream callback calls.
+    A loader thread builds the next queued songs while the current one plays (decode, cache, lookahead priming),
+    so a song ending switches to the next one inside the same callback --> no gap, nothing done on the GUI thread.
+    Every song starts with a fresh vocoder; the overlap-add tail of the one that ended is mixed into the first
+    hops of the next, so the last grain rings out instead of being cut.
+    The stream is only reopened when the next song has another sample rate or channel count."""
+    def __init__(self, preload=1, output=True, setup=None, on_error=None, **shifter_kwargs):
+        """preload: Queued songs kept built ahead of time
+        output: True plays on the sound card, False opens no stream --> drive callback() yourself.
+        Or a sink from sink.py, e.g. WavSink('queue.flac') --> records what plays, silence between and after songs too
+        setup: Optional callable(shifter) run on every song once built, e.g. to enable the governor
+        on_error: Optional callable(source, exception) for songs that fail to build (missing, undecodable), called
+        on the loader thread --> the song is skipped either way, by default with a message on stderr
+        shifter_kwargs: Go to every PitchShifter (phase_mode, streaming, cache, mono, lookahead, stride, ...)"""
+        self.preload = preload
+        self.setup = setup
+        self.on_error = on_error
+        self.shifter_kwargs = shifter_kwargs
+        self.stride = shifter_kwargs.get('stride', 1024)
+        self.shift_factor = 1.0
+        self.current = None     #(source, shifter) playing now
+        self.queue = deque()    #sources not built yet
+        self.ready = deque()    #(generation, source, shifter) built, in queue order
+        self.pending = None     #source load() asked for, muted until it is built
+        self.jump = None        #(generation, source, shifter) for the callback to switch to
+        self.reopen = None      #(source, shifter) that needs a stream in another format
+        self.generation = 0     #bumped by load() --> songs built for an older queue are dropped
+        self.retired = deque()  #shifters done playing, closed by the loader
+        self.tail = None        #overlap-add tail of the song that just ended, interleaved
+        self.tail_pos = 0
+        self.format = None      #(samp_freq, channels) of the open stream
+        self.silence = b''
+        self.switches = 0
+        self.playing = False
+        self.closed = False
+        self.lock = threading.Lock() #queue and stream changes, never taken by the callback
+        self.wake = threading.Event()
+        self.sink = None
+        self.stream = None
+        if output is not False and output is not None:
+            self.sink = PyAudioSink() if output is True else output
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load(self, source, *upcoming):
+        """Plays source as soon as it is built, then the upcoming ones --> returns immediately.
+        Anything queued before is dropped; the song playing now goes quiet until the switch.
+        Raises ValueError, and changes nothing, if the sink cannot play one of them, see check"""
+        for s in (source,) + upcoming:
+            self.check(s)
+        with self.lock:
+            self.generation += 1
+            self.queue = deque(upcoming)
+            self.pending = source
+            self.jump = None
+        self.wake.set()
+
+    def enqueue(self, *sources):
+        """Appends songs to play once the current one and those already queued end --> ValueError like load"""
+        for source in sources:
+            self.check(source)
+        with self.lock:
+            self.queue.extend(sources)
+        self.wake.set()
+
+    def clear(self):
+        """Drops queued songs, the current one plays to its end """
+        with self.lock:
+            self.generation += 1
+            self.queue.clear()
+        self.wake.set()
+
+    def build(self, source):
+        shifter = PitchShifter(source, self.shift_factor, output=False, **self.shifter_kwargs)
+        if self.setup is not None:
+            self.setup(shifter)
+        return shifter
+
+    def check(self, source):
+        """Raises ValueError if the sink cannot take the song's format, e.g. a WavSink another sample rate -->
+        from the file header, so in the caller and not on the loader. Files libsndfile cannot open are left to it"""
+        if self.sink is None:
+            return
+        mono = self.shifter_kwargs.get('mono', True)
+        if hasattr(source, 'read'):
+            samp_freq, channels = source.samp_freq, source.channels
+        else:
+            try:
+                info = sf.info(source)
+            except RuntimeError:
+                return
+            samp_freq, channels = info.samplerate, 1 if mono else info.channels
+        self.sink.check(samp_freq, channels)
+
+    def report(self, source, error):
+        if self.on_error is not None:
+            self.on_error(source, error)
+        else:
+            print(f'skipping {source}: {error!r}', file=sys.stderr)
+
+    def try_build(self, source):
+        """build, or None if the song cannot be played --> reported, the loader carries on with the next one"""
+        try:
+            return self.build(source)
+        except Exception as e: #a dead loader would silently stop every later song too
+            self.report(source, e)
+            return None
+
+    def try_start(self, source, shifter):
+        """start_song, or False if the sink refuses the song's format --> reported and the song retired"""
+        try:
+            self.start_song(source, shifter)
+            return True
+        except ValueError as e:
+            self.report(source, e)
+            self.retired.append(shifter)
+            return False
+
+    def run(self):
+        """Loader thread --> builds queued songs, reopens the stream when needed and closes finished songs"""
+        while not self.closed:
+            self.wake.wait(0.05)
+            self.wake.clear()
+            while self.retired:
+                self.retired.popleft().close()
+            if self.reopen is not None:
+                with self.lock:
+                    self.try_start(*self.reopen)
+                    self.reopen = None
+            pending, generation = self.pending, self.generation
+            if pending is not None:
+                shifter = self.try_build(pending)
+                track = (generation, pending, shifter)
+                with self.lock:
+                    if generation != self.generation: #load() was called again meanwhile
+                        if shifter is not None:
+                            self.retired.append(shifter)
+                        continue
+                    if shifter is None: #next queued song takes its place
+                        self.pending = self.queue.popleft() if self.queue else None
+                        continue
+                    self.pending = None
+                    if shifter.getPitch() != self.shift_factor: #setPitch() ran while it was built
+                        shifter.setPitch(self.shift_factor)
+                    active = self.stream is not None and self.stream.is_active()
+                    if active and self.same_format(track[2]):
+                        self.jump = track
+                    else: #the callback is not running --> switch here
+                        if self.current is not None:
+                            self.retired.append(self.current[1])
+                        self.current = None
+                        self.tail = None
+                        self.try_start(pending, track[2])
+                continue
+            while self.ready and self.ready[0][0] != self.generation:
+                self.retired.append(self.ready.popleft()[2])
+            if self.queue and len(self.ready) < self.preload:
+                with self.lock:
+                    source = self.queue.popleft() if self.queue else None
+                if source is not None:
+                    shifter = self.try_build(source)
+                    if shifter is None:
+                        continue
+                    if shifter.getPitch() != self.shift_factor: #setPitch() ran while it was built
+                        shifter.setPitch(self.shift_factor)
+                    self.ready.append((generation, source, shifter))
+                    self.wake.set()
+
+    def same_format(self, shifter):
+        return self.format == (shifter.samp_freq, shifter.CHANNELS)
+
+    def start_song(self, source, shifter):
+        """Loader side switch, with the lock held and the callback not running --> reopens the stream if needed"""
+        if self.sink is not None and not self.same_format(shifter):
+            self.sink.check(shifter.samp_freq, shifter.CHANNELS) #a refused song leaves the old stream playing on
+            if self.stream is not None:
+                self.stream.stop_stream()
+                self.stream.close()
+            self.stream = self.sink.open(self.callback, shifter.CHANNELS, shifter.samp_freq, self.stride)
+        self.format = (shifter.samp_freq, shifter.CHANNELS)
+        self.silence = np.zeros_like(shifter.output_buffer).tobytes()
+        self.current = (source, shifter)
+        self.switches += 1
+        if self.playing and self.stream is not None and not self.stream.is_active():
+            self.stream.start_stream()
+
+    def next_ready(self):
+        """Pops the next built song of the current queue, drops stale ones --> None if nothing is built yet"""
+        while self.ready:
+            generation, source, shifter = self.ready.popleft()
+            if generation == self.generation:
+                return source, shifter
+            self.retired.append(shifter)
+        return None
+
+    def advance(self):
+        """Callback side: moves on to the next built song --> False if there is none yet or it needs another format"""
+        track = self.next_ready()
+        self.wake.set()
+        if track is None or not self.same_format(track[1]):
+            self.current = None
+            self.reopen = track
+            return False
+        self.current = track
+        self.switches += 1
+        return True
+
+    def retire(self, shifter):
+        """Keeps the ended song's overlap-add tail for the next one and hands the song to the loader to close"""
+        self.tail = np.ascontiguousarray(shifter.prev_grain.T)
+        self.tail_pos = 0
+        self.retired.append(shifter)
+
+    def callback(self, in_data, frame_count, time_info, status):
+        """Stream callback --> the current song's callback, switching songs at the block boundary when it ends"""
+        jump = self.jump
+        if jump is not None and jump[0] == self.generation:
+            self.jump = None
+            if self.current is not None:
+                self.retired.append(self.current[1])
+            self.tail = None
+            self.current = jump[1:]
+            self.switches += 1
+        elif self.pending is not None:
+            return (self.silence, paContinue)
+        elif self.current is None and (self.reopen is not None or not self.advance()): #next song still being built
+            return (self.silence, paContinue)
+        data, flag = self.current[1].callback(in_data, frame_count, time_info, status)
+        while flag != paContinue: #song over --> next built one takes this very block
+            self.retire(self.current[1])
+            if not self.advance():
+                return (self.silence, paContinue)
+            data, flag = self.current[1].callback(in_data, frame_count, time_info, status)
+        if self.tail is not None:
+            block = np.frombuffer(data, dtype=np.float32).reshape(self.current[1].output_buffer.shape)
+            tail = self.tail[self.tail_pos:self.tail_pos + len(block)]
+            if tail.shape[1:] == block.shape[1:]:
+                data = (block[:len(tail)] + tail).tobytes() + block[len(tail):].tobytes()
+            self.tail_pos += len(block)
+            if self.tail_pos >= len(self.tail) or tail.shape[1:] != block.shape[1:]:
+                self.tail = None
+        return (data, paContinue)
+
+    def play(self):
+        """Starts or resumes the stream, or remembers to once the first song is built"""
+        with self.lock:
+            self.playing = True
+            if self.stream is not None and not self.stream.is_active():
+                self.stream.start_stream()
+
+    def pause(self):
+        with self.lock:
+            self.playing = False
+            if self.stream is not None:
+                self.stream.stop_stream()
+
+    def close(self):
+        """Stops the loader and the stream, closes every song and the sink --> unusable afterwards"""
+        self.closed = True
+        self.thread.join()
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+        if self.sink is not None:
+            self.sink.close()
+        shifters = [self.current, self.jump, self.reopen] + list(self.ready)
+        shifters = [t[-1] for t in shifters if t is not None] + list(self.retired)
+        for shifter in shifters:
+            shifter.close()
+        self.current = self.jump = self.reopen = None
+        self.ready.clear()
+        self.retired.clear()
+
+    def getShifter(self):
+        """Returns the PitchShifter playing now --> None between songs and while load() is building one"""
+        if self.pending is not None or self.current is None:
+            return None
+        return self.current[1]
+
+    def getTrack(self):
+        """Returns the source (path) playing now, or the one load() is building --> None when idle"""
+        if self.pending is not None:
+            return self.pending
+        return self.current[0] if self.current is not None else None
+
+    def getPitch(self):
+        return self.shift_factor
+
+    def setPitch(self, shift_factor):
+        """Sets the pitch of the current song and of every song built from now on """
+        self.shift_factor = shift_factor
+        for track in [self.current, self.jump] + list(self.ready):
+            if track is not None:
+                track[-1].setPitch(shift_factor)
+
+    def getTime(self):
+        shifter = self.getShifter()
+        return shifter.getTime() if shifter is not None else 0.0
+
+    def setTime(self, seconds):
+        shifter = self.getShifter()
+        if shifter is not None:
+            shifter.setTime(seconds)
+
+    def getDuration(self):
+        shifter = self.getShifter()
+        return shifter.DURATION if shifter is not None else 0.0
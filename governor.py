@@ -0,0 +1,75 @@
+#(phase mode, threshold) from best to cheapest, see utils.ENGINES for the tiers. 'array' gives the same output as
+#'heap' for a fraction of the cost, so the heap only shows up here if you pass your own levels
+QUALITY_LEVELS = (('array', 0.0), ('array', 0.01), ('array', 0.05), ('array', 0.2), ('peak', 0.05), ('basic', 0.0))
+
+
+class QualityGovernor:
+    """Keeps the vocoder inside the callback deadline by stepping along a ladder of quality levels.
+    Load is hop time over the hop budget (stride / samp_freq), smoothed over recent hops.
+    Hysteresis: load above `high` for `patience` hops steps one level cheaper, load below `low` for
+    4*patience hops steps one level better --> unless the better level's predicted load would be above `high`.
+    Predictions use the cost ratio between neighbouring levels learned on earlier switches, so they follow
+    a box that gets busier or quieter. Every switch is followed by `cooldown` hops without decisions."""
+    def __init__(self, shifter, levels=QUALITY_LEVELS, level=None, low=0.3, high=0.7, smoothing=0.1,
+                 patience=8, cooldown=32):
+        self.shifter = shifter
+        self.levels = levels
+        self.budget = shifter.STRIDE / shifter.samp_freq
+        self.low, self.high = low, high
+        self.smoothing = smoothing
+        self.patience = patience
+        self.cooldown = cooldown
+        self.level = self.nearest() if level is None else level
+        self.load = 0.0
+        self.step_cost = [1.0] * (len(levels) - 1) #load at level i over load at level i+1
+        self.before = None  #(level, settled load) before the last switch
+        self.above = self.below = 0
+        self.hold = cooldown
+        self.hops = 0
+        self.history = []   #one dict per switch
+        self.apply()
+
+    def nearest(self):
+        """Level closest to the vocoder's current mode and threshold """
+        vocoder = self.shifter.phase_vocoder
+        same_mode = [i for i, (mode, _) in enumerate(self.levels) if mode == vocoder.mode] or range(len(self.levels))
+        return min(same_mode, key=lambda i: abs(self.levels[i][1] - vocoder.threshold))
+
+    def apply(self):
+        mode, threshold = self.levels[self.level]
+        self.shifter.setPhaseMode(mode)
+        self.shifter.phase_vocoder.threshold = threshold
+
+    def observe(self, seconds):
+        """Called after every hop with how long it took --> may switch level before the next hop"""
+        self.hops += 1
+        self.load += self.smoothing * (seconds / self.budget - self.load)
+        if self.hold:
+            self.hold -= 1
+            if not self.hold and self.before is not None and self.load > 0:
+                level, load = self.before
+                better, cheaper = (load, self.load) if level < self.level else (self.load, load)
+                self.step_cost[min(level, self.level)] = better / cheaper
+            return
+        self.above = self.above + 1 if self.load > self.high else 0
+        self.below = self.below + 1 if self.load < self.low else 0
+        if self.above >= self.patience and self.level < len(self.levels) - 1:
+            self.switch(self.level + 1)
+        elif self.below >= 4 * self.patience and self.level > 0:
+            if self.load * self.step_cost[self.level - 1] < self.high:
+                self.switch(self.level - 1)
+
+    def switch(self, level):
+        self.history.append({'hop': self.hops, 'time': self.shifter.getTime(), 'load': self.load,
+                             'from': self.levels[self.level], 'to': self.levels[level]})
+        self.before = (self.level, self.load) if not self.hold else None
+        self.level = level
+        self.apply()
+        self.above = self.below = 0
+        self.hold = self.cooldown
+
+    def state(self):
+        """Current level, its mode and threshold, smoothed load and every switch so far """
+        mode, threshold = self.levels[self.level]
+        return {'level': self.level, 'levels': len(self.levels), 'mode': mode, 'threshold': threshold,
+                'load': self.load, 'history': list(self.history)}
@@ -0,0 +1,192 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import soundfile as sf
+from source import open_source, ArraySource
+from pitch_shift import PitchShifter
+from utils import build_dft_rescale_lookup, make_vocoder
+from telemetry import Telemetry, WINDOW, RFFT, RESCALE, PHASE, IRFFT, OVERLAP_ADD, HOP
+from signals import synthesize, percentiles
+
+
+class Harmonizer:
+    """Several pitch-shifted voices of one mono input, analysed once per hop.
+    Window, rfft, magnitude and phase of the input grain are computed a single time; each voice's SHIFT_IDX map
+    then gathers its row of an (N, bins) frame, which one vocoder with a pitch ratio and phase state per row
+    propagates as a batch, followed by one batched irfft. A voice matches what PitchShifter plays at its ratio.
+    Voices come out separately in `voices` (N, STRIDE) and mixed with `gains` in `output_buffer`."""
+    def __init__(self, input_wav, shift_factors, gains=None, phase_mode='array', streaming=False, cache=None,
+                 grain_len=4096, stride=1024, dtype=np.float32):
+        """shift_factors: One pitch scale ratio per voice, e.g. 2**(np.array([0, 4, 7])/12) for a major triad
+        gains: Mix weight per voice, 1/N each by default"""
+        self.source = input_wav if hasattr(input_wav, 'read') else open_source(input_wav, streaming, cache, mono=True)
+        assert self.source.mono, "The harmonizer is mono only"
+        assert grain_len % stride == 0 and grain_len >= 2*stride, "Grain length must be a multiple of at least twice the stride"
+        self.samp_freq = self.source.samp_freq
+        self.N_VOICES = len(shift_factors)
+        self.GRAIN_LEN_SAMP = grain_len
+        self.STRIDE = stride
+        self.OVERLAP_LEN = grain_len - stride
+        self.N_BINS = grain_len // 2 + 1
+        self.DURATION = round(self.source.frames / self.samp_freq, 3)
+        voices = (self.N_VOICES,)
+        self.gains = np.full(voices, 1 / self.N_VOICES, np.float32) if gains is None else np.asarray(gains, np.float32)
+        #shared analysis
+        self.window = np.hanning(grain_len).astype(dtype)
+        self.x_prev = np.zeros(self.OVERLAP_LEN, np.float32)
+        self.input_concat = np.zeros(grain_len, np.float32)
+        self.windowed = np.zeros(grain_len, dtype)
+        self.X = np.zeros(self.N_BINS, np.result_type(dtype, np.complex64))
+        self.magn = np.zeros(self.N_BINS + 1, dtype)    #last slot stays 0 --> source of bins no input bin maps to
+        self.phase = np.zeros(self.N_BINS + 1, dtype)
+        #per voice
+        self.src = np.zeros(voices + (self.N_BINS,), np.intp) #input bin feeding each voice's output bin
+        self.vocoder = make_vocoder(phase_mode, grain_len, list(shift_factors), channels=self.N_VOICES, dtype=dtype)
+        self.Y = np.zeros(voices + (self.N_BINS,), self.X.dtype)
+        self.grains = np.zeros(voices + (grain_len,), dtype)
+        self.synthesis_window = np.zeros(voices + (grain_len,), dtype) #full shape, see PhaseVocoder.update
+        self.synthesis_window[:] = self.window
+        self.prev_grain = np.zeros(voices + (self.OVERLAP_LEN,), dtype)
+        self.voices = np.zeros(voices + (stride,), np.float32)
+        self.output_buffer = np.zeros(stride, np.float32)
+        self.shift_factors = None
+        self.pending = list(shift_factors)
+        self.apply_shifts()
+        self.stats = Telemetry(stride / self.samp_freq)
+        self.count = 0
+
+    def apply_shifts(self):
+        """Rebuilds the gather maps and the vocoder's ratios --> at the start of a hop, never during one"""
+        self.shift_factors, self.pending = self.pending, None
+        for v, shift_factor in enumerate(self.shift_factors):
+            shift_idx, max_bin = build_dft_rescale_lookup(self.N_BINS, shift_factor)
+            max_bin = min(max_bin, self.N_BINS)
+            self.src[v] = self.N_BINS
+            self.src[v, shift_idx[:max_bin]] = np.arange(max_bin) #same last-write-wins as dft_rescale when bins collide
+        self.vocoder.update(list(self.shift_factors))
+
+    def setPitches(self, shift_factors):
+        """Sets every voice's pitch scale ratio, takes effect on the next hop """
+        assert len(shift_factors) == self.N_VOICES, "One pitch per voice"
+        assert all(-3 < f < 3 for f in shift_factors), "Pitch must be bounded between 2 octaves"
+        self.pending = list(shift_factors)
+
+    def getPitches(self):
+        return list(self.pending or self.shift_factors)
+
+    def hop(self, count):
+        """Renders hop number count into voices and output_buffer --> False once the input runs out"""
+        start = time.perf_counter()
+        if self.pending is not None:
+            self.apply_shifts()
+        input_buffer = self.source.read(self.STRIDE * count, self.STRIDE)
+        if len(input_buffer) < self.STRIDE:
+            return False
+        stats, vocoder = self.stats, self.vocoder
+        stats.start()
+        self.input_concat[:self.OVERLAP_LEN], self.input_concat[self.OVERLAP_LEN:] = self.x_prev, input_buffer
+        np.multiply(self.input_concat, self.window, out=self.windowed)
+        stats.mark(WINDOW)
+        np.fft.rfft(self.windowed, out=self.X, norm='forward') #see FrameWorkspace.rescale on the scaling
+        self.X *= self.GRAIN_LEN_SAMP
+        stats.mark(RFFT)
+        np.arctan2(self.X.imag, self.X.real, out=self.phase[:-1])
+        np.abs(self.X, out=self.magn[:-1])
+        np.take(self.phase, self.src, out=vocoder.current_phase, mode='clip')
+        np.take(self.magn, self.src, out=vocoder.current_magn, mode='clip')
+        stats.mark(RESCALE)
+        vocoder.propagate(out=self.Y)
+        stats.mark(PHASE)
+        np.fft.irfft(self.Y, n=self.GRAIN_LEN_SAMP, out=self.grains)
+        stats.mark(IRFFT)
+        self.grains *= self.synthesis_window
+        update = self.OVERLAP_LEN - self.STRIDE
+        for voice, prev_grain, grain in zip(self.voices, self.prev_grain, self.grains): #1-D rows, see PitchShifter.rows
+            np.add(prev_grain[:self.STRIDE], grain[:self.STRIDE], out=voice)
+            prev_grain[:update], prev_grain[update:] = prev_grain[self.STRIDE:], grain[-self.STRIDE:]
+            prev_grain[:update] += grain[self.STRIDE:self.OVERLAP_LEN]
+        self.x_prev[:update], self.x_prev[update:] = self.x_prev[self.STRIDE:], input_buffer
+        np.dot(self.gains, self.voices, out=self.output_buffer)
+        stats.mark(OVERLAP_ADD)
+        stats.record(HOP, time.perf_counter() - start)
+        return True
+
+    def render(self, mix=True):
+        """Whole input from the start --> mixed (frames,) or every voice (N, frames)"""
+        hops = self.source.frames // self.STRIDE
+        out = np.zeros((hops * self.STRIDE,) if mix else (self.N_VOICES, hops * self.STRIDE), np.float32)
+        self.count = 0
+        while self.count < hops and self.hop(self.count):
+            block = slice(self.count * self.STRIDE, (self.count + 1) * self.STRIDE)
+            out[..., block] = self.output_buffer if mix else self.voices
+            self.count += 1
+        return out
+
+    def getStats(self):
+        return self.stats.snapshot()
+
+    def close(self):
+        self.source.close()
+
+
+def scaling(voice_counts=(1, 2, 4, 8), samp_freq=44100, seconds=5.0, phase_mode='array', grain_len=4096, stride=1024):
+    """Cost per hop against the number of voices, shared analysis vs one PitchShifter per voice --> list of flat dicts"""
+    signal = synthesize('sine', samp_freq, seconds)
+    hops = len(signal) // stride
+    records = []
+    for n in voice_counts:
+        shifts = [2**(s/12) for s in np.linspace(-5, 7, n)] if n > 1 else [2**(4/12)]
+        harmonizer = Harmonizer(ArraySource(signal, samp_freq), shifts, phase_mode=phase_mode, grain_len=grain_len, stride=stride)
+        shifters = [PitchShifter(ArraySource(signal, samp_freq), f, phase_mode, grain_len=grain_len, stride=stride, output=False)
+                    for f in shifts]
+        shared, separate = [], []
+        for count in range(hops):
+            start = time.perf_counter()
+            harmonizer.hop(count)
+            shared.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            for shifter in shifters:
+                shifter.hop(count)
+            separate.append(time.perf_counter() - start)
+        record = {'voices': n, 'phase_mode': phase_mode, 'grain_len': grain_len, 'stride': stride}
+        record.update(percentiles(shared[8:], 'hop'))
+        record.update(percentiles(separate[8:], 'separate'))
+        record['per_voice_ms'] = record['hop_p50_ms'] / n
+        record['speedup'] = record['separate_p50_ms'] / record['hop_p50_ms']
+        record['realtime_factor'] = float(np.mean(shared[8:])) / (stride / samp_freq)
+        records.append(record)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render several pitch-shifted voices of a song from one analysis')
+    parser.add_argument('song', nargs='?', help='input song, omit with --scaling')
+    parser.add_argument('-s', '--semitones', nargs='+', type=float, default=[0, 4, 7], help='one voice per value')
+    parser.add_argument('-g', '--gains', nargs='+', type=float, help='mix weight per voice, 1/N each by default')
+    parser.add_argument('-o', '--out', default='harmony.wav', help='mixed output, or the stem of one file per voice')
+    parser.add_argument('--separate', action='store_true', help='write each voice to its own file instead of the mix')
+    parser.add_argument('--mode', default='array', help='phase engine, see utils.ENGINES')
+    parser.add_argument('--scaling', nargs='*', type=int, help='report cost per hop for these voice counts instead')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.scaling is not None:
+        for record in scaling(args.scaling or (1, 2, 4, 8), phase_mode=args.mode):
+            print(json.dumps(record))
+        return
+    if args.song is None:
+        parser.error('give a song or --scaling')
+    harmonizer = Harmonizer(args.song, [2**(s/12) for s in args.semitones], args.gains, args.mode)
+    out = harmonizer.render(mix=not args.separate)
+    if args.separate:
+        stem = args.out[:-4] if args.out.endswith('.wav') else args.out
+        for semitones, voice in zip(args.semitones, out):
+            sf.write(f'{stem}{semitones:g}.wav', voice, harmonizer.samp_freq)
+    else:
+        sf.write(args.out, out, harmonizer.samp_freq)
+    print(json.dumps(harmonizer.getStats()['stages']['hop']))
+    harmonizer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from source import LiveSource
+from pitch_shift import PitchShifter
+from signals import synthesize
+
+#(grain_len, stride) pairs the loopback measurement tries by default, latency roughly halves with each
+CONFIGS = ((4096, 1024), (2048, 512), (1024, 256), (512, 128))
+
+
+class NullDevice:
+    """Stands in for a duplex sound card --> calls a stream callback with one input block at a time and keeps the
+    output blocks it returns, as PortAudio would, without any hardware. Sample t of the input can only be handed
+    over once its whole block is captured, so input and output timelines are one block apart, plus the
+    `input_latency` and `output_latency` frames a real device would add."""
+    def __init__(self, frames_per_buffer, channels=1, input_latency=0, output_latency=0, samp_freq=44100):
+        self.frames_per_buffer = frames_per_buffer
+        self.channels = channels
+        self.input_latency = input_latency
+        self.output_latency = output_latency
+        self.samp_freq = samp_freq
+
+    def offset(self):
+        """Frames between a sample entering the device and the output sample played in the same callback """
+        return self.input_latency + self.frames_per_buffer + self.output_latency
+
+    def run(self, callback, signal, realtime=False):
+        """Feeds signal (frames,) or (frames, channels) through callback --> output on the input's timeline,
+        i.e. already delayed by offset(). realtime sleeps like a device clock instead of running flat out"""
+        block = self.frames_per_buffer
+        blocks = len(signal) // block
+        out = np.zeros((blocks * block + self.offset(),) + signal.shape[1:], dtype=np.float32)
+        signal = np.ascontiguousarray(signal, dtype=np.float32)
+        period = block / self.samp_freq
+        start = time.perf_counter()
+        for n in range(blocks):
+            data, _ = callback(signal[n*block:(n+1)*block].tobytes(), block, {}, 0)
+            played = self.offset() + n*block
+            out[played:played + block] = np.frombuffer(data, dtype=np.float32).reshape((block,) + signal.shape[1:])
+            if realtime:
+                time.sleep(max(0.0, start + (n + 1) * period - time.perf_counter()))
+        return out[:len(signal)]
+
+
+def delay(reference, recorded, max_lag, smooth=64):
+    """Lag in frames that best aligns recorded with reference --> peak of the cross-correlation of their smoothed
+    energy envelopes over [0, max_lag], which holds for shifted output too, unlike the waveforms' own"""
+    kernel = np.ones(smooth) / smooth
+    envelopes = [np.convolve(np.abs(x.reshape(len(x), -1)[:, 0]), kernel, 'same') for x in (reference, recorded)]
+    n = 1 << int(np.ceil(np.log2(2 * len(reference))))
+    xcorr = np.fft.irfft(np.fft.rfft(envelopes[1], n) * np.conj(np.fft.rfft(envelopes[0], n)), n)
+    return int(np.argmax(xcorr[:max_lag + 1]))
+
+
+def loopback(grain_len=1024, stride=256, samp_freq=44100, shift_factor=1.0, phase_mode='array', channels=1,
+             seconds=2.0, realtime=False, algorithm='vocoder'):
+    """Plays a noise burst through a live PitchShifter on the null device --> measured end-to-end delay next to
+    what getLatency predicts for it, plus the callback's cost against its one-stride budget"""
+    shifter = PitchShifter(LiveSource(samp_freq, channels), shift_factor, phase_mode, grain_len=grain_len, stride=stride,
+                           output=False, algorithm=algorithm)
+    device = NullDevice(stride, channels, samp_freq=samp_freq)
+    signal = np.zeros(int(seconds * samp_freq), dtype=np.float32)
+    burst = synthesize('noise', samp_freq, 0.05)
+    signal[len(signal) // 4:len(signal) // 4 + len(burst)] = burst
+    if channels > 1:
+        signal = np.repeat(signal[:, None], channels, axis=1)
+    recorded = device.run(shifter.callback, signal, realtime)
+    latency = shifter.getLatency()
+    measured = delay(signal, recorded, 4 * grain_len)
+    stats = shifter.getStats()
+    record = {'grain_len': grain_len, 'stride': stride, 'samp_freq': samp_freq, 'shift_factor': shift_factor,
+              'algorithm': algorithm, 'phase_mode': shifter.getPhaseMode(), 'channels': channels,
+              'measured_ms': measured * 1e3 / samp_freq, 'expected_ms': latency['total_ms'],
+              'algorithmic_ms': latency['algorithmic_ms'], 'buffer_ms': latency['buffer_ms'],
+              'callback_p99_ms': stats['stages']['callback']['p99_ms'], 'budget_ms': stats['budget_ms'],
+              'overruns': stats['overruns']}
+    shifter.close()
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pitch-shift a microphone or line-in live, or measure the delay of doing so')
+    parser.add_argument('-s', '--semitones', type=float, default=0.0)
+    parser.add_argument('--grain', type=int, help='grain length in samples, 1024 by default')
+    parser.add_argument('--stride', type=int, help='hop, also the device buffer size, grain/4 by default')
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--mode', default='array', help="phase engine, see utils.ENGINES, or 'auto'")
+    parser.add_argument('--algorithm', default='vocoder', choices=('vocoder', 'wsola'))
+    parser.add_argument('--loopback', action='store_true', help='measure end-to-end delay on a null device instead')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    shift_factor = 2**(args.semitones/12)
+    grain_len = args.grain or 1024
+    stride = args.stride or grain_len // 4
+    if args.loopback:
+        configs = CONFIGS if args.grain is None and args.stride is None else ((grain_len, stride),)
+        for grain_len, stride in configs:
+            print(json.dumps(loopback(grain_len, stride, args.rate, shift_factor, args.mode, args.channels,
+                                      algorithm=args.algorithm)))
+        return
+    shifter = PitchShifter(LiveSource(args.rate, args.channels), shift_factor, args.mode, grain_len=grain_len,
+                           stride=stride, algorithm=args.algorithm)
+    print(json.dumps(shifter.getLatency()))
+    shifter.play()
+    try:
+        while shifter.stream.is_active():
+            time.sleep(5)
+            stats = shifter.getStats()
+            print(json.dumps({k: stats[k] for k in ('overruns', 'input_overflows', 'output_underflows')}))
+    except KeyboardInterrupt:
+        pass
+    shifter.close()
+
+
+if __name__ == '__main__':
+    main()
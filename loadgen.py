@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+from server import AUDIO, EVENT, read_frame
+
+
+async def connect(address):
+    """address: (host, port) or a Unix socket path """
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+async def send(writer, **msg):
+    writer.write((json.dumps(msg) + '\n').encode())
+    await writer.drain()
+
+
+async def listen(address, song='sine', seconds=10.0, shift=2**(4/12), lead=0.5, phase_mode='array', algorithm='vocoder'):
+    """One realtime listener --> plays `seconds` of song from a `lead` second buffer, counting stalls.
+    A stall is a chunk that arrived after the listener's clock had already reached it."""
+    reader, writer = await connect(address)
+    await send(writer, op='open', path=song, shift=shift, phase_mode=phase_mode, algorithm=algorithm, seconds=seconds + 1,
+               realtime=True)
+    kind, payload = await read_frame(reader)
+    info = json.loads(payload)
+    if info['event'] != 'open':
+        raise RuntimeError(info.get('message', info))
+    bytes_per_second = 4 * info['samp_freq'] * info['channels']
+    received = 0.0
+    stalls = 0
+    start = None
+    while received < seconds:
+        kind, payload = await read_frame(reader)
+        if kind is None or (kind == EVENT and json.loads(payload)['event'] == 'end'):
+            break
+        if kind != AUDIO:
+            continue
+        now = time.perf_counter()
+        if start is None:
+            start = now
+        elif now > start + lead + received:
+            stalls += 1
+            start = now - lead - received #listener re-buffers
+        received += len(payload) / bytes_per_second
+    await send(writer, op='stats')
+    while True:
+        kind, payload = await read_frame(reader)
+        if kind is None or (kind == EVENT and json.loads(payload)['event'] == 'stats'):
+            break
+    stats = json.loads(payload) if kind is not None else {}
+    await send(writer, op='close')
+    writer.close()
+    return {'received_s': received, 'stalls': stalls, 'late_chunks': stats.get('late_chunks'),
+            'job_p99_ms': stats.get('jobs', {}).get('stages', {}).get('callback', {}).get('p99_ms')}
+
+
+async def level(address, sessions, **kwargs):
+    """`sessions` listeners at once --> one flat record for the level"""
+    start = time.perf_counter()
+    results = await asyncio.gather(*(listen(address, **kwargs) for _ in range(sessions)))
+    stalled = sum(r['stalls'] > 0 for r in results)
+    p99 = [r['job_p99_ms'] for r in results if r['job_p99_ms'] is not None]
+    return {'sessions': sessions, 'stalled_sessions': stalled, 'stalls': sum(r['stalls'] for r in results),
+            'late_chunks': sum(r['late_chunks'] or 0 for r in results), 'worst_job_p99_ms': max(p99, default=None),
+            'wall_s': time.perf_counter() - start}
+
+
+async def ramp(address, levels, tolerance=0, log=print, **kwargs):
+    """Runs increasing session counts until more than `tolerance` sessions stall --> highest count that kept up"""
+    sustained = 0
+    for sessions in levels:
+        record = await level(address, sessions, **kwargs)
+        log(json.dumps(record))
+        if record['stalled_sessions'] > tolerance:
+            break
+        sustained = sessions
+    return sustained
+
+
+def wait_for_server(address, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+            with socket.socket(family) as s:
+                s.connect(address)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'no server at {address}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find how many realtime pitch-shift sessions one server sustains')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='connect to this Unix socket instead of TCP')
+    parser.add_argument('--spawn', action='store_true', help='start server.py as a subprocess for the run')
+    parser.add_argument('--workers', type=int, help='--workers of the spawned server')
+    parser.add_argument('--levels', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32, 64], help='session counts to try, in order')
+    parser.add_argument('--song', default='sine', help="'sine', 'chirp', 'noise' or a path the server can read")
+    parser.add_argument('--seconds', type=float, default=10.0, help='audio each listener plays')
+    parser.add_argument('--shift', type=float, default=2**(4/12))
+    parser.add_argument('--lead', type=float, default=0.5, help="listener buffer, keep it equal to the server's --lead")
+    parser.add_argument('--mode', default='array', help='phase mode of the sessions')
+    parser.add_argument('--algorithm', default='vocoder', choices=('vocoder', 'wsola'), help='pitch-shift algorithm of the sessions')
+    parser.add_argument('--tolerance', type=int, default=0, help='stalled sessions allowed per level')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    address = args.unix or (args.host, args.port)
+    server = None
+    if args.spawn:
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'), '--lead', str(args.lead)]
+        cmd += ['--unix', args.unix] if args.unix else ['--host', args.host, '--port', str(args.port)]
+        cmd += ['--workers', str(args.workers)] if args.workers else []
+        server = subprocess.Popen(cmd)
+        wait_for_server(address)
+    try:
+        sustained = asyncio.run(ramp(address, args.levels, args.tolerance, song=args.song, seconds=args.seconds,
+                                     shift=args.shift, lead=args.lead, phase_mode=args.mode,
+                                     algorithm=args.algorithm))
+        print(json.dumps({'sustained_sessions': sustained}))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
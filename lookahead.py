@@ -0,0 +1,101 @@
+import threading
+import time
+import numpy as np
+from sink import paContinue, paComplete
+
+
+class BlockRing:
+    """Single-producer single-consumer ring of preallocated output blocks.
+    head is only advanced by the producer and tail only by the consumer, so no lock is needed:
+    a slot is filled before head moves past it and read before tail moves past it."""
+    def __init__(self, depth, block_shape):
+        self.depth = depth
+        self.blocks = np.zeros((depth,) + block_shape, dtype=np.float32)
+        self.positions = np.zeros(depth, dtype=np.int64)    #hop count each block plays at
+        self.generations = np.zeros(depth, dtype=np.int64)  #seek generation it was produced in
+        self.head = 0
+        self.tail = 0
+
+    def queued(self):
+        return self.head - self.tail
+
+
+class LookaheadWorker:
+    """Runs PitchShifter hops on a producer thread, `depth` hops ahead of playback.
+    The PortAudio callback only copies finished blocks out of the ring. Pitch changes splice in:
+    queued blocks still play, the producer just continues at the new pitch. Seeks (any outside change
+    of shifter.count) flush: the producer restarts at the new position, priming the overlap-add,
+    and stale blocks are skipped."""
+    def __init__(self, shifter, depth=8):
+        self.shifter = shifter
+        self.depth = depth
+        self.ring = BlockRing(depth, shifter.output_buffer.shape)
+        self.silence = np.zeros_like(shifter.output_buffer).tobytes()
+        self.hop_time = shifter.STRIDE / shifter.samp_freq
+        self.next = shifter.count   #next hop the producer renders
+        self.played = shifter.count #consumer's own copy of count, a mismatch means someone seeked
+        self.seek_to = None
+        self.generation = 0
+        self.eof_at = None          #(generation, hop) where the song ran out
+        self.underruns = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Producer loop --> keeps the ring full, restarts on seeks reported by the consumer"""
+        sh, ring = self.shifter, self.ring
+        while not self.closed:
+            if self.seek_to is not None:
+                target, self.seek_to = self.seek_to, None
+                self.restart(target)
+                continue
+            if ring.queued() >= self.depth or self.eof_at is not None:
+                time.sleep(self.hop_time / 4)
+                continue
+            if not sh.hop(self.next):
+                self.eof_at = (self.generation, self.next)
+                continue
+            slot = ring.head % self.depth
+            ring.blocks[slot] = sh.output_buffer
+            ring.positions[slot] = self.next
+            ring.generations[slot] = self.generation
+            ring.head += 1 #publish
+            self.next += 1
+
+    def restart(self, count):
+        """Flushes after a seek --> clears the overlap-add state and primes it with the hops before count"""
+        sh = self.shifter
+        self.generation += 1
+        self.eof_at = None
+        sh.x_prev[:] = 0
+        sh.prev_grain[:] = 0
+        if sh.wsola is not None:
+            sh.wsola.reset()
+        for c in range(max(0, count - sh.GRAIN_LEN_SAMP // sh.STRIDE + 1), count):
+            sh.hop(c)
+        self.next = count
+
+    def callback(self, in_data, frame_count):
+        """Consumer side, runs on the PortAudio thread --> copy out or count an underrun, never process"""
+        sh, ring = self.shifter, self.ring
+        if sh.count != self.played:
+            self.played = self.seek_to = sh.count
+        while ring.queued() > 0:
+            slot = ring.tail % self.depth
+            if ring.generations[slot] == self.generation and ring.positions[slot] == sh.count:
+                ret_data = ring.blocks[slot].tobytes()
+                ring.tail += 1
+                sh.count += 1
+                self.played = sh.count
+                return (ret_data, paContinue)
+            ring.tail += 1 #stale block from before a seek
+        if self.eof_at == (self.generation, sh.count):
+            sh.Finish = True
+            return (in_data, paComplete)
+        self.underruns += 1
+        return (self.silence, paContinue)
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from utils import build_dft_rescale_lookup, make_vocoder
+from source import decode
+import soundfile as sf
+
+WARMUP_HOPS = 16          #hops a segment's vocoder runs before its first one, see OfflineShifter.render_parallel
+BLEND_HOPS = 32           #frames over which a segment's phases glide from the previous segment's into its own
+SEAM_THRESHOLD_DB = 1.0   #largest excess of seam_artifact_db over the background a parallel render may show, see check_seams
+
+
+class OfflineShifter:
+    def __init__(self, input_wav, samp_freq=None, grain_len=4096, stride=1024, phase_mode='array', batch_hops=512,
+                 analysis=None):
+        """Whole-file counterpart of PitchShifter --> same grains, lookup and vocoder but no audio device.
+        input_wav: Path to a song, or an already decoded mono signal (then samp_freq is required)
+        analysis: Optional analysis.AnalysisCache for a path --> frames gather the stored spectra instead of running
+        the forward FFTs, analysed and stored here first on a miss"""
+        if isinstance(input_wav, str):
+            self.signal, self.samp_freq = decode(input_wav, mono=True)
+        else:
+            assert samp_freq is not None, "Sample rate required for a decoded signal"
+            self.signal, self.samp_freq = np.asarray(input_wav, dtype=np.float32), samp_freq
+        assert self.signal.ndim == 1, "Offline rendering is mono only"
+        assert grain_len % stride == 0, "Grain length must be a multiple of the stride"
+        self.GRAIN_LEN_SAMP = grain_len
+        self.STRIDE = stride
+        self.OVERLAP_LEN = self.GRAIN_LEN_SAMP-self.STRIDE
+        self.N_BINS = self.GRAIN_LEN_SAMP// 2 + 1
+        self.N_PARTS = self.GRAIN_LEN_SAMP // self.STRIDE
+        self.N_HOPS = len(self.signal) // self.STRIDE #PitchShifter.callback stops on the first short buffer
+        self.DURATION = round( len(self.signal) / self.samp_freq , 3)
+        self.WIN = np.hanning(self.GRAIN_LEN_SAMP)
+        self.phase_mode = phase_mode
+        self.batch_hops = batch_hops
+        self.spectra = None #(2, N_HOPS, N_BINS) magnitudes and phases, see analysis.analyze
+        if analysis is not None and isinstance(input_wav, str):
+            self.spectra = analysis.load(input_wav, True, grain_len, stride, self.signal)
+
+    def padded(self, out=None):
+        """The signal behind OVERLAP_LEN zeros, what grains slides over --> into out, e.g. shared memory, if given"""
+        if out is None:
+            out = np.zeros(self.OVERLAP_LEN + self.N_HOPS*self.STRIDE, dtype=np.float32)
+        out[:self.OVERLAP_LEN] = 0
+        out[self.OVERLAP_LEN:] = self.signal[:self.N_HOPS*self.STRIDE]
+        return out
+
+    def grains(self, padded=None):
+        """Every hop's grain as rows of one zero-copy 2-D view --> row n is input_concat of hop n"""
+        padded = self.padded() if padded is None else padded
+        return sliding_window_view(padded, self.GRAIN_LEN_SAMP)[::self.STRIDE]
+
+    def lookup(self, shift_factor):
+        """Destination bin of every source bin below max_bin --> (dest, max_bin) for frames"""
+        shift_idx, max_bin = build_dft_rescale_lookup(self.N_BINS, shift_factor)
+        max_bin = min(max_bin, self.N_BINS)
+        return shift_idx[:max_bin], max_bin
+
+    def frames(self, grains, start, stop, lookup, phase_vocoder):
+        """Rescaled and phase-propagated spectra of hops start..stop-1 --> (stop - start, N_BINS), the vocoder
+        must have seen hop start-1 last (or nothing, at the start of the song)"""
+        if self.spectra is not None:
+            return self.gathered(start, stop, lookup, phase_vocoder)
+        dest, max_bin = lookup
+        X = np.fft.rfft(grains[start:stop] * self.WIN, axis=1)
+        Y = np.zeros_like(X)
+        Y[:, dest] = X[:, :max_bin] #same last-write-wins as dft_rescale when bins collide
+        for i in range(len(Y)): #only the phase propagation depends on the previous hop
+            phase_vocoder.calc_phase(Y[i], out=Y[i])
+        return Y
+
+    def gathered(self, start, stop, lookup, phase_vocoder):
+        """frames from the cached analysis --> each hop's magnitudes and phases go to their destination bins by one
+        gather, as in harmonizer.Harmonizer, with the zero bin past the end where no source bin lands"""
+        dest, max_bin = lookup
+        src = np.full(self.N_BINS, self.N_BINS, dtype=np.intp)
+        src[dest] = np.arange(max_bin) #same last-write-wins as dft_rescale when bins collide
+        magn = np.zeros((stop - start, self.N_BINS + 1))
+        phase = np.zeros((stop - start, self.N_BINS + 1))
+        magn[:, :-1], phase[:, :-1] = self.spectra[0, start:stop], self.spectra[1, start:stop]
+        Y = np.zeros((stop - start, self.N_BINS), dtype=complex)
+        for i in range(len(Y)):
+            np.take(magn[i], src, out=phase_vocoder.current_magn)
+            np.take(phase[i], src, out=phase_vocoder.current_phase)
+            phase_vocoder.propagate(out=Y[i])
+        return Y
+
+    def overlap_add(self, Y, output, hop):
+        """Synthesises frames Y and adds them to output from its hop number `hop` on --> each frame's grain runs
+        N_PARTS hops, so output needs len(Y) + N_PARTS - 1 strides from there"""
+        n_parts, S = self.N_PARTS, self.STRIDE
+        out = np.fft.irfft(Y, n=self.GRAIN_LEN_SAMP, axis=1)
+        out *= self.WIN
+        #Overlap-add: part q of grain n lands on hop n+q, so add each part as one contiguous slab
+        out = out.reshape(len(Y), n_parts, S)
+        for q in range(n_parts):
+            output[(hop+q)*S:(hop+len(Y)+q)*S] += out[:, q].ravel()
+
+    def render_into(self, grains, first, last, lookup, phase_vocoder, output):
+        """Hops first..last-1 overlap-added into output, whose sample 0 is the start of hop `first`, in batches"""
+        for start in range(first, last, self.batch_hops):
+            stop = min(start + self.batch_hops, last)
+            self.overlap_add(self.frames(grains, start, stop, lookup, phase_vocoder), output, start - first)
+        return output
+
+    def render(self, shift_factor):
+        """Returns the whole song shifted by shift_factor --> sample for sample what the callback plays with
+        PitchShifter(dtype=np.float64). The default float32 callback drifts from it within the tolerance given for
+        PitchShifter's dtype, i.e. similar magnitude spectra but not the same samples"""
+        output = np.zeros((self.N_HOPS + self.N_PARTS) * self.STRIDE)
+        phase_vocoder = make_vocoder(self.phase_mode, self.GRAIN_LEN_SAMP, shift_factor)
+        self.render_into(self.grains(), 0, self.N_HOPS, self.lookup(shift_factor), phase_vocoder, output)
+        return output[:self.N_HOPS*self.STRIDE].astype(np.float32)
+
+    def seams(self, segments, search=1.0, blend=BLEND_HOPS):
+        """Hops splitting the song into `segments` about equal parts --> each within search seconds of its even
+        split point, where the N_PARTS - 1 hops before it are quietest: the previous segment's last grains overlap
+        the blend there, so the less they carry the less any mismatch is heard. Segments stay over blend hops long"""
+        span = max(1, int(search * self.samp_freq / self.STRIDE))
+        lead = self.N_PARTS - 1
+        hops = self.signal[:self.N_HOPS*self.STRIDE].reshape(self.N_HOPS, self.STRIDE)
+        seams = []
+        for k in range(1, segments):
+            nominal = k * self.N_HOPS // segments
+            lo = max(nominal - span, lead, seams[-1] + blend + 1 if seams else blend + 1)
+            hi = min(nominal + span + 1, self.N_HOPS - blend)
+            if lo >= hi:
+                continue
+            energy = np.einsum('ij,ij->i', hops[lo-lead:hi-1], hops[lo-lead:hi-1], dtype=np.float64)
+            before = np.convolve(energy, np.ones(lead), 'valid') #energy of hops seam-lead..seam-1, seam = lo..hi-1
+            seams.append(lo + int(np.argmin(before)))
+        return seams
+
+    def render_parallel(self, shift_factor, workers=None, seams=None, warmup=WARMUP_HOPS, blend=BLEND_HOPS):
+        """render split at seams (by default one segment per worker, see seams) and spread over a process pool.
+        The padded signal and everything workers produce live in shared memory, they only receive names and hop
+        ranges. A segment's vocoder starts warmup hops early, so its magnitudes and phase derivatives are settled
+        by the seam, but its phases still differ from the previous segment's by some angle per bin. Its first
+        blend frames are therefore kept as spectra, and once both sides are done they are rotated by that angle,
+        fully at the seam and less each frame after --> the segment picks up where the previous one left off and
+        glides into its own phases, a drift of at most pi over blend hops, instead of jumping"""
+        workers = workers or os.cpu_count()
+        seams = self.seams(workers, blend=blend) if seams is None else list(seams)
+        bounds = [0] + seams + [self.N_HOPS]
+        assert all(b - a > blend for a, b in zip(bounds[1:], bounds[2:])), "Segments after the first must be longer than blend"
+        n_segments, tail = len(bounds) - 1, (self.N_PARTS - 1) * self.STRIDE
+        #segment k's slab, hop bounds[k] on, starts k tails after its place in the song
+        offsets = [bounds[k] * self.STRIDE + k * tail for k in range(n_segments + 1)]
+        shapes = {'signal': ((self.OVERLAP_LEN + self.N_HOPS*self.STRIDE,), np.float32),
+                  'slabs': ((offsets[-1],), np.float64),
+                  'phases': ((n_segments, 2, self.N_BINS), np.float64),   #accum_phase before the first and after the last hop
+                  'spectra': ((n_segments, blend, self.N_BINS), np.complex128)}
+        blocks = {name: SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+                  for name, (shape, dtype) in shapes.items()}
+        try:
+            arrays = {name: np.ndarray(shape, dtype, blocks[name].buf) for name, (shape, dtype) in shapes.items()}
+            self.padded(arrays['signal'])
+            arrays['slabs'].fill(0)
+            layout = {name: (blocks[name].name, shape, np.dtype(dtype).str) for name, (shape, dtype) in shapes.items()}
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                jobs = [pool.submit(render_segment, layout, self.samp_freq, self.GRAIN_LEN_SAMP, self.STRIDE, self.phase_mode,
+                                    self.batch_hops, shift_factor, k, bounds[k], bounds[k+1], offsets[k], warmup, blend,
+                                    None if self.spectra is None else self.spectra.filename)
+                        for k in range(n_segments)]
+                for job in jobs:
+                    job.result()
+            output = np.zeros((self.N_HOPS + self.N_PARTS) * self.STRIDE)
+            slabs, phases, spectra = arrays['slabs'], arrays['phases'], arrays['spectra']
+            for k in range(n_segments):
+                slab = slabs[offsets[k]:offsets[k+1]]
+                output[bounds[k]*self.STRIDE:bounds[k]*self.STRIDE + len(slab)] += slab
+                if k:
+                    mismatch = np.angle(np.exp(1j * (phases[k-1, 1] - phases[k, 0]))) #shortest way round, see render_parallel
+                    fade = 1 - np.arange(1, blend + 1) / (blend + 1)
+                    self.overlap_add(spectra[k] * np.exp(1j * fade[:, None] * mismatch), output, bounds[k])
+            del arrays, slabs, phases, spectra
+            return output[:self.N_HOPS*self.STRIDE].astype(np.float32)
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+
+
+def render_segment(layout, samp_freq, grain_len, stride, phase_mode, batch_hops, shift_factor, k, first, last, offset,
+                   warmup, blend, spectra_path=None):
+    """Worker job --> renders segment k, hops first..last-1, of the padded signal in shared memory into its slab.
+    Past the first segment the vocoder warms up from first - warmup, and hops first..first+blend-1 go to the
+    segment's spectra instead of the slab, see OfflineShifter.render_parallel.
+    spectra_path: The song's cached analysis, memory-mapped here so every worker shares the one on disk"""
+    blocks = {name: SharedMemory(name=block) for name, (block, _, _) in layout.items()}
+    try:
+        arrays = {name: np.ndarray(shape, dtype, blocks[name].buf) for name, (_, shape, dtype) in layout.items()}
+        padded = arrays['signal']
+        shifter = OfflineShifter(padded[grain_len - stride:], samp_freq, grain_len, stride, phase_mode, batch_hops)
+        if spectra_path is not None:
+            shifter.spectra = np.load(spectra_path, mmap_mode='r')
+        grains, lookup = shifter.grains(padded), shifter.lookup(shift_factor)
+        phase_vocoder = make_vocoder(phase_mode, grain_len, shift_factor)
+        slab = arrays['slabs'][offset:offset + (last - first + shifter.N_PARTS - 1) * stride]
+        start = first
+        if first:
+            for hop in range(max(first - warmup, 0), first, batch_hops):
+                shifter.frames(grains, hop, min(hop + batch_hops, first), lookup, phase_vocoder)
+            arrays['phases'][k, 0] = phase_vocoder.accum_phase
+            start = first + blend
+            arrays['spectra'][k] = shifter.frames(grains, first, start, lookup, phase_vocoder)
+        shifter.render_into(grains, start, last, lookup, phase_vocoder, slab[(start - first) * stride:])
+        arrays['phases'][k, 1] = phase_vocoder.accum_phase
+        del arrays, padded, shifter, grains, slab
+    finally:
+        for block in blocks.values():
+            block.close()
+    return last - first
+
+
+def seam_artifact_db(output, reference, seams, grain_len=4096, stride=1024):
+    """Level deviation from a reference around the seams --> short-time energy over stride-long frames, stride/4
+    apart and two grains either side of a seam, as |dB| against the reference's; the worst frame per seam,
+    averaged over seams. A seam is heard as a dip where grains overlap out of step, or as a click. Waveforms are no
+    measure, a vocoder's absolute phases are arbitrary and two renders drift apart in them without being heard"""
+    deviations = []
+    for seam in seams:
+        lo = max(seam * stride - 2*grain_len, 0)
+        hi = min(seam * stride + 2*grain_len, len(output), len(reference))
+        if hi - lo < stride:
+            continue
+        levels = [10 * np.log10(np.mean(sliding_window_view(np.asarray(x[lo:hi], np.float64), stride)[::stride // 4]**2,
+                                        axis=1) + 1e-10) for x in (output, reference)]
+        deviations.append(float(np.max(np.abs(levels[0] - levels[1]))))
+    return float(np.mean(deviations)) if deviations else 0.0
+
+
+def check_seams(shifter, shift_factor, workers=None, threshold=SEAM_THRESHOLD_DB, controls=8, blend=BLEND_HOPS):
+    """Parallel render against the serial one --> record with seam_artifact_db at the seams and, as background, at
+    `controls` hops spread over each segment clear of its seams: with phases of their own the two renders differ in
+    level a little everywhere, what counts is how much more they do at the seam. Passes when that excess stays
+    under threshold. blend=0 renders without phase alignment, which tonal input fails by well over the threshold"""
+    seams = shifter.seams(workers or os.cpu_count())
+    output = shifter.render_parallel(shift_factor, workers, seams, blend=blend)
+    reference = shifter.render(shift_factor)
+    g, S = shifter.GRAIN_LEN_SAMP, shifter.STRIDE
+    bounds, margin = [0] + seams + [shifter.N_HOPS], 2 * g // S + BLEND_HOPS
+    background = [int(hop) for a, b in zip(bounds, bounds[1:]) if b - a > 2 * margin
+                  for hop in np.linspace(a + margin, b - margin, controls)]
+    artifacts = seam_artifact_db(output, reference, seams, g, S)
+    background = seam_artifact_db(output, reference, background, g, S)
+    return {'seams': seams, 'seam_artifact_db': artifacts, 'background_db': background, 'excess_db': artifacts - background,
+            'threshold_db': threshold, 'passed': artifacts - background < threshold}
+
+
+def scaling(shifter, shift_factor, worker_counts=(1, 2, 4, 8)):
+    """Wall time of render_parallel against the number of workers, next to the serial render --> list of flat dicts"""
+    start = time.perf_counter()
+    shifter.render(shift_factor)
+    serial = time.perf_counter() - start
+    records = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        shifter.render_parallel(shift_factor, workers)
+        wall = time.perf_counter() - start
+        records.append({'workers': workers, 'duration_s': shifter.DURATION, 'wall_s': wall, 'serial_s': serial,
+                        'speedup': serial / wall, 'efficiency': serial / wall / workers,
+                        'realtime_factor': shifter.DURATION / wall})
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render a pitch-shifted song offline, split over several processes')
+    parser.add_argument('song')
+    parser.add_argument('-s', '--semitones', type=float, default=0.0)
+    parser.add_argument('-o', '--out', default='shifted.wav')
+    parser.add_argument('-w', '--workers', type=int, help='processes and segments, one per core by default')
+    parser.add_argument('--grain', type=int, default=4096)
+    parser.add_argument('--stride', type=int, default=1024)
+    parser.add_argument('--mode', default='array', help='phase engine, see utils.ENGINES')
+    parser.add_argument('--check', action='store_true', help='compare the seams against a serial render, exit 1 past the threshold')
+    parser.add_argument('--threshold', type=float, default=SEAM_THRESHOLD_DB)
+    parser.add_argument('--scaling', nargs='*', type=int, help='report wall time for these worker counts instead')
+    parser.add_argument('--analysis', action='store_true', help='reuse the STFT analysis of earlier renders, see analysis.py')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    analysis = None
+    if args.analysis:
+        from analysis import AnalysisCache
+        analysis = AnalysisCache()
+    shifter = OfflineShifter(args.song, grain_len=args.grain, stride=args.stride, phase_mode=args.mode, analysis=analysis)
+    shift_factor = 2**(args.semitones/12)
+    if args.scaling is not None:
+        for record in scaling(shifter, shift_factor, args.scaling or (1, 2, 4, 8)):
+            print(json.dumps(record))
+        return 0
+    if args.check:
+        record = check_seams(shifter, shift_factor, args.workers, args.threshold)
+        print(json.dumps(record))
+        return 0 if record['passed'] else 1
+    start = time.perf_counter()
+    output = shifter.render_parallel(shift_factor, args.workers)
+    print(json.dumps({'duration_s': shifter.DURATION, 'wall_s': time.perf_counter() - start}))
+    sf.write(args.out, output, shifter.samp_freq)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
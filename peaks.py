@@ -0,0 +1,154 @@
+import io
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+#Frames per bin of the finest level, 5.8 ms at 44.1 kHz --> the deepest zoom a seek bar gets
+BASE_BLOCK = 256
+#Levels stop once one bin covers this many seconds or the song has fewer bins left
+COARSEST_S = 60.0
+
+
+class PeakIndex:
+    """Waveform overview of a song, mipmap style --> level 0 holds min, max and RMS of every BASE_BLOCK frames,
+    each further level merges pairs of bins of the one below, so any view of any width is drawn from the level with
+    the fewest bins still finer than a pixel, i.e. O(pixels) no matter how long the song or how far zoomed in.
+    Multichannel songs are indexed as one trace: min/max over all channels, RMS of their mean square"""
+    def __init__(self, samp_freq, frames, levels, block=BASE_BLOCK):
+        """levels: List of (mins, maxs, rms) float arrays, level n with bins of block * 2**n frames"""
+        self.samp_freq = samp_freq
+        self.frames = frames
+        self.block = block
+        self.levels = levels
+
+    @classmethod
+    def build(cls, signal, samp_freq, block=BASE_BLOCK):
+        """Indexes a decoded signal (frames,) or (frames, channels) --> one pass over the PCM, a memmap is fine"""
+        frames = len(signal)
+        bins = -(-frames // block)
+        mins = np.empty(bins, dtype=np.float32)
+        maxs = np.empty(bins, dtype=np.float32)
+        ms = np.empty(bins, dtype=np.float32)
+        chunk = block * 4096 #bounded scratch memory however long the song
+        for start in range(0, frames, chunk):
+            x = np.asarray(signal[start:start+chunk], dtype=np.float32)
+            x = x.reshape(len(x), -1)
+            n = -(-len(x) // block)
+            pad = np.zeros((n * block, x.shape[1]), dtype=np.float32)
+            pad[:len(x)] = x
+            bins_ = pad.reshape(n, -1)
+            b = start // block
+            ms[b:b+n] = (bins_ * bins_).sum(axis=1) / (np.minimum(block, len(x) - np.arange(n) * block) * x.shape[1])
+            pad[len(x):] = x[-1] #repeat the last frame so the tail bin's min/max are not pulled to 0
+            mins[b:b+n] = bins_.min(axis=1)
+            maxs[b:b+n] = bins_.max(axis=1)
+        levels = [(mins, maxs, ms)]
+        while len(mins) > 1 and block << (len(levels) - 1) < COARSEST_S * samp_freq:
+            if len(mins) % 2: #odd bin out merges with itself
+                mins, maxs, ms = (np.append(a, a[-1]) for a in (mins, maxs, ms))
+            mins = np.minimum(mins[0::2], mins[1::2])
+            maxs = np.maximum(maxs[0::2], maxs[1::2])
+            ms = (ms[0::2] + ms[1::2]) / 2
+            levels.append((mins, maxs, ms))
+        return cls(samp_freq, frames, [(lo, hi, np.sqrt(ms)) for lo, hi, ms in levels], block)
+
+    def duration(self):
+        return self.frames / self.samp_freq
+
+    def bin_frames(self, level):
+        return self.block << level
+
+    def level_for(self, frames_per_pixel):
+        """Coarsest level whose bins are no wider than a pixel --> at most two bins fold into each pixel"""
+        level = int(np.log2(max(frames_per_pixel / self.block, 1)))
+        return min(level, len(self.levels) - 1)
+
+    def overview(self, pixels, start=0.0, end=None):
+        """Waveform of [start, end) seconds drawn pixels wide --> (mins, maxs, rms) arrays of length pixels,
+        RMS per pixel being that of its bins. Pixels past the end of the song are 0"""
+        end = self.duration() if end is None else end
+        assert pixels > 0 and end > start, "Need a view of at least one pixel and some time"
+        frames_per_pixel = (end - start) * self.samp_freq / pixels
+        level = self.level_for(frames_per_pixel)
+        mins, maxs, rms = self.levels[level]
+        width = self.bin_frames(level)
+        #first bin of each pixel, every pixel gets at least one
+        edges = np.floor((start * self.samp_freq + np.arange(pixels + 1) * frames_per_pixel) / width).astype(np.int64)
+        first = edges[:-1]
+        count = np.maximum(edges[1:] - first, 1)
+        valid = (first >= 0) & (first < len(mins))
+        first = np.clip(first, 0, len(mins) - 1)
+        count = np.minimum(count, len(mins) - first)
+        out = np.zeros((3, pixels), dtype=np.float32)
+        #bins per pixel are 1 or 2 at this level, so gather the few columns instead of a reduceat over the range
+        for k in range(int(count.max())):
+            take = valid & (count > k)
+            idx = first[take] + k
+            if k == 0:
+                out[0, take], out[1, take], out[2, take] = mins[idx], maxs[idx], rms[idx] ** 2
+            else:
+                out[0, take] = np.minimum(out[0, take], mins[idx])
+                out[1, take] = np.maximum(out[1, take], maxs[idx])
+                out[2, take] += rms[idx] ** 2
+        out[2] = np.sqrt(out[2] / count)
+        return out[0], out[1], out[2]
+
+    def seek(self, x, pixels, start=0.0, end=None, stride=1):
+        """Seconds for a click at pixel x of a view like overview's --> snapped to the nearest multiple of stride
+        frames, plus half a frame so PitchShifter.setTime's floor lands on that hop and not the one before"""
+        end = self.duration() if end is None else end
+        seconds = start + (end - start) * min(max(x, 0), pixels) / pixels
+        hop = round(seconds * self.samp_freq / stride)
+        hop = min(hop, max(0, (self.frames - 1) // stride))
+        return (hop * stride + 0.5) / self.samp_freq
+
+    def tobytes(self):
+        """Serialized for a database blob --> float16 bins, plenty for pixels and half the size"""
+        arrays = {f'{name}{n}': a.astype(np.float16) for n, level in enumerate(self.levels)
+                  for name, a in zip(('min', 'max', 'rms'), level)}
+        f = io.BytesIO()
+        np.savez(f, header=np.array([self.samp_freq, self.frames, self.block, len(self.levels)], dtype=np.int64), **arrays)
+        return f.getvalue()
+
+    @classmethod
+    def frombytes(cls, data):
+        with np.load(io.BytesIO(data)) as f:
+            samp_freq, frames, block, n = (int(v) for v in f['header'])
+            levels = [tuple(f[f'{name}{k}'].astype(np.float32) for name in ('min', 'max', 'rms')) for k in range(n)]
+        return cls(samp_freq, frames, levels, block)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a song's waveform index and time views of it against scanning the PCM")
+    parser.add_argument('song')
+    parser.add_argument('-p', '--pixels', type=int, default=360)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    from source import decode
+    signal, samp_freq = decode(args.song, mono=False)
+    t = time.perf_counter()
+    index = PeakIndex.build(signal, samp_freq)
+    build = time.perf_counter() - t
+    blob = index.tobytes()
+    t = time.perf_counter()
+    PeakIndex.frombytes(blob)
+    load = time.perf_counter() - t
+    duration = index.duration()
+    for zoom in (1, 10, 100, 1000):
+        start = duration / 3
+        end = start + duration / zoom
+        t = time.perf_counter()
+        index.overview(args.pixels, start, end)
+        indexed = time.perf_counter() - t
+        t = time.perf_counter()
+        view = signal[int(start * samp_freq):int(end * samp_freq)]
+        [(c.min(), c.max(), np.sqrt(np.mean(c * c))) for c in np.array_split(view.reshape(len(view), -1), args.pixels)]
+        scanned = time.perf_counter() - t
+        print(json.dumps({'zoom': zoom, 'pixels': args.pixels, 'indexed_ms': indexed * 1e3, 'scanned_ms': scanned * 1e3,
+                          'build_ms': build * 1e3, 'load_ms': load * 1e3, 'levels': len(index.levels),
+                          'blob_bytes': len(blob)}))
+
+
+if __name__ == '__main__':
+    main()
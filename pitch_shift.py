@@ -1,69 +1,210 @@
-import pyaudio
 import numpy as np
-from utils import dft_rescale, build_dft_rescale_lookup, PhaseVocoder, PhaseVocoder2
-import librosa
+from utils import dft_rescale, build_dft_rescale_lookup, PhaseVocoder, FrameWorkspace, make_vocoder, switch_engine, choose_engine, ENGINES
+from source import open_source
+from lookahead import LookaheadWorker
+from telemetry import Telemetry, OVERLAP_ADD, HOP
+from governor import QualityGovernor
+from spectrum import SpectrumTap
+from wsola import WsolaShifter
+from sink import PyAudioSink, NullSink, WavSink, paContinue, paComplete
+import sys
+import json
 import time
+import argparse
+import threading
+from math import log2
 
 
 class PitchShifter:
-    def __init__(self, input_wav, shift_factor):
-        "Must re-initialize whenever loading a new song"
+    def __init__(self, input_wav, shift_factor, phase_mode='heap', streaming=False, cache=None, mono=True, lookahead=0,
+                 grain_len=4096, stride=1024, output=True, stats_log=None, dtype=np.float32, algorithm='vocoder',
+                 analysis=None):
+        """Must re-initialize whenever loading a new song
+        input_wav: Path to the song or a source (see source.py) --> streaming decodes in blocks instead of up front.
+        A source.LiveSource opens the stream duplex: callback feeds in_data to the source, hop() shifts it as usual.
+        For live input keep grain_len small, e.g. 1024/256 --> see getLatency
+        cache: Optional cache.DecodedCache so replaying a song skips the decode
+        mono: False keeps every channel --> all channels go through one batched FFT per hop
+        lookahead: Hops rendered ahead on a worker thread (see lookahead.py), 0 renders inside the PortAudio callback
+        grain_len, stride: Analysis window and hop in samples, grain_len a multiple of stride and at least twice it
+        output: True plays on the sound card, False opens no stream --> drive hop() yourself, e.g. for benchmarks.
+        Or a sink from sink.py, e.g. WavSink('out.flac') or NullSink() --> the same callback path, clocked by the sink
+        at full speed instead of by a device. The shifter closes its sink
+        stats_log: Optional path of a rotating log that getStats() snapshots are appended to
+        phase_mode: Engine name from utils.ENGINES, or 'auto' for the best tier whose measured cost fits half a hop
+        dtype: Precision of the per-hop DSP --> float32 never allocates in the hot path, float64 tracks offline renders closest.
+        Phase propagation amplifies rounding, so float32 output matches float64 to ~1e-8 for the first hops only, then
+        drifts to the same degree as a 1e-6 change of the input: magnitude spectra stay within ~4% (spectral convergence)
+        algorithm: 'vocoder' (dft_rescale and the phase vocoder) or 'wsola', the time-domain wsola.WsolaShifter -->
+        several times cheaper per hop and no FFT, at the cost of some roughness on dense mixes; phase_mode is then unused
+        and the spectrum tap publishes no magnitudes
+        analysis: Optional analysis.AnalysisCache --> on a hit every hop gathers the song's stored magnitudes and phases
+        instead of running window and forward FFT, on a miss it is filled in the background and used once stored.
+        Vocoder and songs from a file only. After a seek the first grains are then the song's own at the new position,
+        where the FFT path still overlaps audio from before the seek for a grain"""
         self.shift_factor = shift_factor
-        self.signal, self.samp_freq = librosa.load(input_wav, sr=None, mono=True)
+        self.source = input_wav if hasattr(input_wav, 'read') else open_source(input_wav, streaming, cache, mono)
+        self.samp_freq = self.source.samp_freq
+        self.CHANNELS = self.source.channels
+        self.live = getattr(self.source, 'live', False)
+        assert not (self.live and lookahead), "Live input is shifted inside the callback, lookahead would only add latency"
+        lead = () if self.source.mono else (self.CHANNELS,) #buffers are (channels, samples) when not mono
         #derived parameters
-        self.GRAIN_LEN_SAMP = 4096
-        self.STRIDE = 1024
+        assert grain_len % stride == 0 and grain_len >= 2*stride, "Grain length must be a multiple of at least twice the stride"
+        self.GRAIN_LEN_SAMP = grain_len
+        self.STRIDE = stride
         self.OVERLAP_LEN = self.GRAIN_LEN_SAMP-self.STRIDE
         self.N_BINS = self.GRAIN_LEN_SAMP// 2 + 1
-        self.DURATION = round( len(self.signal) / self.samp_freq , 3)
+        self.DURATION = round( self.source.frames / self.samp_freq , 3)
         self.input_buffer = np.zeros(self.STRIDE, dtype=np.float32)
-        self.output_buffer= np.zeros(self.STRIDE, dtype=np.float32)
+        self.output_buffer= np.zeros((self.STRIDE,) + lead, dtype=np.float32) #interleaved, as PyAudio wants it
+        self.output_view = self.output_buffer.T #(channels, STRIDE) view that writes straight into the interleaved buffer
         self.WIN = np.hanning(self.GRAIN_LEN_SAMP)
         self.SHIFT_IDX, self.MAX_BIN = build_dft_rescale_lookup(self.N_BINS, shift_factor)
-        self.x_prev = np.zeros(self.OVERLAP_LEN).astype(np.float32)
-        self.prev_grain = np.zeros(self.OVERLAP_LEN).astype(np.float32)
-        self.input_concat = np.zeros(self.GRAIN_LEN_SAMP).astype(np.float32)
-        self.grain = np.zeros(self.GRAIN_LEN_SAMP).astype(np.float32)
-        self.phase_vocoder = PhaseVocoder(self.GRAIN_LEN_SAMP, shift_factor)
+        self.x_prev = np.zeros(lead + (self.OVERLAP_LEN,)).astype(np.float32)
+        self.prev_grain = np.zeros(lead + (self.OVERLAP_LEN,)).astype(dtype)
+        self.input_concat = np.zeros(lead + (self.GRAIN_LEN_SAMP,)).astype(np.float32)
+        self.workspace = FrameWorkspace(self.GRAIN_LEN_SAMP, lead, dtype)
+        self.grain = self.workspace.grain
+        self.spectra = None         #cached analysis, (2, hops) + lead + (N_BINS,), see fill_analysis
+        self.frame = None           #this hop's row of it, None to run the FFT
+        #1-D row per channel for the overlap-add shifts --> overlapping 2-D copies would go through a temporary
+        self.rows = list(zip(*(a if lead else (a,) for a in (self.x_prev, self.prev_grain, self.grain))))
+        channels = lead[0] if lead else None
+        if phase_mode == 'auto':
+            phase_mode = choose_engine(0.5 * self.STRIDE / self.samp_freq, self.GRAIN_LEN_SAMP, channels, dtype)
+        self.phase_vocoder = make_vocoder(phase_mode, self.GRAIN_LEN_SAMP, shift_factor, channels=channels, dtype=dtype)
+        self.next_mode = None       #engine switch for the next hop, see setPhaseMode
         self.count=0
         self.pitchChanged = False
         self.Finish = False
-        self.p = pyaudio.PyAudio()
-        self.stream=self.p.open(format = pyaudio.paFloat32,
-                        channels=1,
-                        rate=self.samp_freq,
-                        output=True,
-                        frames_per_buffer=self.STRIDE,
-                        start=False,
-                        stream_callback=self.callback)
+        self.variants = None        #pre-rendered pitches, see enablePrerender
+        self.variant_now = None     #variant being played, None while processing live
+        self.fade_from = None
+        self.fade_left = self.fade_len = 0
+        self.fade_buffer = np.zeros(self.STRIDE, dtype=np.float32)
+        assert algorithm in ('vocoder', 'wsola'), f"Unknown algorithm {algorithm}"
+        self.wsola = WsolaShifter(self.STRIDE, shift_factor, channels, dtype=dtype) if algorithm == 'wsola' else None
+        self.governor = None        #adaptive quality, see enableGovernor
+        self.stats = Telemetry(self.STRIDE / self.samp_freq)
+        self.tap = SpectrumTap(self.N_BINS, self.output_buffer.shape) #for the GUI, see getAmpSpectrum
+        if stats_log is not None:
+            self.stats.start_logging(stats_log, self.getStats)
+        if analysis is not None and self.wsola is None and not self.live and getattr(self.source, 'path', None):
+            key = (self.source.path, self.source.mono, grain_len, stride)
+            if analysis.contains(*key):
+                self.spectra = analysis.load(*key)
+            else:
+                threading.Thread(target=self.fill_analysis, args=(analysis, key), daemon=True).start()
+        self.lookahead = LookaheadWorker(self, lookahead) if lookahead > 0 else None
+        self.sink = self.stream = None
+        if output is False or output is None:
+            return
+        self.sink = PyAudioSink() if output is True else output
+        self.stream = self.sink.open(self.callback, self.CHANNELS, self.samp_freq, self.STRIDE, input=self.live)
 
     def process(self, input_buffer, output_buffer, buffer_len):
-        """Called every stride/hop in the callback function """
-        self.input_concat[:self.OVERLAP_LEN], self.input_concat[self.OVERLAP_LEN:] = self.x_prev[:self.OVERLAP_LEN], input_buffer
-        self.grain, self.phase_vocoder = dft_rescale(self.input_concat*self.WIN, self.N_BINS, self.SHIFT_IDX, self.MAX_BIN, self.phase_vocoder)
-        self.grain*=self.WIN
-        #Overlap-add without loops due to latency constraints
+        """Called every stride/hop in the callback function --> every channel rides along the last axis"""
+        self.stats.start()
+        if self.wsola is not None:
+            self.wsola.process(input_buffer, self.output_view)
+            self.stats.mark(OVERLAP_ADD)
+            return
+        if self.frame is not None:
+            self.workspace.resynthesize(self.frame, self.SHIFT_IDX, self.MAX_BIN, self.phase_vocoder, self.stats)
+        else:
+            self.input_concat[..., :self.OVERLAP_LEN], self.input_concat[..., self.OVERLAP_LEN:] = self.x_prev[..., :self.OVERLAP_LEN], input_buffer.T
+            self.workspace.rescale(self.input_concat, self.SHIFT_IDX, self.MAX_BIN, self.phase_vocoder, self.stats)
+        self.grain*=self.workspace.window
+        #Overlap-add without loops due to latency constraints (bar the one over channels)
         update = self.OVERLAP_LEN - self.STRIDE
-        self.output_buffer[:self.STRIDE] = self.prev_grain[:self.STRIDE] + self.grain[:self.STRIDE]
-        self.x_prev[:update], self.x_prev[update:] =  self.x_prev[self.STRIDE:], input_buffer
-        self.prev_grain[:update], self.prev_grain[update:] = self.prev_grain[self.STRIDE:], self.grain[-self.STRIDE:]
-        self.prev_grain[:update] +=  self.grain[self.STRIDE:self.OVERLAP_LEN]
+        np.add(self.prev_grain[..., :self.STRIDE], self.grain[..., :self.STRIDE], out=self.output_view[..., :self.STRIDE])
+        for (x_prev, prev_grain, grain), samples in zip(self.rows, input_buffer.T if input_buffer.ndim > 1 else (input_buffer,)):
+            x_prev[:update], x_prev[update:] =  x_prev[self.STRIDE:], samples
+            prev_grain[:update], prev_grain[update:] = prev_grain[self.STRIDE:], grain[-self.STRIDE:]
+            prev_grain[:update] +=  grain[self.STRIDE:self.OVERLAP_LEN]
+        self.stats.mark(OVERLAP_ADD)
 
-    def callback(self, in_data, frame_count, time_info, status):
-        """Moves the audio forward using the count pointer --> Called when self.stream.is_active()"""
+    def play_variants(self, input_buffer, start_idx):
+        """Plays the pre-rendered pitch when it is ready, cross-fading whenever the audible source changes.
+        Fading back to live lasts a full grain so the restarted overlap-add has time to fill in."""
+        variant = self.variants.get(self.shift_factor)
+        if variant is not self.variant_now:
+            self.fade_from, self.variant_now = self.variant_now, variant
+            self.fade_len = self.fade_left = 1 if variant is not None else self.GRAIN_LEN_SAMP // self.STRIDE
+            if variant is None:
+                self.prev_grain[:] = 0
+                self.phase_vocoder = make_vocoder(self.phase_vocoder.mode, self.GRAIN_LEN_SAMP, self.shift_factor,
+                                                  threshold=self.phase_vocoder.threshold, dtype=self.phase_vocoder.dtype)
+                self.SHIFT_IDX, self.MAX_BIN = build_dft_rescale_lookup(self.N_BINS, self.shift_factor)
+        end_idx = start_idx + self.STRIDE
+        if self.variant_now is None or (self.fade_left and self.fade_from is None):
+            self.process(input_buffer, self.output_buffer, self.STRIDE)
+        else: #keep the input history current so live processing can take over at any hop
+            update = self.OVERLAP_LEN - self.STRIDE
+            self.x_prev[:update], self.x_prev[update:] = self.x_prev[self.STRIDE:], input_buffer
+        if not self.fade_left:
+            if self.variant_now is not None:
+                self.output_buffer[:] = self.variant_now[start_idx:end_idx]
+            return
+        outgoing = self.output_buffer if self.fade_from is None else self.fade_from[start_idx:end_idx]
+        incoming = self.output_buffer if self.variant_now is None else self.variant_now[start_idx:end_idx]
+        done = self.fade_len - self.fade_left
+        ramp = (np.arange(self.STRIDE) + done*self.STRIDE) / (self.fade_len*self.STRIDE)
+        self.fade_buffer[:] = outgoing + (incoming - outgoing) * ramp
+        self.output_buffer[:] = self.fade_buffer
+        self.fade_left -= 1
+
+    def hop(self, count):
+        """Renders hop number count into output_buffer --> False once the song runs out"""
+        start = time.perf_counter()
+        if self.next_mode is not None:
+            self.phase_vocoder = switch_engine(self.phase_vocoder, self.next_mode)
+            self.next_mode = None
         if self.pitchChanged:
             self.phase_vocoder.update(self.shift_factor)
             self.pitchChanged=False
             self.SHIFT_IDX, self.MAX_BIN = build_dft_rescale_lookup(self.N_BINS, self.shift_factor)
-        start_idx, end_idx = frame_count*self.count, frame_count*(self.count+1)
-        input_buffer = self.signal[start_idx:end_idx]
-        if len(input_buffer) < frame_count:
+            if self.wsola is not None:
+                self.wsola.update(self.shift_factor)
+        start_idx = self.STRIDE*count
+        input_buffer = self.source.read(start_idx, self.STRIDE)
+        if len(input_buffer) < self.STRIDE:
+            return False
+        spectra = self.spectra
+        self.frame = spectra[:, count] if spectra is not None and count < spectra.shape[1] else None
+        if self.variants is None:
+            self.process(input_buffer, self.output_buffer, self.STRIDE)
+        else:
+            self.play_variants(input_buffer, start_idx)
+        self.tap.publish(self.phase_vocoder.last_magnitudes, self.output_buffer)
+        elapsed = time.perf_counter() - start
+        self.stats.record(HOP, elapsed)
+        if self.governor is not None:
+            self.governor.observe(elapsed)
+        return True
+
+    def fill_analysis(self, analysis, key):
+        """Background thread on an analysis cache miss --> stores the song's analysis, hops gather it from then on"""
+        analysis.store_async(*key, source=self.source).join()
+        if analysis.contains(*key):
+            self.spectra = analysis.load(*key)
+
+    def callback(self, in_data, frame_count, time_info, status):
+        """Moves the audio forward using the count pointer --> Called when self.stream.is_active()"""
+        start = time.perf_counter()
+        if self.live:
+            self.source.push(in_data)
+        if self.lookahead is not None:
+            ret = self.lookahead.callback(in_data, frame_count)
+        elif not self.hop(self.count):
             self.Finish = True
-            return (in_data, pyaudio.paComplete)
-        self.process(input_buffer, self.output_buffer, self.STRIDE)
-        ret_data = self.output_buffer.tobytes()
-        self.count+=1
-        return (ret_data, pyaudio.paContinue)
+            ret = (in_data, paComplete)
+        else:
+            ret = (self.output_buffer.tobytes(), paContinue)
+            self.count+=1
+        self.stats.callback(status, frame_count, time.perf_counter() - start)
+        return ret
 
     def play(self):
         """Starts the stream"""
@@ -73,6 +214,18 @@ class PitchShifter:
         """Pauses the stream"""
         self.stream.stop_stream()
 
+    def close(self):
+        """Stops the stream and releases the device and decoder --> object is unusable afterwards"""
+        if self.lookahead is not None:
+            self.lookahead.close()
+        self.stats.stop_logging()
+        if self.stream is not None:
+            self.stream.close()
+            self.sink.close()
+        self.source.close()
+        if self.variants is not None:
+            self.variants.close()
+
     def getPitch(self):
         """Returns pitch scale ratio --> One semitone up is a multiplication by 2^(1/12) """
         return self.shift_factor
@@ -83,6 +236,64 @@ class PitchShifter:
         assert shift_factor > -3 and shift_factor <3, "Pitch must be bounded between 2 octaves"
         self.pitchChanged = True
         self.shift_factor = shift_factor
+        if self.variants is not None:
+            self.variants.recenter(shift_factor)
+
+    def enablePrerender(self, memory_budget=512<<20, workers=None):
+        """Opt-in: renders neighbouring semitones in the background so pitch moves become cross-fades.
+        Pitches that are not rendered yet keep being processed live"""
+        assert self.source.mono, "Pre-rendering is mono only"
+        assert not self.live, "Live input cannot be pre-rendered"
+        assert self.wsola is None, "Pre-rendering goes through the vocoder"
+        if self.variants is None:
+            from prerender import PitchVariants #process pool machinery, loaded on first use
+            self.variants = PitchVariants(self.source, self.shift_factor, self.GRAIN_LEN_SAMP, self.STRIDE,
+                                          self.phase_vocoder.mode, memory_budget=memory_budget, workers=workers)
+
+    def getPhaseMode(self):
+        """Returns phase integration engine of the vocoder --> a name from utils.ENGINES, e.g. 'array' or 'peak' """
+        return self.next_mode or self.phase_vocoder.mode
+
+    def setPhaseMode(self, phase_mode):
+        """Switches phase integration engine, takes effect on the next hop with the phases carried over """
+        assert phase_mode in ENGINES, f"Unknown phase mode {phase_mode}, choose from {tuple(ENGINES)}"
+        if self.phase_vocoder.mode != phase_mode or self.next_mode is not None:
+            self.next_mode = phase_mode
+
+    def enableGovernor(self, **kwargs):
+        """Opt-in: trades phase quality for speed whenever hops get close to their deadline, and back when idle.
+        kwargs go to governor.QualityGovernor (levels, low, high, patience, ...)"""
+        self.governor = QualityGovernor(self, **kwargs)
+
+    def getQuality(self):
+        """Returns the governor's level, mode, threshold, load and switch history --> None without a governor"""
+        return self.governor.state() if self.governor is not None else None
+
+    def getUnderruns(self):
+        """Returns callbacks that found no hop ready from the lookahead worker """
+        return self.lookahead.underruns if self.lookahead is not None else 0
+
+    def getStats(self):
+        """Returns a snapshot of the callback telemetry --> stage latencies, overruns, PortAudio xrun flags, underruns"""
+        stats = self.stats.snapshot()
+        stats.update({'lookahead_underruns': self.getUnderruns(), 'decoder_underruns': getattr(self.source, 'underruns', 0),
+                      'position_s': self.getTime(), 'finished': self.Finish})
+        return stats
+
+    def getLatency(self):
+        """Returns the input to output delay in ms --> algorithmic (a sample enters the output OVERLAP_LEN samples
+        later, with the grain that starts on it, or WsolaShifter.DELAY), buffering (live input waits for a full stride before its hop)
+        and the device's own input and output latency as PortAudio reports it, 0 without a stream"""
+        ms = 1e3 / self.samp_freq
+        latency = {'algorithmic_ms': (self.OVERLAP_LEN if self.wsola is None else self.wsola.DELAY) * ms, 'buffer_ms': self.STRIDE * ms if self.live else 0.0,
+                   'device_input_ms': 0.0, 'device_output_ms': 0.0}
+        if self.stream is not None:
+            latency['device_input_ms'] = self.stream.get_input_latency() * 1e3 if self.live else 0.0
+            latency['device_output_ms'] = self.stream.get_output_latency() * 1e3
+        latency['total_ms'] = sum(latency.values())
+        if self.lookahead is not None: #delays pitch changes and seeks, not the audio
+            latency['lookahead_ms'] = self.lookahead.depth * self.STRIDE * ms
+        return latency
 
     def getTime(self):
         """Returns position of song in seconds """
@@ -93,48 +304,86 @@ class PitchShifter:
         assert seconds >= 0 and seconds < self.DURATION, "Choose a valid duration within the boundaries of song"
         self.count = int( seconds * self.samp_freq / self.STRIDE )
 
+    def render(self, shift_factor):
+        """Renders the whole song at shift_factor without touching the stream --> see offline.OfflineShifter"""
+        from offline import OfflineShifter
+        offline = OfflineShifter(self.source.load(), self.samp_freq, self.GRAIN_LEN_SAMP, self.STRIDE, self.phase_vocoder.mode)
+        return offline.render(shift_factor)
+
     def getData(self):
-        """Returns raw wave data """
-        return self.output_buffer
+        """Returns raw wave data of the last hop --> copy of the tap's snapshot, safe to call from any thread"""
+        return self.tap.read()[2]
 
     def getAmpSpectrum(self):
-        """Returns amplitudes of real FFT """
-        return np.abs( np.fft.rfft(self.output_buffer) )
+        """Returns amplitudes of the last hop's shifted spectrum, N_BINS long and averaged over channels.
+        Published by the engine from the frame it already transformed --> no FFT on poll"""
+        return self.tap.read()[1]
 
-if __name__ == '__main__': #testing
-    input_wav = './songs/Red.mp3'
-    audio = PitchShifter(input_wav, 2**(0/12))
+def main(argv=None):
+    """Plays a song from the terminal, no GUI --> commands on stdin, one per line: + and - move a semitone, p pauses
+    or resumes, t prints the position, s SECONDS seeks, q quits. Without a terminal it plays to the end unattended,
+    into a file or a null sink with -o / --null, i.e. the real-time path at full speed"""
+    parser = argparse.ArgumentParser(description='Play a song pitch-shifted, controlled from stdin')
+    parser.add_argument('song')
+    parser.add_argument('-s', '--semitones', type=float, default=0.0)
+    parser.add_argument('-o', '--out', help='WAV/FLAC file to play into instead of the sound card')
+    parser.add_argument('--null', action='store_true', help='play into nothing instead of the sound card')
+    parser.add_argument('--speed', type=float, help='times real time with -o or --null, as fast as possible by default')
+    parser.add_argument('--mode', default='array', help="phase engine, see utils.ENGINES, or 'auto'")
+    parser.add_argument('--algorithm', default='vocoder', choices=('vocoder', 'wsola'))
+    parser.add_argument('--streaming', action='store_true', help='decode while playing instead of up front')
+    parser.add_argument('--lookahead', type=int, default=0, help='hops rendered ahead on a worker thread')
+    parser.add_argument('--analysis', action='store_true', help='reuse the STFT analysis of earlier plays, see analysis.py')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    output = WavSink(args.out, args.speed) if args.out else NullSink(args.speed) if args.null else True
+    analysis = None
+    if args.analysis:
+        from analysis import AnalysisCache
+        analysis = AnalysisCache()
+    audio = PitchShifter(args.song, 2**(args.semitones/12), args.mode, streaming=args.streaming, lookahead=args.lookahead,
+                         output=output, algorithm=args.algorithm, analysis=analysis)
+    state = {'paused': False, 'quit': False}
+
+    def status():
+        print(json.dumps({'position_s': round(audio.getTime(), 3), 'semitones': round(12*log2(audio.getPitch()), 3),
+                          'paused': state['paused'], 'finished': audio.Finish}), flush=True)
+
+    def commands():
+        for line in sys.stdin:
+            command, *arg = line.split() or ['']
+            if command == 'q':
+                break
+            try:
+                if command in ('+', '-'):
+                    audio.setPitch(audio.getPitch() * 2**((1 if command == '+' else -1)/12))
+                elif command == 'p':
+                    audio.play() if state['paused'] else audio.pause()
+                    state['paused'] = not state['paused']
+                elif command == 's' and arg:
+                    audio.setTime(min(max(float(arg[0]), 0), audio.DURATION - 1e-3))
+                elif command != 't':
+                    print(f'unknown command {line.strip()!r}, use + - p t s SECONDS q', file=sys.stderr)
+                    continue
+            except (AssertionError, ValueError) as e: #a bad number or a pitch out of range, keep reading
+                print(f'{line.strip()!r}: {e}', file=sys.stderr)
+                continue
+            status()
+        state['quit'] = True
+
+    if sys.stdin.isatty():
+        threading.Thread(target=commands, daemon=True).start()
     audio.play()
-    import readchar
-    from math import log2
-    while(True):
-        key = readchar.readkey()
-        if key == 'p':
-            audio.stream.stop_stream() if audio.stream.is_active() else audio.stream.start_stream()
-        elif key == '\x1b[C':       #Right arrow key -- increment current pitch by one semi-tone
-            audio.setPitch( audio.getPitch() * (2**(1/12) ))
-            print(int(log2(audio.getPitch())*12))
-        elif key == '\x1b[D':       #Left arrow key -- decrement current pitch by one semi-tone
-            audio.setPitch( audio.getPitch() * (2**(-1/12) ))
-            print(int(log2(audio.getPitch())*12))
-        elif key == 's':
-            audio.stream.stop_stream()
-            break
-        elif key == '\x1b[A':       #Up arrow key
-            audio.count+=45
-        elif key == '\x1b[B':       #Down arrow key
-            audio.count-=45
-        elif key == 't':
-            print(audio.getTime(), 'seconds')
-        elif key == '3':
-            audio.setTime(239)
-            print(audio.getTime(), 'set to 239 seconds')
-        elif key == 'f':
-            print(audio.didFinish())
-        elif key == 'l':
-            audio.pause()
-            audio = PitchShifter('Kanye.mp3', 2**(0/12))
-            audio.play()
+    try:
+        while not state['quit'] and (state['paused'] or audio.stream.is_active()):
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    status()
+    audio.close()
+
+
+if __name__ == '__main__':
+    main()
 
 """
 input_wav = './Red.mp3'
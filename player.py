@@ -1,22 +1,66 @@
 from tkinter import *
 import tkinter.ttk as ttk
 from tkinter import filedialog
+import os
 import database
+from cache import DecodedCache
 import time
-from pitch_shift import PitchShifter
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,
-NavigationToolbar2Tk)
-import matplotlib.animation as animation
-import matplotlib.pyplot as plt
-import numpy as np
-
-
-# App Database
-playlists_record = database.Database()
+from engine import AudioEngine
+from visualizer import SpectrumVisualizer
+
+
+# App Database, decoded songs (memory-mapped on replay) and the output stream --> see open_library
+playlists_record = decoded_cache = audio = None
+# Spectrum display, see open_visualizer
+visualizer = None
+# Waveform seek bar: the playing song's peaks.PeakIndex once built, the (start, end) seconds in view,
+# and the canvas items (peak lines, RMS lines, cursor) reused for every song
+waveform_index = waveform_view = waveform_items = None
+# Whether update still looks for the index --> until it is stored or its build has ended without one
+waveform_pending = False
+WAVEFORM_WIDTH, WAVEFORM_HEIGHT = 360, 48
 # Directory to get musics from
 songs_main_dir = '/Users/kennethtrinh/Desktop/pitchshift/songs'
+# Render neighbouring pitches in the background so the pitch slider cross-fades instead of re-processing
+prerender_pitches = False
+
+
+def setup_song(shifter):
+    if prerender_pitches: shifter.enablePrerender()
+    shifter.enableGovernor()
+
+def open_library():
+    """Opens the database, the song cache and the engine once the window is up --> the first frame never waits on them"""
+    global playlists_record, decoded_cache, audio
+    playlists_record = database.Database()
+    decoded_cache = DecodedCache()
+    # One output stream for the whole session, the next song is built in the background while the current one plays
+    audio = AudioEngine(setup=setup_song, phase_mode='array', streaming=True, cache=decoded_cache, lookahead=4)
+    display_songs()
+    root.after_idle(open_visualizer)
 
+def open_visualizer():
+    """Builds the spectrum plot --> matplotlib is imported here, once the songs are listed, as it takes seconds"""
+    global visualizer
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    fig = Figure(figsize = (5.5, 3.5),
+                     dpi = 100)
+    canvas = FigureCanvasTkAgg(fig, master = root)
+    canvas.get_tk_widget().place(relx=.5, rely=.5, anchor="center", x=-10, y=220)
+    # Blitted waveform + log spectrum fed by the engine's spectrum tap, 30 fps
+    visualizer = SpectrumVisualizer(canvas, fig, fps=30)
+    visualizer.start()
+
+
+def song_path(song):
+    """The song's file, whichever of database.AUDIO_EXTENSIONS it has --> the .mp3 path if none is there, which
+    the engine then reports and skips"""
+    directory = playlists_record.get_directory(song)
+    return playlists_record.find_file(song, directory) or f'{directory}{song}.mp3'
+
+def next_path(index):
+    return song_path(song_box.get((index + 1) % song_box.size()))
 
 
 def add_song():
@@ -26,6 +70,7 @@ def add_song():
     if song_box.size() == 0:
         loaded = False
         previous_pitch = 2**(0/12)
+    musics = []
     for song in songs:
         song_dir = song.split("/")
         song_dir.pop(len(song_dir)-1)
@@ -35,12 +80,29 @@ def add_song():
             song_file = song_file + "/" + elem
         song_file = song_file + "/"
         # Saving path of the .mp3 file in the path List
-        # Strip out the directory info and .mp3 extension from the song name
-        song = song.replace(song_file, "").replace(".mp3", "")
-        # Add song to list box
-        if playlists_record.add_to_music(song, song_file) == -1:
-            print('cannot add song, choose different name')
-            return
+        # Strip out the directory info and the extension (.mp3 or .wav) from the song name
+        musics.append((os.path.splitext(song.replace(song_file, ""))[0], song_file))
+    # One transaction for the whole selection, headers read on a thread pool
+    taken = playlists_record.add_musics(musics)
+    for song in taken:
+        print(f'cannot add {song}, choose different name')
+    for song, _ in musics:
+        if song not in taken:
+            song_box.insert(END, song)
+
+
+def add_folder():
+    global song_box, loaded, previous_pitch
+    directory = filedialog.askdirectory(initialdir=songs_main_dir, title="Choose A Folder")
+    if not directory:
+        return
+    if song_box.size() == 0:
+        loaded = False
+        previous_pitch = 2**(0/12)
+    added, taken = playlists_record.import_directory(directory)
+    if taken:
+        print(f'{len(taken)} songs already in the library')
+    for song in added:
         song_box.insert(END, song)
 
 
@@ -59,7 +121,6 @@ def display_songs():
     global song_box, previous_pitch
     for elem in playlists_record.get_musics():
         song_box.insert(END, elem[0])
-        print(elem)
     if song_box.size() >0:
         song_box.activate(0)
         song_box.selection_set(0, last=None)
@@ -105,7 +166,7 @@ def forward():
 
 
 def play():
-    global paused, loaded, audio, song, music_slider, previous_pitch
+    global paused, loaded, audio, song, music_slider, previous_pitch, playing_path
     if (not loaded) or (song != song_box.get(ACTIVE) ): #if it hasn't been loaded or the song changed
         stop()
         song = song_box.get(ACTIVE)
@@ -113,9 +174,13 @@ def play():
             print('Load a song')
             return
         song_index = song_box.index(ACTIVE)
-        song_path = f'{playlists_record.get_directory(song)}{song}.mp3'
         loaded = True
-        audio = PitchShifter(song_path, previous_pitch)
+        playing_path = song_path(song)
+        audio.load(playing_path, next_path(song_index)) #returns at once, the engine switches when it is built
+        show_waveform(song)
+        metadata = playlists_record.get_metadata(song)
+        if metadata and metadata['duration']: #length from the library, no decode needed
+            music_slider.config(to=metadata['duration'])
     #Play
     audio.play()
     paused = False
@@ -127,14 +192,36 @@ def play():
 def update():
     global loop, ani
     if paused: return
-    if audio.Finish:
-        forward()
-        return
+    track = audio.getTrack()
+    if track is not None and track != playing_path: #the engine moved on to the queued song
+        follow()
+    shifter = audio.getShifter()
+    if shifter is not None and visualizer is not None and shifter is not visualizer.shifter:
+        visualizer.attach(shifter)
     current = time.strftime('%M:%S', time.gmtime( audio.getTime() ))
     music_label_text.set(current)
-    music_slider.config(to= audio.DURATION, value = audio.getTime() )
+    if audio.getDuration(): music_slider.config(to= audio.getDuration())
+    music_slider.config(value = audio.getTime() )
+    move_cursor()
     loop = music_slider.after(1000, update) #polls update continuously in separate thread
 
+def follow():
+    """Selects the song the engine continued with and queues the one after it """
+    global song, playing_path
+    playing_path = audio.getTrack()
+    next_song = (song_box.index(ACTIVE) + 1) % song_box.size()
+    song = song_box.get(next_song)
+    song_box.selection_clear(0, END)
+    song_box.activate(next_song)
+    song_box.selection_set(next_song, last=None)
+    audio.enqueue(next_path(next_song))
+    show_waveform(song)
+
+def quit_player():
+    if audio is not None:
+        audio.close() #the one stream, PortAudio and every decoder
+    root.destroy()
+
 def pause():
     global paused
     audio.pause()
@@ -149,6 +236,69 @@ def stop():
 
 
 
+def show_waveform(name):
+    """Whole-song view of name's waveform --> built in the background the first time, drawn by update once stored"""
+    global waveform_index, waveform_view, waveform_pending
+    waveform_index = playlists_record.get_peaks(name)
+    waveform_view = None
+    waveform_pending = waveform_index is None
+    if waveform_index is None:
+        waveform.itemconfig('wave', state='hidden') #no stale waveform of the last song meanwhile
+        playlists_record.index_peaks_async(name, decoded_cache) #decodes once, shared with the playback cache
+    else:
+        draw_waveform()
+
+def draw_waveform():
+    """Lays the view out --> the canvas items are made once and only moved here, on a new song or zoom"""
+    global waveform_items, waveform_view
+    if waveform_view is None: waveform_view = (0.0, waveform_index.duration())
+    if waveform_items is None:
+        waveform_items = ([waveform.create_line(x, 0, x, 0, fill="purple", tags='wave') for x in range(WAVEFORM_WIDTH)],
+                          [waveform.create_line(x, 0, x, 0, fill="hot pink", tags='wave') for x in range(WAVEFORM_WIDTH)],
+                          waveform.create_line(0, 0, 0, WAVEFORM_HEIGHT, fill="black", tags='wave'))
+    mins, maxs, rms = waveform_index.overview(WAVEFORM_WIDTH, *waveform_view)
+    mid = WAVEFORM_HEIGHT / 2
+    for x, peak, loudness in zip(range(WAVEFORM_WIDTH), *waveform_items[:2]):
+        waveform.coords(peak, x, mid - maxs[x]*mid, x, mid - mins[x]*mid + 1)
+        waveform.coords(loudness, x, mid - rms[x]*mid, x, mid + rms[x]*mid + 1)
+    waveform.itemconfig('wave', state='normal')
+    move_cursor()
+
+def move_cursor():
+    """Every position update --> moves the one cursor line, or draws the waveform once its index is stored"""
+    global waveform_index, waveform_pending
+    if waveform_index is None:
+        if not waveform_pending: return
+        building = playlists_record.indexing_peaks(song) #asked first, a build ending in between is still seen below
+        waveform_index = playlists_record.get_peaks(song) #None until the background build has stored it
+        if waveform_index is not None: draw_waveform()
+        elif not building: waveform_pending = False #failed (see Database.index_errors) or never started
+        return
+    start, end = waveform_view
+    x = (audio.getTime() - start) / (end - start) * WAVEFORM_WIDTH
+    waveform.coords(waveform_items[2], x, 0, x, WAVEFORM_HEIGHT)
+
+def waveform_seek(event):
+    """Click on the waveform --> seeks there, snapped to the engine's hop so the position shown is the one played"""
+    if waveform_index is None or waveform_view is None: return
+    seconds = waveform_index.seek(event.x, WAVEFORM_WIDTH, *waveform_view, stride=audio.stride)
+    music_label_text.set( time.strftime('%M:%S', time.gmtime(seconds))  )
+    audio.setTime(seconds)
+    move_cursor()
+
+def waveform_zoom(event):
+    """Mouse wheel on the waveform --> halves or doubles the time in view around the pointer"""
+    global waveform_view
+    if waveform_index is None or waveform_view is None: return
+    start, end = waveform_view
+    duration = waveform_index.duration()
+    at = start + (end - start) * event.x / WAVEFORM_WIDTH
+    scale = 0.5 if event.num == 4 or event.delta > 0 else 2.0
+    span = min(max((end - start) * scale, 0.5), duration)
+    start = min(max(at - (at - start) * span / (end - start), 0.0), duration - span)
+    waveform_view = (start, start + span)
+    draw_waveform()
+
 def pitch_slide(value):
     global pitch_slider, pitch_label_text, audio
     valuelist = [-12, -11, -10, -9, -8, -7, -6, -5, -4, -3, -2, -1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
@@ -213,6 +363,7 @@ if __name__ == '__main__':
     add_song_menu = Menu(my_menu, tearoff=0)
     my_menu.add_cascade(label = "Add Songs", menu=add_song_menu)
     add_song_menu.add_command(label="Add Song(s) To Menu", command=add_song)
+    add_song_menu.add_command(label="Add A Folder To Menu", command=add_folder)
 
     remove_song_menu = Menu(my_menu, tearoff=0)
     my_menu.add_cascade(label="Remove Songs", menu = remove_song_menu)
@@ -238,6 +389,14 @@ if __name__ == '__main__':
     music_slider.grid(row=4, column=0, pady=(30,10), columnspan = 2)
     music_slider.config(value=0)
 
+    # Waveform seek bar, click to seek, wheel to zoom --> drawn from the library's peak index, never from PCM
+    waveform = Canvas(master_frame, width=WAVEFORM_WIDTH, height=WAVEFORM_HEIGHT, bg="pink", highlightthickness=0)
+    waveform.grid(row=5, column=0, pady=(0,10), columnspan = 2)
+    waveform.bind("<Button-1>", waveform_seek)
+    waveform.bind("<MouseWheel>", waveform_zoom)
+    waveform.bind("<Button-4>", waveform_zoom) #X11 scroll up
+    waveform.bind("<Button-5>", waveform_zoom)
+
 
     label_title = StringVar()
     label_title.set('My Sick Playlist')
@@ -245,25 +404,6 @@ if __name__ == '__main__':
     info_label.grid(row=0, column=1, sticky=W)
 
 
-    fig = Figure(figsize = (5.5, 3.5),
-                     dpi = 100)
-    canvas = FigureCanvasTkAgg(fig, master = root)
-    canvas.get_tk_widget().place(relx=.5, rely=.5, anchor="center", x=-10, y=220)
-    ax = fig.add_subplot(211)
-    line, = ax.plot(range(1024), [0 for i in range(1024)])
-    ax.set_ylim([-2,2])
-    ax2 = fig.add_subplot(212)
-    line2, = ax2.plot( np.fft.rfftfreq(1024, 1/48000) , [0 for i in range(513)], color="red") #np.linspace(0, 48000/2, 1024/2 + 1)
-    ax2.set_ylim([0, 75])
-
-    def plot(i):
-       global line
-       if not paused:
-            line.set_ydata( audio.getData() )
-            line2.set_ydata( audio.getAmpSpectrum() )
-            plt.show(block=False)
-    # ani = animation.FuncAnimation(fig, plot, interval=50, blit=False)
-
-
-    display_songs()
+    root.after_idle(open_library) #after the first paint
+    root.protocol("WM_DELETE_WINDOW", quit_player)
     root.mainloop()
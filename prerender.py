@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+from math import log2
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from offline import OfflineShifter
+
+
+def render_variant(signal_path, samp_freq, semitone, grain_len, stride, phase_mode, out_path):
+    """Worker job --> renders one semitone offline and leaves it on disk for the player to memory-map"""
+    signal = np.load(signal_path, mmap_mode='r')
+    output = OfflineShifter(signal, samp_freq, grain_len, stride, phase_mode).render(2**(semitone/12))
+    np.save(out_path, output)
+    return out_path
+
+
+class PitchVariants:
+    """Renders the semitone variants around the current pitch in a process pool, nearest first.
+    Only as many variants as fit in memory_budget are kept; the ones furthest from the pitch go first."""
+    def __init__(self, source, shift_factor, grain_len=4096, stride=1024, phase_mode='array',
+                 span=12, memory_budget=512<<20, workers=None):
+        self.source = source
+        self.samp_freq = source.samp_freq
+        self.grain_len = grain_len
+        self.stride = stride
+        self.phase_mode = phase_mode
+        self.span = span
+        self.max_variants = max(1, memory_budget // (4 * source.frames))
+        self.directory = tempfile.mkdtemp(prefix='pitch_variants_')
+        self.signal_path = None
+        self.ready = {}     #semitone -> memory-mapped rendered song
+        self.futures = {}   #semitone -> pending render
+        self.center = self.semitone(shift_factor)
+        self.closed = False
+        self.lock = threading.RLock() #done callbacks may run inside recenter
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        threading.Thread(target=self.start, daemon=True).start()
+
+    def semitone(self, shift_factor):
+        return round(12*log2(shift_factor))
+
+    def start(self):
+        """Hands the decoded song to the workers as an .npy file --> reuses the cache file when there is one"""
+        signal = self.source.load()
+        if isinstance(signal, np.memmap) and str(signal.filename).endswith('.npy'):
+            self.signal_path = signal.filename
+        else:
+            self.signal_path = os.path.join(self.directory, 'signal.npy')
+            np.save(self.signal_path, np.asarray(signal, dtype=np.float32))
+        self.recenter(2**(self.center/12))
+
+    def wanted(self):
+        """Semitones to keep, nearest to the current pitch first """
+        semitones = range(-self.span, self.span+1)
+        return sorted(semitones, key=lambda s: (abs(s - self.center), s))[:self.max_variants]
+
+    def recenter(self, shift_factor):
+        """Called when the pitch moves --> drops far variants, queues the new nearest ones"""
+        with self.lock:
+            self.center = self.semitone(shift_factor)
+            if self.signal_path is None or self.closed:
+                return
+            wanted = self.wanted()
+            for s in [s for s in self.ready if s not in wanted]:
+                del self.ready[s]
+                os.remove(self.variant_path(s))
+            for s in [s for s in self.futures if s not in wanted]:
+                self.futures.pop(s).cancel()
+            for s in wanted:
+                if s in self.ready or s in self.futures:
+                    continue
+                future = self.pool.submit(render_variant, self.signal_path, self.samp_freq, s, self.grain_len,
+                                          self.stride, self.phase_mode, self.variant_path(s))
+                self.futures[s] = future
+                future.add_done_callback(lambda f, s=s: self.finish(s, f))
+
+    def finish(self, semitone, future):
+        with self.lock:
+            if self.futures.get(semitone) is not future:
+                return
+            del self.futures[semitone]
+            if future.cancelled() or future.exception() is not None or self.closed:
+                return
+            self.ready[semitone] = np.load(future.result(), mmap_mode='r')
+
+    def variant_path(self, semitone):
+        return os.path.join(self.directory, f'{semitone:+d}.npy')
+
+    def get(self, shift_factor):
+        """Rendered song for shift_factor, or None if it is not ready (or not a whole semitone)"""
+        semitone = self.semitone(shift_factor)
+        if abs(2**(semitone/12) - shift_factor) > 1e-9:
+            return None
+        return self.ready.get(semitone)
+
+    def close(self):
+        """Cancels pending renders and deletes the rendered files """
+        with self.lock:
+            self.closed = True
+            self.ready.clear()
+            self.futures.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import struct
+import asyncio
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from source import ArraySource
+from pitch_shift import PitchShifter
+from telemetry import Telemetry
+from signals import SIGNALS, synthesize
+
+#Wire format. Client --> server: one JSON object per line, {"op": "open" | "pitch" | "seek" | "stats" | "close", ...}.
+#Server --> client: frames of a 1-byte kind and a 4-byte big-endian length, then the payload:
+#AUDIO is float32 PCM, interleaved for stereo sessions, EVENT is a JSON object with an "event" key.
+HEADER = struct.Struct('!cI')
+AUDIO, EVENT = b'A', b'J'
+
+
+def frame(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def event(name, **fields):
+    return frame(EVENT, json.dumps(dict(event=name, **fields)).encode())
+
+
+async def read_frame(reader):
+    """Client side helper --> (kind, payload), (None, b'') once the server hung up"""
+    try:
+        kind, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+        return kind, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None, b''
+
+
+class Session:
+    """One listener: a headless PitchShifter whose hops run on the server's pool, `chunk` hops per job.
+    Pitch changes and seeks are stored by the event loop and applied by the next job, so they never race a hop.
+    realtime: Stay at most `lead` seconds ahead of the listener's clock --> a chunk sent after the listener
+    would have played it counts as late. Otherwise renders as fast as the socket drains."""
+    def __init__(self, server, writer, shifter, name, realtime=True):
+        self.server = server
+        self.writer = writer
+        self.shifter = shifter
+        self.name = name
+        self.realtime = realtime
+        self.id = next(server.ids)
+        self.hop_seconds = shifter.STRIDE / shifter.samp_freq
+        self.stats = Telemetry(server.chunk * self.hop_seconds) #job latency, overrun = chunk slower than it plays
+        self.shift = None       #pending pitch
+        self.seek_to = None     #pending seek, in hops
+        self.late = 0
+        self.sent = 0           #hops sent since the listener's clock (re)started
+        self.clock = None
+        self.finished = False
+        self.wake = asyncio.Event()
+        self.task = None
+
+    def render(self, hops):
+        """Worker side --> (PCM bytes of up to `hops` hops, True at the end of the song)"""
+        sh = self.shifter
+        if self.shift is not None:
+            shift, self.shift = self.shift, None
+            sh.setPitch(shift)
+        if self.seek_to is not None:
+            count, self.seek_to = self.seek_to, None
+            sh.x_prev[:] = 0 #restart the overlap-add like LookaheadWorker.restart
+            sh.prev_grain[:] = 0
+            if sh.wsola is not None:
+                sh.wsola.reset()
+            for c in range(max(0, count - sh.GRAIN_LEN_SAMP // sh.STRIDE + 1), count):
+                sh.hop(c)
+            sh.count = count
+        blocks = []
+        for _ in range(hops):
+            if not sh.hop(sh.count):
+                return b''.join(blocks), True
+            blocks.append(sh.output_buffer.tobytes())
+            sh.count += 1
+        return b''.join(blocks), False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        server = self.server
+        while True:
+            if self.finished:
+                if self.seek_to is None: #idle at the end until a seek or close
+                    self.wake.clear()
+                    await self.wake.wait()
+                continue
+            if self.clock is None:
+                self.clock, self.sent = loop.time(), 0
+            if self.realtime:
+                ahead = self.sent * self.hop_seconds - (loop.time() - self.clock)
+                if ahead > server.lead:
+                    await asyncio.sleep(ahead - server.lead)
+            async with server.slots: #bounded queue in front of the pool --> sessions wait here under load
+                submitted = loop.time()
+                pcm, done = await loop.run_in_executor(server.pool, self.render, server.chunk)
+            self.finished = done and self.seek_to is None #a seek during the last chunk starts over instead
+            latency = loop.time() - submitted
+            hops = len(pcm) // self.shifter.output_buffer.nbytes
+            self.stats.callback(0, hops * self.shifter.STRIDE, latency)
+            server.stats.callback(0, hops * self.shifter.STRIDE, latency)
+            if self.realtime and loop.time() > self.clock + server.lead + self.sent * self.hop_seconds:
+                self.late += 1 #listener ran dry before this chunk arrived
+            self.sent += hops
+            if pcm:
+                self.writer.write(frame(AUDIO, pcm))
+            if self.finished:
+                self.writer.write(event('end', session=self.id))
+            await self.writer.drain() #slow readers hold their own session back, not the pool
+
+    def seek(self, seconds):
+        assert 0 <= seconds < self.shifter.DURATION, "Choose a valid duration within the boundaries of song"
+        self.seek_to = int(seconds * self.shifter.samp_freq / self.shifter.STRIDE)
+        self.clock = None       #listener re-buffers from here
+        self.finished = False
+        self.wake.set()
+
+    def snapshot(self):
+        """Per-session report --> job latency and overruns, late chunks, and the shifter's own hop stages"""
+        engine = self.shifter.getStats()
+        return {'session': self.id, 'song': self.name, 'position_s': self.shifter.getTime(), 'pitch': self.shifter.getPitch(),
+                'late_chunks': self.late, 'finished': self.finished, 'jobs': self.stats.snapshot(),
+                'hop_stages': {k: engine['stages'][k] for k in ('rfft', 'phase', 'irfft', 'hop')}}
+
+
+class PitchServer:
+    """Serves pitch-shifted PCM streams to many clients from one process.
+    All sessions share one bounded pool of `workers` threads; at most `max_pending` jobs wait for it, further
+    sessions block before submitting. The numpy FFTs release the GIL, the phase propagation mostly does not,
+    so expect sessions per box to grow with workers until the pure-Python share saturates one core."""
+    def __init__(self, workers=None, max_pending=None, chunk=4, lead=0.5, phase_mode='array', cache=None, stats_log=None):
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.slots = asyncio.Semaphore(max_pending or 2 * self.workers)
+        self.chunk = chunk      #hops per job
+        self.lead = lead        #seconds a realtime session may run ahead of its listener
+        self.phase_mode = phase_mode
+        self.cache = cache
+        self.ids = itertools.count(1)
+        self.sessions = {}
+        self.served = 0
+        self.stats = Telemetry(lead) #all sessions' job latency, overrun = a listener buffering `lead` would run dry
+        if stats_log is not None:
+            self.stats.start_logging(stats_log, self.snapshot)
+
+    def open_shifter(self, msg):
+        """Worker side --> a synthetic signal ('sine', 'chirp', 'noise') or a song path, decoded in blocks"""
+        song = msg['path']
+        if song in SIGNALS:
+            samp_freq = int(msg.get('samp_freq', 44100))
+            source = ArraySource(synthesize(song, samp_freq, float(msg.get('seconds', 30))), samp_freq)
+        else:
+            source = song
+        return PitchShifter(source, float(msg.get('shift', 1.0)), msg.get('phase_mode', self.phase_mode),
+                            streaming=True, cache=self.cache, mono=msg.get('mono', True), output=False,
+                            algorithm=msg.get('algorithm', 'vocoder'))
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        session = None
+        try:
+            async for line in reader:
+                msg = json.loads(line)
+                op = msg.get('op')
+                try:
+                    if op == 'open' and session is None:
+                        shifter = await loop.run_in_executor(self.pool, self.open_shifter, msg)
+                        session = Session(self, writer, shifter, msg['path'], msg.get('realtime', True))
+                        self.sessions[session.id] = session
+                        self.served += 1
+                        writer.write(event('open', session=session.id, samp_freq=shifter.samp_freq, channels=shifter.CHANNELS,
+                                           stride=shifter.STRIDE, duration=shifter.DURATION))
+                        session.task = asyncio.create_task(session.run())
+                    elif op == 'stats':
+                        stats = self.snapshot() if msg.get('scope') == 'server' or session is None else session.snapshot()
+                        writer.write(event('stats', **stats))
+                    elif session is None:
+                        writer.write(event('error', message='open a session first'))
+                    elif op == 'pitch':
+                        shift = float(msg['shift'])
+                        assert -3 < shift < 3, "Pitch must be bounded between 2 octaves"
+                        session.shift = shift
+                    elif op == 'seek':
+                        session.seek(float(msg['seconds']))
+                    elif op == 'close':
+                        break
+                    else:
+                        writer.write(event('error', message=f'unknown op {op}'))
+                except (AssertionError, KeyError, ValueError, RuntimeError, OSError) as e: #OSError: e.g. no such song
+                    writer.write(event('error', message=str(e)))
+                await writer.drain()
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            if session is not None:
+                session.task.cancel()
+                try:
+                    await session.task
+                except (asyncio.CancelledError, ConnectionError):
+                    pass
+                del self.sessions[session.id]
+                await loop.run_in_executor(self.pool, session.shifter.close) #a job may still hold the shifter
+            writer.close()
+
+    def snapshot(self):
+        """Aggregate report --> sessions, job latency over all of them, overruns and late chunks"""
+        return {'sessions': len(self.sessions), 'served': self.served, 'workers': self.workers, 'chunk_hops': self.chunk,
+                'late_chunks': sum(s.late for s in self.sessions.values()), 'jobs': self.stats.snapshot()}
+
+    async def serve(self, host='127.0.0.1', port=8765, unix=None):
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stats.stop_logging()
+            self.pool.shutdown(wait=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream pitch-shifted PCM to many clients over TCP or a Unix socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--workers', type=int, help='pool threads shared by all sessions, defaults to the number of cores')
+    parser.add_argument('--max-pending', type=int, help='jobs allowed to wait for the pool, defaults to twice the workers')
+    parser.add_argument('--chunk', type=int, default=4, help='hops rendered per job')
+    parser.add_argument('--lead', type=float, default=0.5, help='seconds a realtime session may run ahead')
+    parser.add_argument('--mode', default='array', help='default phase mode of new sessions')
+    parser.add_argument('--stats-log', help='rotating log of aggregate snapshots')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    server = PitchServer(args.workers, args.max_pending, args.chunk, args.lead, args.mode, stats_log=args.stats_log)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
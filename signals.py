@@ -0,0 +1,23 @@
+import numpy as np
+
+SIGNALS = ('sine', 'chirp', 'noise') #synthetic signals, anything else is a path to a song
+
+
+def synthesize(kind, samp_freq, seconds, seed=0):
+    """Synthetic mono test signal --> 'sine' (440 Hz and harmonics), 'chirp' (50 Hz to 8 kHz sweep) or 'noise'"""
+    t = np.arange(int(seconds * samp_freq)) / samp_freq
+    if kind == 'sine':
+        signal = sum(np.sin(2*np.pi*440*h*t) / h for h in range(1, 6)) / 2.3
+    elif kind == 'chirp':
+        f0, f1 = 50, min(8000, samp_freq / 2)
+        signal = 0.8*np.sin(2*np.pi*f0*seconds/np.log(f1/f0) * ((f1/f0)**(t/seconds) - 1))
+    else:
+        signal = 0.3*np.random.default_rng(seed).standard_normal(len(t))
+    return signal.astype(np.float32)
+
+
+def percentiles(seconds, prefix):
+    """p50/p90/p99/max of a list of timings --> in milliseconds, keys prefixed for a flat record"""
+    ms = np.asarray(seconds) * 1e3
+    return {f'{prefix}_p50_ms': float(np.percentile(ms, 50)), f'{prefix}_p90_ms': float(np.percentile(ms, 90)),
+            f'{prefix}_p99_ms': float(np.percentile(ms, 99)), f'{prefix}_max_ms': float(ms.max())}
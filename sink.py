@@ -0,0 +1,188 @@
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import soundfile as sf
+try:
+    import pyaudio
+except ImportError: #WavSink and NullSink work without PortAudio
+    pyaudio = None
+
+#PortAudio callback return flags, same values as pyaudio.pa* so callbacks work without PyAudio installed
+paContinue, paComplete, paAbort = 0, 1, 2
+
+
+class PyAudioSink:
+    """The sound card --> streams are PyAudio's own, from one PortAudio instance"""
+    def __init__(self):
+        assert pyaudio is not None, "PyAudio is required for playback, use a WavSink or NullSink to process headless"
+        self.p = pyaudio.PyAudio()
+
+    def check(self, samp_freq, channels):
+        """Raises ValueError if a stream of this format cannot be opened --> the sound card takes any"""
+
+    def open(self, callback, channels, samp_freq, frames_per_buffer, input=False):
+        """Output stream, duplex with input --> not started, calls callback(in_data, frame_count, time_info, status)"""
+        return self.p.open(format=pyaudio.paFloat32, channels=channels, rate=samp_freq, input=input, output=True,
+                           frames_per_buffer=frames_per_buffer, start=False, stream_callback=callback)
+
+    def close(self):
+        self.p.terminate()
+
+
+class ClockStream:
+    """What the file and null sinks open instead of a PortAudio stream --> a thread calls the stream callback block
+    after block and hands each block to the sink, as fast as the CPU allows or `speed` times real time.
+    Same start_stream, stop_stream, is_active, close and latency calls as a pyaudio.Stream, so whatever drives one
+    drives the other: the callback, hop and process run exactly as they would on a sound card, only clocked here.
+    Flat out suits lookahead=0 only, a lookahead worker cannot keep up with no clock at all and leaves underruns"""
+    def __init__(self, sink, callback, channels, samp_freq, frames_per_buffer, speed=None):
+        self.sink = sink
+        self.callback = callback
+        self.channels = channels
+        self.samp_freq = samp_freq
+        self.frames_per_buffer = frames_per_buffer
+        self.speed = speed
+        self.thread = None
+        self.stopping = False
+        self.blocks = 0         #callbacks run since the stream was opened
+
+    def start_stream(self):
+        if self.is_active():
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop_stream(self):
+        """Lets the block being processed finish, then returns --> like PortAudio, no callback runs afterwards"""
+        self.stopping = True
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def is_active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_stopped(self):
+        return not self.is_active()
+
+    def wait(self, timeout=None):
+        """Blocks until the callback completes or the stream is stopped --> True if it has, False on timeout"""
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return not self.is_active()
+
+    def close(self):
+        self.stop_stream()
+
+    def get_input_latency(self):
+        return 0.0
+
+    def get_output_latency(self):
+        return 0.0
+
+    def run(self):
+        """Clock thread --> callbacks until one returns paComplete or paAbort, or stop_stream"""
+        period = self.frames_per_buffer / self.samp_freq / self.speed if self.speed else 0.0
+        start = time.perf_counter()
+        n = 0
+        while not self.stopping:
+            data, flag = self.callback(None, self.frames_per_buffer, {}, 0) #output only, PortAudio passes no input
+            self.blocks += 1
+            if flag == paAbort:
+                break
+            if data:
+                self.sink.write(data, self.channels)
+            if flag != paContinue:
+                break
+            n += 1
+            if period:
+                time.sleep(max(0.0, start + n * period - time.perf_counter()))
+
+
+class NullSink:
+    """Discards the audio --> runs the real-time code path without a device, for tests and benchmarks.
+    speed: None as fast as the CPU allows, else that many times real time, e.g. 1.0 paces like a sound card"""
+    def __init__(self, speed=None):
+        self.speed = speed
+        self.frames = 0         #frames written, over every stream opened
+
+    def check(self, samp_freq, channels):
+        pass
+
+    def open(self, callback, channels, samp_freq, frames_per_buffer, input=False):
+        assert not input, "Live input needs a sound card"
+        return ClockStream(self, callback, channels, samp_freq, frames_per_buffer, self.speed)
+
+    def write(self, data, channels):
+        self.frames += len(data) // (4 * channels)
+
+    def close(self):
+        pass
+
+
+class WavSink(NullSink):
+    """Writes the audio to a file block by block as it is played --> WAV, FLAC or anything else soundfile knows
+    by the extension. Seeks and pauses are recorded as heard, i.e. the file is what a speaker would have played.
+    subtype: soundfile subtype, e.g. 'FLOAT' or 'PCM_24', the format's default (16 bit for WAV and FLAC) if None"""
+    def __init__(self, path, speed=None, subtype=None):
+        super().__init__(speed)
+        self.path = path
+        self.subtype = subtype
+        self.file = None
+        self.format = None
+
+    def check(self, samp_freq, channels):
+        """The first format checked or opened is the file's --> ValueError for any other, one file holds one sample
+        rate and channel count. AudioEngine checks songs as they are queued, so the caller gets the error"""
+        if self.format is None:
+            self.format = (samp_freq, channels)
+        if self.format != (samp_freq, channels):
+            raise ValueError(f'{self.path} is {self.format[0]} Hz with {self.format[1]} channels, '
+                             f'not {samp_freq} Hz with {channels}')
+
+    def open(self, callback, channels, samp_freq, frames_per_buffer, input=False):
+        """Creates the file on the first stream --> later ones, e.g. the engine's next song, append to it"""
+        self.check(samp_freq, channels)
+        if self.file is None:
+            self.file = sf.SoundFile(self.path, 'w', samp_freq, channels, self.subtype)
+        return super().open(callback, channels, samp_freq, frames_per_buffer, input)
+
+    def write(self, data, channels):
+        super().write(data, channels)
+        self.file.write(np.frombuffer(data, dtype=np.float32).reshape(-1, channels))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play a song through the real-time shifter into a file or nowhere, as fast as it goes')
+    parser.add_argument('song')
+    parser.add_argument('-s', '--semitones', type=float, default=0.0)
+    parser.add_argument('-o', '--out', help='WAV/FLAC file to write, the audio is discarded without')
+    parser.add_argument('--subtype', help="soundfile subtype of the file, e.g. 'FLOAT' or 'PCM_24'")
+    parser.add_argument('--speed', type=float, help='times real time, as fast as possible by default')
+    parser.add_argument('--mode', default='array', help='phase engine, see utils.ENGINES')
+    parser.add_argument('--algorithm', default='vocoder', choices=('vocoder', 'wsola'))
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    from pitch_shift import PitchShifter #imports this module
+    sink = NullSink(args.speed) if args.out is None else WavSink(args.out, args.speed, args.subtype)
+    shifter = PitchShifter(args.song, 2**(args.semitones/12), args.mode, output=sink, algorithm=args.algorithm)
+    start = time.perf_counter()
+    shifter.play()
+    shifter.stream.wait()
+    wall = time.perf_counter() - start
+    stats = shifter.getStats()
+    print(json.dumps({'duration_s': shifter.DURATION, 'position_s': shifter.getTime(), 'finished': shifter.Finish,
+                      'wall_s': wall, 'realtime_factor': shifter.DURATION / wall, 'frames': sink.frames,
+                      'callback_p99_ms': stats['stages']['callback']['p99_ms'], 'overruns': stats['overruns']}))
+    shifter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import sys
+import threading
+import numpy as np
+import soundfile as sf
+
+
+def decode(path, mono=True):
+    """Decodes a whole song like librosa.load --> (frames,) if mono, else (frames, channels) so frames stay interleaved.
+    soundfile reads what libsndfile knows (WAV, FLAC, OGG, MP3 from 1.1 on) into the very samples librosa would give;
+    only other formats go through librosa and its audioread fallback, which is imported then, seconds of startup"""
+    try:
+        signal, samp_freq = sf.read(path, dtype='float32', always_2d=True)
+    except RuntimeError: #formats libsndfile cannot open
+        import librosa
+        signal, samp_freq = librosa.load(path, sr=None, mono=mono)
+        if not mono:
+            signal = np.ascontiguousarray(signal.T if signal.ndim == 2 else signal[:, None])
+        return signal, samp_freq
+    if mono: #librosa.to_mono averages the channels
+        signal = signal[:, 0] if signal.shape[1] == 1 else np.mean(signal, axis=1)
+    return signal, samp_freq
+
+
+class ArraySource:
+    """Fully decoded song --> reads are plain slices of the signal, (frames,) or (frames, channels)"""
+    def __init__(self, signal, samp_freq, path=None):
+        self.signal = signal
+        self.samp_freq = samp_freq
+        self.frames = len(signal)
+        self.mono = signal.ndim == 1
+        self.channels = 1 if self.mono else signal.shape[1]
+        self.path = path
+
+    def read(self, start, frame_count):
+        """Returns frame_count samples from start, fewer at the end of the song"""
+        return self.signal[start:start+frame_count]
+
+    def load(self):
+        """Returns the whole decoded signal """
+        return self.signal
+
+    def close(self):
+        pass
+
+
+class StreamingSource:
+    """Decodes the song block by block on a background thread into a bounded ring buffer.
+    Memory stays at `capacity` frames and the first block is ready long before the whole file would be.
+    mono=False keeps every channel --> reads are (frames, channels)"""
+    def __init__(self, path, block_size=8192, capacity=1<<18, timeout=0.1, mono=True):
+        info = sf.info(path)
+        assert capacity >= 2*block_size, "Ring buffer must hold at least two blocks"
+        self.path = path
+        self.samp_freq = info.samplerate
+        self.frames = info.frames
+        self.mono = mono
+        self.channels = 1 if mono else info.channels
+        self.block_size = block_size
+        self.capacity = capacity
+        self.timeout = timeout
+        self.frame_shape = () if mono else (self.channels,)
+        self.ring = np.zeros((capacity,) + self.frame_shape, dtype=np.float32)
+        self.block = np.zeros((block_size, info.channels), dtype=np.float32)
+        self.out = np.zeros((0,) + self.frame_shape, dtype=np.float32)
+        self.read_pos = 0       #absolute frame of the next sample handed to read()
+        self.write_pos = 0      #absolute frame one past the last decoded sample
+        self.seek_target = None
+        self.eof = False
+        self.closed = False
+        self.underruns = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.decode_loop, daemon=True)
+        self.thread.start()
+
+    def decode_loop(self):
+        """Producer thread --> re-opens the file on seeks, otherwise keeps the ring topped up"""
+        song = sf.SoundFile(self.path)
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and self.seek_target is None and (self.eof or self.write_pos - self.read_pos > self.capacity - self.block_size):
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    target, self.seek_target = self.seek_target, None
+                if target is not None:
+                    song.close()
+                    song = sf.SoundFile(self.path)
+                    song.seek(target)
+                    with self.cond:
+                        self.write_pos, self.eof = target, False
+                    continue
+                n = len(song.read(out=self.block))
+                with self.cond:
+                    if self.seek_target is not None: #block belongs to the old position
+                        continue
+                    self.write_block(self.block[:n].mean(axis=1) if self.mono else self.block[:n])
+                    self.eof = n < self.block_size
+                    self.cond.notify_all()
+        finally:
+            song.close()
+
+    def write_block(self, samples):
+        """Copies decoded samples into the ring, dropping any the reader already skipped past"""
+        skip = max(0, self.read_pos - self.write_pos)
+        start = self.write_pos + skip
+        samples = samples[skip:]
+        idx = start % self.capacity
+        first = min(len(samples), self.capacity - idx)
+        self.ring[idx:idx+first] = samples[:first]
+        self.ring[:len(samples)-first] = samples[first:]
+        self.write_pos = start + len(samples)
+
+    def seek(self, frame):
+        """Flushes the ring and restarts decoding at frame """
+        with self.cond:
+            self.read_pos = self.write_pos = frame
+            self.seek_target = frame
+            self.eof = False
+            self.cond.notify_all()
+
+    def read(self, start, frame_count):
+        """Returns frame_count samples from start --> silence (counted as an underrun) if the decoder is behind,
+        fewer samples only at the end of the song"""
+        if start != self.read_pos:
+            self.seek(start)
+        if len(self.out) < frame_count:
+            self.out = np.zeros((frame_count,) + self.frame_shape, dtype=np.float32)
+        out = self.out[:frame_count]
+        with self.cond:
+            end = min(start + frame_count, self.frames)
+            self.cond.wait_for(lambda: self.seek_target is None and (self.write_pos >= end or self.eof), self.timeout)
+            available = max(0, min(self.write_pos, end) - start)
+            if available < end - start and not self.eof:
+                self.underruns += 1
+                out[:] = 0
+                available = frame_count
+            else:
+                idx = start % self.capacity
+                first = min(available, self.capacity - idx)
+                out[:first] = self.ring[idx:idx+first]
+                out[first:available] = self.ring[:available-first]
+            self.read_pos = start + available
+            self.cond.notify_all()
+        return out[:available]
+
+    def load(self):
+        """Decodes the whole song in one go --> for offline rendering """
+        return decode(self.path, self.mono)[0]
+
+    def close(self):
+        """Stops the decoder thread """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class LiveSource:
+    """Input side of a duplex stream --> PitchShifter.callback pushes every in_data block, hop() reads it back.
+    Same read() as the file sources so the engine does not care where samples come from; start is ignored and the
+    last pushed block is returned. No end and no seeking, frames is unbounded"""
+    live = True
+    def __init__(self, samp_freq, channels=1, capacity=4096):
+        """capacity: Largest block a callback may push, in frames"""
+        self.samp_freq = samp_freq
+        self.channels = channels
+        self.mono = channels == 1
+        self.frames = sys.maxsize
+        self.path = None
+        self.block = np.zeros((capacity,) if self.mono else (capacity, channels), dtype=np.float32)
+        self.pushed = 0         #frames in block
+        self.blocks = 0
+
+    def push(self, in_data):
+        """Copies one interleaved float32 block (bytes or array) in --> called from the stream callback"""
+        samples = np.frombuffer(in_data, dtype=np.float32)
+        self.pushed = len(samples) // self.channels
+        assert self.pushed <= len(self.block), "Block larger than the source's capacity"
+        self.block[:self.pushed] = samples.reshape(self.block[:self.pushed].shape)
+        self.blocks += 1
+
+    def read(self, start, frame_count):
+        """Returns the last pushed block, frame_count samples of it """
+        return self.block[:min(frame_count, self.pushed)]
+
+    def load(self):
+        raise RuntimeError("Live input cannot be decoded up front")
+
+    def close(self):
+        pass
+
+
+def open_source(input_wav, streaming=False, cache=None, mono=True):
+    """Returns a source for a path --> StreamingSource, or ArraySource decoded up front, see decode.
+    cache: Optional cache.DecodedCache --> hits play straight from the memory-mapped PCM,
+    misses stream (if streaming) while the cache fills in the background"""
+    if cache is not None:
+        if streaming and not cache.contains(input_wav, mono):
+            cache.store_async(input_wav, mono)
+            return StreamingSource(input_wav, mono=mono)
+        signal, samp_freq = cache.load(input_wav, mono)
+        return ArraySource(signal, samp_freq, input_wav)
+    if streaming:
+        return StreamingSource(input_wav, mono=mono)
+    signal, samp_freq = decode(input_wav, mono)
+    return ArraySource(signal, samp_freq, input_wav)
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class SpectrumTap:
+    """What the engine just played, for the GUI --> magnitude spectrum and last output block, double-buffered.
+    The audio side publishes into the back slot and then flips `front`, readers copy the front slot and retry if a
+    publish landed meanwhile (seqlock), so neither side ever waits on the other. Nothing allocates after __init__."""
+    def __init__(self, n_bins, block_shape, dtype=np.float32):
+        self.magn = np.zeros((2, n_bins), dtype)
+        self.block = np.zeros((2,) + tuple(block_shape), dtype)
+        self.front = 0
+        self.seq = 0    #odd while a publish is in flight
+
+    def publish(self, magn, block):
+        """Called from the audio thread after every hop. magn: (bins,) or (channels, bins), summed over channels"""
+        back = 1 - self.front
+        self.seq += 1
+        if magn.ndim > 1:
+            np.sum(magn, axis=0, out=self.magn[back])
+            self.magn[back] *= 1 / len(magn)
+        else:
+            np.copyto(self.magn[back], magn, casting='unsafe')
+        np.copyto(self.block[back], block, casting='unsafe')
+        self.front = back
+        self.seq += 1
+
+    def read(self, magn=None, block=None, tries=4):
+        """Copies the latest snapshot into magn and block (allocated if None) --> (seq, magn, block).
+        A snapshot torn by a concurrent publish is retried; after `tries` the last copy is returned as is"""
+        magn = np.empty_like(self.magn[0]) if magn is None else magn
+        block = np.empty_like(self.block[0]) if block is None else block
+        for _ in range(tries):
+            seq = self.seq
+            front = self.front
+            np.copyto(magn, self.magn[front])
+            np.copyto(block, self.block[front])
+            if seq == self.seq and not seq & 1:
+                break
+        return seq, magn, block
+
+
+class LogBinner:
+    """Folds a linear rfft magnitude spectrum into n_points log-spaced bands, peak per band, in dB.
+    Band edges are fixed up front --> reduce() is a single reduceat with no allocation"""
+    def __init__(self, n_bins, samp_freq, n_points=128, f_min=30.0, floor_db=-20.0):
+        nyquist = samp_freq / 2
+        edges = np.geomspace(f_min, nyquist, n_points + 1)
+        starts = np.round(edges[:-1] / nyquist * (n_bins - 1)).astype(np.intp)
+        self.starts = np.unique(np.clip(starts, 1, n_bins - 1)) #low bands narrower than a bin collapse into one
+        self.n_points = len(self.starts)
+        ends = np.append(self.starts[1:], n_bins)
+        self.freqs = np.sqrt(self.starts * ends) * nyquist / (n_bins - 1)   #geometric band centres, Hz
+        self.floor = 10 ** (floor_db / 20)
+        self.out = np.zeros(self.n_points, np.float32)
+
+    def reduce(self, magn):
+        """Band peaks of magn in dB --> view of a buffer reused on every call"""
+        np.maximum.reduceat(magn, self.starts, out=self.out)
+        np.maximum(self.out, self.floor, out=self.out)
+        np.log10(self.out, out=self.out)
+        self.out *= 20
+        return self.out
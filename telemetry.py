@@ -0,0 +1,122 @@
+import json
+import time
+import threading
+import logging
+import logging.handlers
+from math import log
+import numpy as np
+
+STAGES = ('window', 'rfft', 'rescale', 'phase', 'irfft', 'overlap_add', 'hop', 'callback')
+WINDOW, RFFT, RESCALE, PHASE, IRFFT, OVERLAP_ADD, HOP, CALLBACK = range(len(STAGES))
+#PortAudio callback status flags, same values as pyaudio.pa* so they work without PyAudio installed
+paInputUnderflow, paInputOverflow, paOutputUnderflow, paOutputOverflow, paPrimingOutput = 1, 2, 4, 8, 16
+FLAGS = {'input_underflows': paInputUnderflow, 'input_overflows': paInputOverflow,
+         'output_underflows': paOutputUnderflow, 'output_overflows': paOutputOverflow, 'priming': paPrimingOutput}
+
+
+class Telemetry:
+    """Per-stage latency histograms and xrun counters for the audio callback.
+    Everything is preallocated --> recording only bumps counters in fixed numpy arrays, never grows anything.
+    Histograms are log-spaced from lo to hi seconds, with one extra bin at each end for out of range times."""
+    def __init__(self, budget, n_bins=60, lo=1e-6, hi=1.0):
+        self.budget = budget    #seconds one callback may take, i.e. stride / samp_freq
+        self.lo = lo
+        self.n_bins = n_bins
+        self.scale = n_bins / log(hi / lo)
+        self.edges = np.geomspace(lo, hi, n_bins + 1)
+        self.hist = np.zeros((len(STAGES), n_bins + 2), dtype=np.int64)
+        self.total = np.zeros(len(STAGES))
+        self.peak = np.zeros(len(STAGES))
+        self.flags = np.zeros(len(FLAGS), dtype=np.int64)
+        self.flag_bits = np.array(list(FLAGS.values()))
+        self.callbacks = self.frames = self.overruns = 0
+        self.t = 0.0
+        self.logger = None
+        self.log_thread = None
+        self.log_stop = threading.Event()
+
+    def record(self, stage, seconds):
+        """Adds one timing to a stage's histogram """
+        i = int(log(seconds / self.lo) * self.scale) + 1 if seconds > self.lo else 0
+        self.hist[stage, min(i, self.n_bins + 1)] += 1
+        self.total[stage] += seconds
+        if seconds > self.peak[stage]:
+            self.peak[stage] = seconds
+
+    def start(self):
+        """Starts the stage clock --> each mark() times the stretch since the previous one"""
+        self.t = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.record(stage, now - self.t)
+        self.t = now
+
+    def callback(self, status, frames, seconds):
+        """Called once per PortAudio callback with its status flags and how long it took"""
+        self.record(CALLBACK, seconds)
+        self.callbacks += 1
+        self.frames += frames
+        if seconds > self.budget:
+            self.overruns += 1
+        if status:
+            self.flags += (self.flag_bits & status) != 0
+
+    def percentile(self, stage, q):
+        """Upper edge of the histogram bin holding the q-th percentile, in seconds """
+        counts = self.hist[stage]
+        n = counts.sum()
+        if n == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(counts), q / 100 * n))
+        return float(self.edges[min(i, self.n_bins)]) if i > 0 else self.lo
+
+    def snapshot(self):
+        """Counters plus count/mean/p50/p99/max per stage --> plain dict, times in milliseconds"""
+        stats = {'callbacks': self.callbacks, 'frames': self.frames, 'overruns': self.overruns,
+                 'budget_ms': self.budget * 1e3}
+        stats.update(zip(FLAGS, self.flags.tolist()))
+        stages = {}
+        for stage, name in enumerate(STAGES):
+            count = int(self.hist[stage].sum())
+            peak = float(self.peak[stage]) #bin edges can overshoot the slowest time actually seen
+            stages[name] = {'count': count, 'mean_ms': float(self.total[stage]) / count * 1e3 if count else 0.0,
+                            'p50_ms': min(self.percentile(stage, 50), peak) * 1e3,
+                            'p99_ms': min(self.percentile(stage, 99), peak) * 1e3, 'max_ms': peak * 1e3}
+        stats['stages'] = stages
+        return stats
+
+    def reset(self):
+        self.hist[:] = 0
+        self.total[:] = 0
+        self.peak[:] = 0
+        self.flags[:] = 0
+        self.callbacks = self.frames = self.overruns = 0
+
+    def start_logging(self, path, snapshot=None, interval=10.0, max_bytes=1<<20, backups=3):
+        """Appends a JSON snapshot every interval seconds to a rotating log, from its own thread.
+        snapshot: Callable returning the dict to log, defaults to self.snapshot"""
+        self.logger = logging.getLogger(f'pitch_shift.telemetry.{id(self)}')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self.logger.addHandler(handler)
+        snapshot = snapshot or self.snapshot
+        def log_loop():
+            while not self.log_stop.wait(interval):
+                self.logger.info(json.dumps(snapshot()))
+            self.logger.info(json.dumps(snapshot()))
+        self.log_thread = threading.Thread(target=log_loop, daemon=True)
+        self.log_thread.start()
+
+    def stop_logging(self):
+        """Writes a last snapshot and closes the log """
+        if self.log_thread is None:
+            return
+        self.log_stop.set()
+        self.log_thread.join()
+        for handler in self.logger.handlers[:]:
+            handler.close()
+            self.logger.removeHandler(handler)
+        self.log_thread = None
@@ -0,0 +1,14 @@
+from offline import OfflineShifter, check_seams
+from signals import synthesize
+
+
+def test_parallel_seams_below_threshold():
+    for kind, semitones, workers in (('sine', 3, 4), ('chirp', -5, 8), ('noise', 3, 4)):
+        record = check_seams(OfflineShifter(synthesize(kind, 44100, 20), 44100), 2**(semitones/12), workers)
+        assert record['passed'], (kind, semitones, workers, record)
+
+
+def test_unaligned_seams_fail():
+    for kind, semitones, workers in (('sine', 3, 4), ('chirp', -5, 8)):
+        record = check_seams(OfflineShifter(synthesize(kind, 44100, 20), 44100), 2**(semitones/12), workers, blend=0)
+        assert not record['passed'], (kind, semitones, workers, record)
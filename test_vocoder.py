@@ -0,0 +1,18 @@
+import numpy as np
+from utils import make_vocoder
+
+
+def peakless_frames(channels=None, window_size=4096, seed=0):
+    """Two frames whose magnitudes all sit under the peak threshold, e.g. silence or a quiet intro"""
+    rng = np.random.default_rng(seed)
+    shape = (window_size//2 + 1,) if channels is None else (channels, window_size//2 + 1)
+    return [rng.uniform(0, 0.01, shape) * np.exp(1j * rng.uniform(-np.pi, np.pi, shape)) for _ in range(2)]
+
+
+def test_peakless_frame_matches_basic():
+    for channels, ratio in ((None, 2**(3/12)), (2, 2**(3/12)), (3, [2**(4/12), 2**(7/12), 2**(-5/12)])):
+        peak = make_vocoder('peak', 4096, ratio, channels=channels)
+        basic = make_vocoder('basic', 4096, ratio, channels=channels)
+        for frame in peakless_frames(channels):
+            np.testing.assert_allclose(peak.calc_phase(frame.copy()), basic.calc_phase(frame.copy()), atol=1e-9)
+        np.testing.assert_allclose(peak.accum_phase, basic.accum_phase, atol=1e-9)
@@ -1,16 +1,153 @@
-import librosa
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import soundfile as sf
-import sys
-import pyrubberband as pyrb
+from cache import DecodedCache
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.m4a', '.aiff')
+ENGINES = ('rubberband', 'vocoder')
+BLOCK = 1<<16 #frames per write when streaming a result to disk
+
+
+def find_songs(paths):
+    """Files as given, directories walked for audio files --> sorted list of paths"""
+    songs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                songs += [os.path.join(root, n) for n in names if n.lower().endswith(AUDIO_EXTENSIONS)]
+        else:
+            songs.append(path)
+    return sorted(songs)
+
+
+def output_path(song, semitones, out_dir=None):
+    """Same naming as before --> song.mp3 shifted by 2 becomes song2.wav, next to it unless out_dir"""
+    name = os.path.splitext(song)[0] + f'{semitones:g}' + '.wav'
+    return os.path.join(out_dir, os.path.basename(name)) if out_dir else name
+
+
+def up_to_date(song, out_path):
+    return os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(song)
+
+
+def decode_job(song, cache_dir):
+    """Worker job --> decodes once into the cache, every target of the song then memory-maps the same .npy"""
+    signal, samp_freq = DecodedCache(cache_dir, max_bytes=1<<62).load(song, mono=False)
+    return str(signal.filename), samp_freq, signal.shape
+
+
+def shift_job(signal_path, channel, samp_freq, semitones, engine, result_path):
+    """Worker job --> shifts one channel and writes it into its column of the song's result memmap"""
+    signal = np.load(signal_path, mmap_mode='r')
+    samples = np.ascontiguousarray(signal[:, channel])
+    if engine == 'rubberband':
+        import pyrubberband as pyrb
+        shifted = pyrb.pitch_shift(samples, samp_freq, semitones)
+    else:
+        from offline import OfflineShifter
+        shifted = OfflineShifter(samples, samp_freq).render(2**(semitones/12))
+    result = np.load(result_path, mmap_mode='r+')
+    n = min(len(shifted), len(result))
+    result[:n, channel] = shifted[:n]
+    result[n:, channel] = 0
+    result.flush()
+    return len(signal) / samp_freq
+
+
+def write_wav(result_path, out_path, samp_freq):
+    """Streams the finished memmap into a WAV block by block, then swaps it in atomically"""
+    result = np.load(result_path, mmap_mode='r')
+    tmp_path = out_path + '.tmp'
+    with sf.SoundFile(tmp_path, 'w', samplerate=samp_freq, channels=result.shape[1], format='WAV') as f:
+        for start in range(0, len(result), BLOCK):
+            f.write(result[start:start+BLOCK])
+    os.replace(tmp_path, out_path)
+    os.remove(result_path)
+
+
+def transpose_batch(paths, pitches, out_dir=None, workers=None, engine='rubberband', force=False, cache_dir=None, log=print):
+    """Writes every song in paths at every semitone in pitches --> (audio seconds written, wall seconds).
+    (song, pitch, channel) jobs run on a process pool sized to the cores; each song is decoded once.
+    cache_dir: Keep decoded songs there (e.g. the player's DecodedCache directory) instead of a temporary one"""
+    assert engine in ENGINES, f"Unknown engine {engine}, choose from {ENGINES}"
+    start = time.perf_counter()
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='transpose_')
+    cache_dir = cache_dir or os.path.join(work_dir, 'decoded')
+    todo = {}   #song -> pitches still to write
+    for song in find_songs(paths):
+        stale = [p for p in pitches if force or not up_to_date(song, output_path(song, p, out_dir))]
+        if stale:
+            todo[song] = stale
+        for p in pitches:
+            if p not in stale:
+                log(f'up to date  {output_path(song, p, out_dir)}')
+    audio_seconds = 0.0
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            decoding = {pool.submit(decode_job, song, cache_dir): song for song in todo}
+            shifting = {}   #future -> (song, pitch)
+            pending = {}    #(song, pitch) -> channel jobs left
+            for future in as_completed(decoding):
+                song = decoding[future]
+                signal_path, samp_freq, (frames, channels) = future.result()
+                for p in todo[song]:
+                    result_path = os.path.join(work_dir, f'{len(pending)}.npy')
+                    np.lib.format.open_memmap(result_path, mode='w+', dtype=np.float32, shape=(frames, channels)).flush()
+                    pending[(song, p)] = [channels, result_path, samp_freq]
+                    for c in range(channels):
+                        job = pool.submit(shift_job, signal_path, c, samp_freq, p, engine, result_path)
+                        shifting[job] = (song, p)
+            for future in as_completed(shifting):
+                song, p = shifting[future]
+                seconds = future.result()
+                job = pending[(song, p)]
+                job[0] -= 1
+                if job[0] == 0:
+                    out_path = output_path(song, p, out_dir)
+                    write_wav(job[1], out_path, job[2])
+                    audio_seconds += seconds
+                    log(f'wrote       {out_path}')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    wall = time.perf_counter() - start
+    log(f'{audio_seconds:.1f} audio-seconds in {wall:.1f} s --> {audio_seconds / max(wall, 1e-9):.1f}x real time')
+    return audio_seconds, wall
+
 
 def Transpose(file, pitch):
-    data, sr = librosa.load(file, sr=None, mono=False)
-    l = pyrb.pitch_shift(data[0], sr, pitch)#librosa.effects.pitch_shift(data[0], sr, n_steps =pitch, res_type="linear")
-    r = pyrb.pitch_shift(data[1], sr, pitch) #librosa.effects.pitch_shift(data[1], sr, n_steps =pitch, res_type="linear")
-    y_shifted = np.asfortranarray(np.array([l,r]))
-    sf.write(file=file[:-4] + str(pitch) + '.wav', data= np.swapaxes(y_shifted, 0,1), samplerate=sr, format='WAV')
+    """One song, one pitch, like the original script """
+    transpose_batch([file], [float(pitch)], workers=1)
+
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description='Pitch-shift songs or whole directories to several semitone targets in parallel')
+    parser.add_argument('paths', nargs='+', help='songs and/or directories of songs')
+    parser.add_argument('-p', '--pitch', nargs='+', type=float, help='semitone targets, e.g. -2 -1 1 2')
+    parser.add_argument('-o', '--out-dir', help='write here instead of next to each song')
+    parser.add_argument('-j', '--workers', type=int, help='processes, defaults to the number of cores')
+    parser.add_argument('--engine', choices=ENGINES, default='rubberband',
+                        help='rubberband (pyrubberband, as before) or vocoder (offline.OfflineShifter)')
+    parser.add_argument('--cache-dir', help='keep decoded songs here, e.g. to reuse them across runs')
+    parser.add_argument('-f', '--force', action='store_true', help='rewrite outputs that are already up to date')
+    args = parser.parse_args(argv)
+    if args.pitch is None: #old form: transpose.py song.mp3 2
+        try:
+            args.pitch = [float(args.paths.pop())]
+        except ValueError:
+            parser.error('give semitone targets with --pitch')
+        if not args.paths:
+            parser.error('no songs given')
+    transpose_batch(args.paths, args.pitch, args.out_dir, args.workers, args.engine, args.force, args.cache_dir)
 
 
-Transpose(sys.argv[1], sys.argv[2])
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 import numpy as np
-from scipy.signal import get_window
 from math import fmod, pi, floor, cos, sin
-from scipy.signal import find_peaks
 import heapq
+import time
+from telemetry import WINDOW, RFFT, RESCALE, PHASE, IRFFT
+
 
 def build_dft_rescale_lookup(n_bins, shift_factor):
     """
@@ -23,107 +24,239 @@ def build_dft_rescale_lookup(n_bins, shift_factor):
             break
     return shift_idx, max_bin
 
-def dft_rescale(x, n_bins, shift_idx, max_bin, phase_vocoder):
+def dft_rescale(x, n_bins, shift_idx, max_bin, phase_vocoder, stats=None):
     """
     Rescale spectrum using the lookup table.
-    x: Input segment in time domain
+    x: Input segment in time domain, or (channels, samples) to rescale every channel in one batch
     n_bins: Number of bins in positive half of DFT.
     shift_idx: Mapping from bin to rescaled bin.
     max_bin: Maximum bin until rescaled is less than `n_bins`.
+    stats: Optional telemetry.Telemetry --> marks the end of each stage on its running clock
     return: Pitch-shifted audio segment in time domain.
     """
     X = np.fft.rfft(x)
-    Y = np.zeros(n_bins, dtype=np.complex)
-    max_bin = min(max_bin, len(X))
-    Y[shift_idx[range(max_bin)]] += X[range(max_bin)]
+    if stats is not None: stats.mark(RFFT)
+    Y = np.zeros(X.shape[:-1] + (n_bins,), dtype=complex)
+    max_bin = min(max_bin, X.shape[-1])
+    Y[..., shift_idx[:max_bin]] += X[..., :max_bin]
+    if stats is not None: stats.mark(RESCALE)
     #Y[shift_idx[0]] = X[0]
     #parity = (len(X) % 2 == 0)
     #Y = np.r_[Y, np.conj(Y[-2:0:-1])] if parity else np.r_[Y, np.conj(Y[-1:0:-1])] <-- too slow
     Y = phase_vocoder.calc_phase(Y)
-    return np.fft.irfft(Y), phase_vocoder
-
-class PhaseVocoder2:
-    """Vectorized implementation of phase vocoder with peak detection --> no idea what I'm doing """
-    def __init__(self, window_size, pitch_ratio):
-        self.window_size = window_size
-        self.synthesis_hopsize = window_size//4
-        self.analysis_hopsize = int(self.synthesis_hopsize//pitch_ratio)
-        self.last_phase = np.zeros(window_size//2+1)
-        self.accum_phase = np.zeros(window_size//2+1)
-        self.expected_phase = np.linspace(0, window_size//2, window_size//2+1)*2*np.pi*self.analysis_hopsize//window_size  # expected phase
-        self.pk_indices = range(window_size//2)
-    def calc_phase(self, current_frame):
-        """Saves previous phase values for calculation of next frame"""
-        current_phase = np.angle(current_frame)
-        current_magn = abs(current_frame)
-        delta_phase = np.unwrap(current_phase - self.last_phase - self.expected_phase)
-        self.last_phase = current_phase.copy()
-        self.accum_phase[self.pk_indices] = self.accum_phase[self.pk_indices] + (delta_phase[self.pk_indices] + self.expected_phase[self.pk_indices])*self.synthesis_hopsize/self.analysis_hopsize
-        rotation_angle = self.accum_phase[self.pk_indices] - current_phase[self.pk_indices]
-        peak = np.array(self.pk_indices[0:-1])
-        next_peak = np.array(self.pk_indices[1:])
-        end_point = (peak + next_peak)//2
-        start_point = np.r_[0, end_point[:-1]]
-        M = [start_point, peak, end_point] #Pre-computed matrix
-        for k in range(len(self.pk_indices)-1):
-            ri_indices = [i for i in range(M[0][k], M[2][k]) if i!=M[1][k]]#np.r_[np.arange(M[0][k],M[1][k]) , np.arange(M[2][k],M[3][k])]
-            self.accum_phase[ri_indices] = rotation_angle[k] + current_phase[ri_indices]
-        ri_indices = range(end_point[-1], self.pk_indices[-1]) if len(end_point)>0 else []
-        self.accum_phase[ri_indices] = rotation_angle[len(self.pk_indices)-1] + current_phase[ri_indices]
-        self.pk_indices, _ = find_peaks(current_magn)
-        if len(self.pk_indices) == 0: self.pk_indices = [1]
-        return current_magn*np.exp(1j*self.accum_phase)
-    def update(self, pitch_ratio):
-        """ Called when pitch is changed """
-        self.analysis_hopsize = int(self.synthesis_hopsize//pitch_ratio)
-        self.expected_phase = np.linspace(0, self.window_size//2, self.window_size//2+1)*2*np.pi*self.analysis_hopsize//self.window_size
+    if stats is not None: stats.mark(PHASE)
+    y = np.fft.irfft(Y)
+    if stats is not None: stats.mark(IRFFT)
+    return y, phase_vocoder
 
+class FrameWorkspace:
+    """Preallocated buffers for one live hop --> window, rfft, rescale, phase and irfft without allocating.
+    Runs in dtype end to end (float32 by default, complex64 spectra); frames are (bins,) or (channels, bins).
+    Needs NumPy 2: rfft and irfft take out= and keep float32 in single precision only from 2.0 on"""
+    def __init__(self, grain_len, lead=(), dtype=np.float32):
+        self.grain_len = grain_len
+        self.n_bins = grain_len//2 + 1
+        self.window = np.zeros(lead + (grain_len,), dtype) #per channel, see PhaseVocoder.update on broadcasting
+        self.window[:] = np.hanning(grain_len)
+        self.windowed = np.zeros(lead + (grain_len,), dtype)
+        self.X = np.zeros(lead + (self.n_bins,), np.result_type(dtype, np.complex64))
+        self.Y = np.zeros_like(self.X)
+        self.grain = np.zeros(lead + (grain_len,), dtype)
+        self.shift_idx = None
+        #a cached analysis frame, with a zero bin past the end for resynthesize's gather
+        self.magn = np.zeros(lead + (self.n_bins + 1,), dtype)
+        self.phase = np.zeros(lead + (self.n_bins + 1,), dtype)
+    def set_lookup(self, shift_idx, max_bin):
+        """Caches the destination bins as intp --> an int16 index array would be converted on every hop.
+        src is the inverse map, the source bin of every destination bin (n_bins, the zero bin, where there is none)"""
+        self.shift_idx = shift_idx
+        self.max_bin = min(max_bin, self.n_bins)
+        self.dest = shift_idx[:self.max_bin].astype(np.intp)
+        self.src = np.full(self.n_bins, self.n_bins, dtype=np.intp)
+        self.src[self.dest] = np.arange(self.max_bin) #same last-write-wins as rescale when bins collide
+    def rescale(self, x, shift_idx, max_bin, phase_vocoder, stats=None):
+        """dft_rescale(x*window, ...) into self.grain --> the vocoder must use the same dtype"""
+        if shift_idx is not self.shift_idx:
+            self.set_lookup(shift_idx, max_bin)
+        np.multiply(x, self.window, out=self.windowed)
+        if stats is not None: stats.mark(WINDOW)
+        #norm='forward' hands pocketfft a float32 scale, the default one upcasts through a complex128 temporary.
+        #Multiplying back by grain_len is exact for power-of-two grains
+        np.fft.rfft(self.windowed, out=self.X, norm='forward')
+        self.X *= self.grain_len
+        if stats is not None: stats.mark(RFFT)
+        self.Y.fill(0)
+        self.Y[..., self.dest] = self.X[..., :self.max_bin]
+        if stats is not None: stats.mark(RESCALE)
+        phase_vocoder.calc_phase(self.Y, out=self.Y)
+        if stats is not None: stats.mark(PHASE)
+        np.fft.irfft(self.Y, n=self.grain_len, out=self.grain)
+        if stats is not None: stats.mark(IRFFT)
+        return self.grain
+    def resynthesize(self, frame, shift_idx, max_bin, phase_vocoder, stats=None):
+        """rescale from a cached analysis frame, e.g. analysis.AnalysisCache's --> frame[0] magnitudes and frame[1]
+        phases of the windowed grain, gathered straight into the vocoder so window, rfft and the split are skipped"""
+        if shift_idx is not self.shift_idx:
+            self.set_lookup(shift_idx, max_bin)
+        self.magn[..., :-1] = frame[0]
+        self.phase[..., :-1] = frame[1]
+        if stats is not None: stats.mark(RFFT)
+        np.take(self.magn, self.src, axis=-1, out=phase_vocoder.current_magn, mode='clip')
+        np.take(self.phase, self.src, axis=-1, out=phase_vocoder.current_phase, mode='clip')
+        if stats is not None: stats.mark(RESCALE)
+        phase_vocoder.propagate(out=self.Y)
+        if stats is not None: stats.mark(PHASE)
+        np.fft.irfft(self.Y, n=self.grain_len, out=self.grain)
+        if stats is not None: stats.mark(IRFFT)
+        return self.grain
 
 class PhaseVocoder:
-    """Vectorized implementation of phase vocoder with peak detection --> no idea what I'm doing """
-    def __init__(self, window_size, pitch_ratio):
-        self.pitch_ratio = pitch_ratio
+    """Vectorized implementation of phase vocoder with peak detection --> no idea what I'm doing
+    Engine contract (see ENGINES): calc_phase(frame, out), update(pitch_ratio), reset(), set_mode(mode) for MODES"""
+    MODES = ('heap', 'array', 'basic') #phase integration engines of this class
+    def __init__(self, window_size, pitch_ratio, mode='heap', threshold=0.05, channels=None, dtype=np.float64):
+        """channels keeps one phase state per channel --> frames are then (channels, bins) instead of (bins,)
+        pitch_ratio: One ratio, or one per channel (e.g. harmonizer voices)
+        dtype: Precision of the phase state and of every per-frame buffer, all preallocated here"""
         self.window_size = window_size
+        self.set_mode(mode)
+        self.threshold = threshold
+        self.dtype = dtype
         self.synthesis_hopsize = window_size//4
-        self.analysis_hopsize = int(self.synthesis_hopsize//pitch_ratio)
         self.HALF_FFT = window_size//2+1
-        self.last_phase = np.zeros(self.HALF_FFT) #frame n − 1
-        self.accum_phase = np.zeros(self.HALF_FFT)
-        self.last_accum_phase = np.zeros(self.HALF_FFT)
-        self.expected_phase = np.linspace(0, window_size//2, self.HALF_FFT)*2*np.pi*self.analysis_hopsize//window_size  # expected phase (2049,)
-        self.last_magnitudes = np.zeros(self.HALF_FFT) #frame n − 1
-    def calc_phase(self, current_frame):
-        """Saves previous phase values for calculation of next frame"""
-        current_phase = np.angle(current_frame)
-        current_magn = abs(current_frame)
-        delta_phase = np.unwrap(current_phase - self.last_phase - self.expected_phase)
-        phase_derivative = self.expected_phase + delta_phase
-        frequency_derivative = (np.r_[current_phase[0] - self.last_phase[-1], (current_phase[1:] - current_phase[:-1])] )
+        self.channels = channels
+        shape = (self.HALF_FFT,) if channels is None else (channels, self.HALF_FFT)
+        self.last_phase = np.zeros(shape, dtype) #frame n − 1
+        self.accum_phase = np.zeros(shape, dtype)
+        self.last_accum_phase = np.zeros(shape, dtype)
+        self.update(pitch_ratio)
+        self.last_magnitudes = np.zeros(shape, dtype) #frame n − 1
+        #workspace, reused every frame
+        self.current_phase = np.zeros(shape, dtype)
+        self.current_magn = np.zeros(shape, dtype)
+        self.phase_derivative = np.zeros(shape, dtype)
+        self.frequency_derivative = np.zeros(shape, dtype)
+        self.scratch = np.zeros(shape, dtype)
+        self.scratch2 = np.zeros(shape, dtype)
+        self.mask = np.zeros(shape, dtype=bool)
+        self.mask2 = np.zeros(shape, dtype=bool)
+        self.scan = None    #ScanWorkspace, made on the first 'array' frame
+    def calc_phase(self, current_frame, out=None):
+        """Saves previous phase values for calculation of next frame.
+        out: Where to write the new frame, may be current_frame itself --> no allocation at all (bar the heap engine)"""
+        np.arctan2(current_frame.imag, current_frame.real, out=self.current_phase) #np.angle
+        np.abs(current_frame, out=self.current_magn)
+        return self.propagate(out)
+    def propagate(self, out=None):
+        """calc_phase for a frame already split into current_phase and current_magn, e.g. gathered from a shared analysis"""
+        current_phase, current_magn = self.current_phase, self.current_magn
+        phase_derivative = self.phase_derivative
+        np.subtract(current_phase, self.last_phase, out=phase_derivative)
+        phase_derivative -= self.expected_phase
+        self.unwrap(phase_derivative) #delta_phase
+        phase_derivative += self.expected_phase
+        frequency_derivative = self.frequency_derivative
+        np.subtract(current_phase[..., :1], self.last_phase[..., -1:], out=frequency_derivative[..., :1])
+        for phase, derivative in zip(current_phase.reshape(-1, self.HALF_FFT), frequency_derivative.reshape(-1, self.HALF_FFT)):
+            np.subtract(phase[1:], phase[:-1], out=derivative[1:]) #1-D rows, see unwrap
         #self.accum_phase += phase_derivative*(self.synthesis_hopsize/self.analysis_hopsize) #phi(k, n+1)
-        self.Gradient_Heap(current_magn, phase_derivative, frequency_derivative)
-        self.last_accum_phase = self.accum_phase.copy()
-        self.last_phase = current_phase
-        self.last_magnitudes = current_magn
-        return current_magn*np.exp(1j*self.accum_phase)
+        self.integrate(current_magn, phase_derivative, frequency_derivative)
+        #Keep phases in [-pi, pi) --> they grow by up to pi*window/4 a frame, which float32 cannot hold for long
+        self.accum_phase += pi
+        np.mod(self.accum_phase, 2*pi, out=self.accum_phase)
+        self.accum_phase -= pi
+        np.copyto(self.last_accum_phase, self.accum_phase)
+        self.last_phase, self.current_phase = current_phase, self.last_phase
+        self.last_magnitudes, self.current_magn = current_magn, self.last_magnitudes
+        if out is None:
+            out = np.empty(current_magn.shape, dtype=np.result_type(self.dtype, np.complex64))
+        np.cos(self.accum_phase, out=self.scratch)
+        np.multiply(current_magn, self.scratch, out=out.real)
+        np.sin(self.accum_phase, out=self.scratch)
+        np.multiply(current_magn, self.scratch, out=out.imag)
+        return out
+    def integrate(self, current_magn, phase_derivative, frequency_derivative):
+        """New accum_phase from the unwrapped time and frequency derivatives of the current frame """
+        if self.mode == 'basic': #time integration only, i.e. a classic phase vocoder --> cheapest, most phasey
+            np.multiply(phase_derivative, self.ratio, out=self.accum_phase)
+            self.accum_phase += self.last_accum_phase
+        elif self.mode == 'array': #batched over channels
+            self.Gradient_Array(current_magn, phase_derivative, frequency_derivative, self.threshold)
+        elif self.channels is None:
+            self.Gradient_Heap(current_magn, phase_derivative, frequency_derivative, self.threshold)
+        else:
+            for c in range(self.channels):
+                self.Gradient_Heap(current_magn[c], phase_derivative[c], frequency_derivative[c], self.threshold, c)
+    def unwrap(self, p):
+        """In-place np.unwrap along the bins, same arithmetic but through the preallocated scratch buffers.
+        (channels, bins) frames go row by row --> ufuncs on 2-D [..., 1:] views buffer the whole frame past 8192 values"""
+        if p.ndim == 1:
+            return self.unwrap_row(p, self.scratch, self.scratch2, self.mask, self.mask2)
+        for row in zip(p, self.scratch, self.scratch2, self.mask, self.mask2):
+            self.unwrap_row(*row)
+    @staticmethod
+    def unwrap_row(p, scratch, scratch2, mask, mask2):
+        dd, correct = scratch[1:], scratch2[1:]
+        ambiguous, positive = mask[1:], mask2[1:]
+        np.subtract(p[1:], p[:-1], out=dd)
+        np.add(dd, pi, out=correct)
+        np.mod(correct, 2*pi, out=correct)
+        correct -= pi
+        np.equal(correct, -pi, out=ambiguous)
+        np.greater(dd, 0, out=positive)
+        ambiguous &= positive
+        np.copyto(correct, pi, where=ambiguous)
+        correct -= dd
+        np.abs(dd, out=dd)
+        np.less(dd, pi, out=ambiguous)
+        np.copyto(correct, 0, where=ambiguous)
+        np.cumsum(correct, out=correct)
+        p[1:] += correct
     def update(self, pitch_ratio):
-        """ Called when pitch is changed """
+        """ Called when pitch is changed --> one ratio, or one per channel """
         self.pitch_ratio = pitch_ratio
-        self.analysis_hopsize = int(self.synthesis_hopsize//pitch_ratio)
-        self.expected_phase = np.linspace(0, self.window_size//2, self.HALF_FFT)*2*np.pi*self.analysis_hopsize//self.window_size
-    def Gradient_Heap(self, current_magn, phase_derivative, frequency_derivative, threshold=0.05):
+        bins = np.linspace(0, self.window_size//2, self.HALF_FFT)
+        #full (channels, bins) copies, broadcasting a 1-D operand in place makes NumPy buffer the whole frame
+        self.expected_phase = np.zeros(self.last_phase.shape, self.dtype)
+        if np.ndim(pitch_ratio) == 0:
+            self.ratio = pitch_ratio
+            self.analysis_hopsize = int(self.synthesis_hopsize//pitch_ratio)
+            self.expected_phase[:] = bins*2*np.pi*self.analysis_hopsize//self.window_size
+            return
+        assert len(pitch_ratio) == self.channels, "One pitch ratio per channel"
+        self.analysis_hopsize = [int(self.synthesis_hopsize//r) for r in pitch_ratio]
+        self.ratio = np.zeros(self.last_phase.shape, self.dtype)
+        for c, r in enumerate(pitch_ratio):
+            self.ratio[c] = r
+            self.expected_phase[c] = bins*2*np.pi*self.analysis_hopsize[c]//self.window_size
+    def reset(self):
+        """Forgets every previous frame --> the next one is integrated as if by a new vocoder"""
+        for state in (self.last_phase, self.accum_phase, self.last_accum_phase, self.last_magnitudes):
+            state.fill(0)
+    def set_mode(self, mode):
+        """ Switches phase integration engine between frames --> 'heap' (reference), 'array' (vectorized)
+        or 'basic' (no propagation across frequency). Engines of another class need switch_engine """
+        assert mode in self.MODES, f"Unknown phase mode {mode} for {type(self).__name__}, choose from {self.MODES}"
+        self.mode = mode
+    def Gradient_Heap(self, current_magn, phase_derivative, frequency_derivative, threshold=0.05, channel=None):
         """Implementation gradient propagation algorithm - Makes all magnitudes negative for Max heap.
         Lower threshold = better audio quality but slower performance
         (0 threshold  not fast enough to stream at 128kbps)"""
-        #threshold = threshold* max( current_magn.max(), self.last_magnitudes.max() )
+        accum_phase, last_accum_phase, last_magnitudes = self.accum_phase, self.last_accum_phase, self.last_magnitudes
+        pitch_ratio = self.ratio
+        if channel is not None:
+            accum_phase, last_accum_phase, last_magnitudes = accum_phase[channel], last_accum_phase[channel], last_magnitudes[channel]
+            pitch_ratio = pitch_ratio if np.ndim(pitch_ratio) == 0 else pitch_ratio[channel, 0]
+        #threshold = threshold* max( current_magn.max(), last_magnitudes.max() )
         heap = []
         I = set()
         for i in range(self.HALF_FFT):
-            if self.last_magnitudes[i] > threshold:
-                heapq.heappush(heap, (-self.last_magnitudes[i], i, 0) )
+            if last_magnitudes[i] > threshold:
+                heapq.heappush(heap, (-last_magnitudes[i], i, 0) )
             if current_magn[i] > threshold:
                 I.add( (i, 1) )
-        # previous_indices = np.where( self.last_magnitudes > threshold )[0]
-        # heap = list( zip(self.last_magnitudes[previous_indices] * -1, previous_indices, np.zeros(previous_indices.shape[0]) ) )
+        # previous_indices = np.where( last_magnitudes > threshold )[0]
+        # heap = list( zip(last_magnitudes[previous_indices] * -1, previous_indices, np.zeros(previous_indices.shape[0]) ) )
         # heapq.heapify(heap) # initialize with all elements from frame n - 1
         # current_indices = np.where( current_magn > threshold )[0]
         # I = set( zip( current_indices, np.ones(current_indices.shape[0]) ) ) #visited
@@ -131,15 +264,241 @@ class PhaseVocoder:
             G, k, n = heapq.heappop(heap)
             if n == 0:
                 if (k, n+1) in I:
-                    self.accum_phase[k] = self.last_accum_phase[k] + phase_derivative[k] * self.pitch_ratio
+                    accum_phase[k] = last_accum_phase[k] + phase_derivative[k] * pitch_ratio
                     I.remove( (k, n+1) )
                     heapq.heappush( heap, (-current_magn[k], k , n+1) )
             if n == 1:
                 if (k+1, n) in I:
-                    self.accum_phase[k + 1] = self.accum_phase[k] +  frequency_derivative[k + 1] * self.pitch_ratio
+                    accum_phase[k + 1] = accum_phase[k] +  frequency_derivative[k + 1] * pitch_ratio
                     I.remove( (k+1, n) )
                     heapq.heappush( heap, (-current_magn[k+1], k+1 , n) )
                 if (k-1, n) in I:
-                    self.accum_phase[k - 1] = self.accum_phase[k] +  frequency_derivative[k - 1] * self.pitch_ratio
+                    accum_phase[k - 1] = accum_phase[k] +  frequency_derivative[k - 1] * pitch_ratio
                     I.remove( (k-1, n) )
                     heapq.heappush( heap, (-current_magn[k-1], k-1 , n) )
+    def Gradient_Array(self, current_magn, phase_derivative, frequency_derivative, threshold=0.05):
+        """Same propagation as Gradient_Heap with bulk thresholding on NumPy arrays instead of a heap.
+        Popping the heap in magnitude order means every bin ends up integrated from the seed with the
+        widest path (largest min magnitude) to it, so both sweeps are done as max-min scans.
+        (channels, bins) frames are scanned as one flat array with propagation blocked between channels."""
+        if self.scan is None:
+            self.scan = ScanWorkspace(current_magn.size, self.dtype)
+        ws = self.scan
+        magn = current_magn.ravel()
+        last_magn = self.last_magnitudes.ravel()
+        valid, seeds = ws.valid, ws.seeds
+        np.greater(magn, threshold, out=valid)
+        np.greater(last_magn, threshold, out=seeds)
+        seeds &= valid
+        if not seeds.any():
+            return
+        level = ws.level
+        level.fill(-np.inf)
+        np.copyto(level, last_magn, where=seeds)
+        left_level, left_src, right_level, right_src = ws.left_level, ws.left_src, ws.right_level, ws.right_src
+        widest_path_scan(level, magn, valid, self.HALF_FFT, ws, left_level, left_src)
+        widest_path_scan(level[::-1], magn[::-1], valid[::-1], self.HALF_FFT, ws, right_level[::-1], ws.src)
+        np.subtract(len(level) - 1, ws.src[::-1], out=right_src)
+        reached, from_left, tmp = ws.reached, ws.from_left, ws.tmp
+        np.maximum(left_level, right_level, out=tmp)
+        np.greater(tmp, -np.inf, out=reached)
+        np.greater_equal(left_level, right_level, out=from_left)
+        # phi(t) from time integration at the seed, then summed frequency derivatives out to each bin
+        seed_phase, cumsum, cumsum_prev = ws.seed_phase, ws.cumsum, ws.cumsum_prev
+        np.multiply(phase_derivative, self.ratio, out=seed_phase.reshape(current_magn.shape))
+        seed_phase += self.last_accum_phase.ravel()
+        cumsum2d, cumsum_prev2d = cumsum.reshape(current_magn.shape), cumsum_prev.reshape(current_magn.shape)
+        np.cumsum(frequency_derivative, axis=-1, out=cumsum2d)
+        cumsum2d *= self.ratio
+        cumsum_prev2d[..., 0] = 0
+        cumsum_prev2d[..., 1:] = cumsum2d[..., :-1]
+        left_phase, right_phase = ws.left_phase, ws.right_phase
+        np.take(seed_phase, left_src, out=left_phase, mode='clip') #seed_phase[left_src] + cumsum - cumsum[left_src]
+        left_phase += cumsum
+        np.take(cumsum, left_src, out=tmp, mode='clip')
+        left_phase -= tmp
+        np.take(seed_phase, right_src, out=right_phase, mode='clip') #seed_phase[right_src] + cumsum_prev[right_src] - cumsum_prev
+        np.take(cumsum_prev, right_src, out=tmp, mode='clip')
+        right_phase += tmp
+        right_phase -= cumsum_prev
+        np.copyto(right_phase, left_phase, where=from_left)
+        np.copyto(self.accum_phase.reshape(-1), right_phase, where=reached)
+
+
+class ScanWorkspace:
+    """Buffers for Gradient_Array and widest_path_scan over n flat bins --> allocated once per vocoder"""
+    def __init__(self, n, dtype=np.float64):
+        for name in ('level', 'left_level', 'right_level', 'c', 'carry', 'tmp', 'seed_phase', 'cumsum', 'cumsum_prev',
+                     'left_phase', 'right_phase'):
+            setattr(self, name, np.zeros(n, dtype))
+        for name in ('left_src', 'right_src', 'src'):
+            setattr(self, name, np.zeros(n, dtype=np.intp))
+        for name in ('valid', 'seeds', 'reached', 'from_left', 'from_prev', 'link'):
+            setattr(self, name, np.zeros(n, dtype=bool))
+        self.arange = np.arange(n)
+
+
+def widest_path_scan(level, magn, valid, n_bins=None, ws=None, a=None, src=None):
+    """
+    Prefix max-min scan: best level reaching each bin from a seed at or before it.
+    level: Seed level per bin (-inf where not a seed).
+    magn: Magnitude of each bin, bounds propagation out of it.
+    valid: Bins allowed to take part in propagation.
+    n_bins: Length of each spectrum when several are laid end to end --> nothing propagates across them.
+    ws, a, src: Optional ScanWorkspace and output arrays, so repeated scans do not allocate.
+    return: (level, source seed index) for each bin.
+    Each bin is the map x -> max(a, min(x, c)); these compose associatively, so log2(n_bins) doubling steps.
+    """
+    n_bins = n_bins or len(level)
+    ws = ws or ScanWorkspace(len(level), level.dtype)
+    a = np.empty_like(level) if a is None else a
+    src = np.empty(len(level), dtype=np.intp) if src is None else src
+    c, carry, tmp = ws.c, ws.carry, ws.tmp
+    np.copyto(a, level)
+    np.logical_and(valid[1:], valid[:-1], out=ws.link[1:])
+    c.fill(-np.inf)
+    np.copyto(c[1:], magn[:-1], where=ws.link[1:])
+    c[::n_bins] = -np.inf
+    np.copyto(carry, c)
+    shift = 1
+    while shift < n_bins:
+        np.minimum(a[:-shift], c[shift:], out=tmp[shift:])
+        np.maximum(a[shift:], tmp[shift:], out=a[shift:])
+        np.minimum(c[shift:], c[:-shift], out=tmp[shift:])
+        np.copyto(c[shift:], tmp[shift:])
+        shift *= 2
+    # Each bin came either from its own seed or from its left neighbour --> the seed is the nearest own-seeded bin
+    from_prev = ws.from_prev
+    from_prev[0] = False
+    np.minimum(a[:-1], carry[1:], out=tmp[1:])
+    np.greater(tmp[1:], level[1:], out=from_prev[1:])
+    np.copyto(src, ws.arange)
+    np.copyto(src, 0, where=from_prev)
+    np.maximum.accumulate(src, out=src)
+    return a, src
+
+
+class PhaseVocoder2(PhaseVocoder):
+    """Peak-locked phase vocoder (identity phase locking, Laroche & Dolson) --> a tier between 'array' and 'basic'.
+    Spectral peaks are integrated in time like 'basic'; every other bin keeps its analysis phase offset to the
+    nearest peak, so each peak's region rotates as one. Peaks are local maxima above threshold, regions are found
+    with running max/min scans over bin indices instead of a loop per peak. Allocation-free like PhaseVocoder."""
+    MODES = ('peak',)
+    def __init__(self, window_size, pitch_ratio, mode='peak', threshold=0.05, channels=None, dtype=np.float64):
+        super().__init__(window_size, pitch_ratio, mode, threshold, channels, dtype)
+        shape = self.last_phase.shape
+        self.peaks = np.zeros(shape, dtype=bool)
+        self.bins = np.zeros(shape, dtype=np.intp)
+        self.bins[:] = np.arange(self.HALF_FFT)
+        self.offsets = np.zeros(shape, dtype=np.intp) #start of each channel in the flat frame
+        self.offsets[:] = (np.arange(channels)[:, None] if channels else 0) * self.HALF_FFT
+        self.left = np.zeros(shape, dtype=np.intp)
+        self.right = np.zeros(shape, dtype=np.intp)   #filled back to front, see integrate
+        self.dist = np.zeros(shape, dtype=np.intp)
+        self.dist2 = np.zeros(shape, dtype=np.intp)
+    def integrate(self, current_magn, phase_derivative, frequency_derivative):
+        n = self.HALF_FFT
+        accum, peaks, mask = self.accum_phase, self.peaks, self.mask
+        np.multiply(phase_derivative, self.ratio, out=accum) #every bin as in 'basic', peaks keep theirs
+        accum += self.last_accum_phase
+        peaks.fill(False)
+        np.greater(current_magn[..., 1:-1], current_magn[..., :-2], out=peaks[..., 1:-1])
+        np.greater_equal(current_magn[..., 1:-1], current_magn[..., 2:], out=mask[..., 1:-1])
+        peaks &= mask
+        np.greater(current_magn, self.threshold, out=mask)
+        peaks &= mask
+        # Nearest peak at or below each bin (running max) and at or above it (running min over the reversed bins)
+        left, right, bins = self.left, self.right[..., ::-1], self.bins
+        left.fill(-n)
+        np.copyto(left, bins, where=peaks)
+        np.maximum.accumulate(left, axis=-1, out=left)
+        self.right.fill(2*n)
+        np.copyto(right, bins, where=peaks)
+        np.minimum.accumulate(self.right, axis=-1, out=self.right)
+        np.copyto(self.dist2, right) #arithmetic on the reversed view would go through a buffer
+        right = self.dist2
+        np.subtract(bins, left, out=self.dist)
+        np.subtract(right, bins, out=self.right)
+        np.greater(self.dist, self.right, out=mask)
+        owner = left
+        np.copyto(owner, right, where=mask)
+        #no peak at all in the channel --> left is -n and right 2n everywhere, bins stay on their own
+        np.greater_equal(owner, n, out=mask)
+        np.less(owner, 0, out=peaks) #peaks are spent, reuse them as the second mask
+        mask |= peaks
+        np.copyto(owner, bins, where=mask)
+        owner += self.offsets
+        # phi(k) = phi(peak) + (analysis phase(k) - analysis phase(peak))
+        peak_phase, offset = self.scratch2.reshape(-1), self.scratch.reshape(-1)
+        np.take(accum.reshape(-1), owner.reshape(-1), out=peak_phase, mode='clip')
+        np.take(self.current_phase.reshape(-1), owner.reshape(-1), out=offset, mode='clip')
+        np.subtract(self.current_phase, self.scratch, out=self.scratch)
+        np.add(self.scratch2, self.scratch, out=accum)
+
+
+#Phase engines by name --> (vocoder class, quality tier). Tier 0 sounds best, higher tiers are cheaper and rougher.
+#'heap' and 'array' give the same output, 'array' is the vectorized one
+ENGINES = {}
+ENGINE_COSTS = {}   #(mode, window_size, channels, dtype name) --> measured seconds per frame
+
+def register_engine(mode, cls, tier):
+    """Makes an engine choosable by name --> cls follows the PhaseVocoder contract with mode in cls.MODES"""
+    assert mode in cls.MODES, f"{cls.__name__} does not implement mode {mode}"
+    ENGINES[mode] = (cls, tier)
+
+register_engine('heap', PhaseVocoder, 0)
+register_engine('array', PhaseVocoder, 0)
+register_engine('peak', PhaseVocoder2, 1)
+register_engine('basic', PhaseVocoder, 2)
+PHASE_MODES = tuple(ENGINES) #built-in engines
+
+def make_vocoder(mode, window_size, pitch_ratio, threshold=0.05, channels=None, dtype=np.float64, like=None):
+    """Vocoder for engine `mode`.
+    like: Vocoder to take sizes, threshold and phase state from --> switching engines mid-stream keeps the phases"""
+    assert mode in ENGINES, f"Unknown phase mode {mode}, choose from {tuple(ENGINES)}"
+    if like is not None:
+        window_size, pitch_ratio, threshold = like.window_size, like.pitch_ratio, like.threshold
+        channels, dtype = like.channels, like.dtype
+    vocoder = ENGINES[mode][0](window_size, pitch_ratio, mode=mode, threshold=threshold, channels=channels, dtype=dtype)
+    if like is not None:
+        for name in ('last_phase', 'accum_phase', 'last_accum_phase', 'last_magnitudes'):
+            np.copyto(getattr(vocoder, name), getattr(like, name))
+    return vocoder
+
+def switch_engine(vocoder, mode):
+    """Vocoder running engine `mode` --> the same one if its class has the mode, else a new one with its state"""
+    if mode in type(vocoder).MODES:
+        vocoder.set_mode(mode)
+        return vocoder
+    return make_vocoder(mode, None, None, like=vocoder)
+
+def measure_engine(mode, window_size=4096, channels=None, dtype=np.float32, frames=24, threshold=0.05):
+    """Median seconds per frame of engine `mode` on a synthetic harmonic signal --> cached per process.
+    Only the phase stage differs between engines, the FFTs around it cost the same for all"""
+    key = (mode, window_size, channels, np.dtype(dtype).name)
+    if key not in ENGINE_COSTS:
+        stride = window_size // 4
+        t = np.arange(window_size + stride * frames) / 44100
+        signal = sum(np.sin(2*np.pi*220*h*t) / h for h in range(1, 9)) + 0.01*np.random.default_rng(0).standard_normal(len(t))
+        window = np.hanning(window_size)
+        vocoder = make_vocoder(mode, window_size, 2**(4/12), threshold, channels, dtype)
+        spectra = [np.fft.rfft(signal[i*stride:i*stride + window_size] * window) for i in range(frames)]
+        out = np.zeros(vocoder.last_phase.shape, np.result_type(dtype, np.complex64))
+        times = []
+        for X in spectra:
+            frame = np.zeros_like(out)
+            frame[:] = X
+            start = time.perf_counter()
+            vocoder.calc_phase(frame, out=out)
+            times.append(time.perf_counter() - start)
+        ENGINE_COSTS[key] = float(np.median(times[2:]))
+    return ENGINE_COSTS[key]
+
+def choose_engine(budget, window_size=4096, channels=None, dtype=np.float32, modes=None):
+    """Best tier whose measured cost per frame fits budget seconds, the fastest of that tier --> cheapest if none fits"""
+    modes = list(modes or ENGINES)
+    costs = {mode: measure_engine(mode, window_size, channels, dtype) for mode in modes}
+    fitting = [mode for mode in modes if costs[mode] <= budget]
+    if not fitting:
+        return min(modes, key=costs.get)
+    return min(fitting, key=lambda mode: (ENGINES[mode][1], costs[mode]))
@@ -0,0 +1,75 @@
+import numpy as np
+from spectrum import LogBinner
+
+
+class SpectrumVisualizer:
+    """Waveform and log-frequency spectrum of the playing shifter, redrawn with blitting on the Tk main loop.
+    Reads PitchShifter.tap --> never touches the audio thread, never recomputes an FFT.
+    Only the two line artists are redrawn each frame onto a cached background, both with a fixed point count,
+    and frames are skipped while the engine has published nothing new (paused, between songs)"""
+    def __init__(self, canvas, fig, fps=30, n_points=128, db_range=(-20, 80)):
+        self.canvas = canvas    #FigureCanvasTkAgg holding fig
+        self.fig = fig
+        self.interval = int(1000 / fps)
+        self.n_points = n_points
+        self.db_range = db_range
+        self.shifter = None
+        self.job = None
+        self.background = None
+        self.seq = -1
+        self.drawn = self.skipped = 0
+        self.ax_wave = fig.add_subplot(211)
+        self.ax_spec = fig.add_subplot(212)
+        self.wave, = self.ax_wave.plot(np.arange(n_points), np.zeros(n_points), animated=True)
+        self.ax_wave.set_ylim([-2, 2])
+        self.ax_wave.set_xticks([])
+        self.spec, = self.ax_spec.plot([1, 2], [0, 0], color="red", animated=True)
+        self.ax_spec.set_xscale('log')
+        self.ax_spec.set_ylim(db_range)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def attach(self, shifter):
+        """Follows a new shifter, e.g. after a song change --> rebuilds the buffers sized for it"""
+        self.shifter = shifter
+        tap = shifter.tap
+        self.magn = np.empty_like(tap.magn[0])
+        self.block = np.empty_like(tap.block[0])
+        self.binner = LogBinner(len(self.magn), shifter.samp_freq, self.n_points, floor_db=self.db_range[0])
+        self.step = max(len(self.block) // self.n_points, 1)
+        n_wave = len(self.block[::self.step])
+        self.wave.set_data(np.arange(n_wave), np.zeros(n_wave))
+        self.ax_wave.set_xlim([0, n_wave - 1])
+        self.spec.set_data(self.binner.freqs, np.full(self.binner.n_points, self.db_range[0]))
+        self.ax_spec.set_xlim([self.binner.freqs[0], self.binner.freqs[-1]])
+        self.seq = -1
+        self.canvas.draw() #new limits --> new background
+
+    def start(self):
+        if self.job is None:
+            self.tick()
+
+    def stop(self):
+        if self.job is not None:
+            self.canvas.get_tk_widget().after_cancel(self.job)
+            self.job = None
+
+    def on_draw(self, event):
+        """Full redraws (first show, resize, attach) refresh the cached background """
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.ax_wave.draw_artist(self.wave)
+        self.ax_spec.draw_artist(self.spec)
+
+    def tick(self):
+        self.job = self.canvas.get_tk_widget().after(self.interval, self.tick)
+        if self.shifter is None or self.background is None or self.shifter.tap.seq == self.seq:
+            self.skipped += 1
+            return
+        self.seq, magn, block = self.shifter.tap.read(self.magn, self.block)
+        wave = block[::self.step]
+        self.wave.set_ydata(wave if wave.ndim == 1 else wave[:, 0])
+        self.spec.set_ydata(self.binner.reduce(magn))
+        self.canvas.restore_region(self.background)
+        self.ax_wave.draw_artist(self.wave)
+        self.ax_spec.draw_artist(self.spec)
+        self.canvas.blit(self.fig.bbox)
+        self.drawn += 1
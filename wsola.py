@@ -0,0 +1,156 @@
+import numpy as np
+from math import ceil, floor, log2
+
+PHASES, TAPS = 32, 16           #fractional positions per sample and taps of the resampling filters
+MIN_RATIO, MAX_RATIO = 0.25, 4.0 #two octaves either way, ratios outside are clamped
+STEPS = range(-24, 25)          #semitone steps with a precomputed filter bank
+FILTER_BANKS = {}               #step --> (PHASES+1, TAPS) float32, see filter_bank
+
+
+def filter_bank(step, phases=PHASES, taps=TAPS, beta=8.0):
+    """Polyphase interpolator for reading a signal 2**(step/12) samples per output sample --> row p holds the
+    Kaiser-windowed sinc taps for a fractional offset of p/phases, taps centred between taps//2-1 and taps//2.
+    Reading faster than one sample per sample low-passes below the output's Nyquist, so nothing aliases"""
+    if (step, phases, taps) not in FILTER_BANKS:
+        cutoff = min(1.0, 2**(-step/12)) * 0.95
+        x = np.arange(taps)[None, :] - (taps//2 - 1) - np.arange(phases + 1)[:, None] / phases
+        window = np.i0(beta * np.sqrt(np.clip(1 - (x / (taps/2))**2, 0, None))) / np.i0(beta)
+        bank = cutoff * np.sinc(cutoff * x) * window
+        bank /= bank.sum(axis=1, keepdims=True) #unity gain at DC for every phase
+        FILTER_BANKS[(step, phases, taps)] = bank.astype(np.float32)
+    return FILTER_BANKS[(step, phases, taps)]
+
+
+class WsolaShifter:
+    """Time-domain pitch shifter --> WSOLA stretches the input by the pitch ratio, then a polyphase resampler
+    reads the stretched signal back at ratio samples per output sample, so pitch moves and duration does not.
+    Each stretched frame is the input segment within +-search samples of its nominal position that best
+    continues the previous one, found by cross-correlation on a decimated signal and refined at full rate.
+    No FFT at all: a hop costs a few short correlations and a TAPS-tap filter per output sample.
+    Frames are (samples,) or, with channels, (channels, samples) sharing one search on the channel mean.
+    Output lags input by DELAY samples, fixed for every ratio so pitch changes never move the timeline."""
+    def __init__(self, stride, shift_factor, channels=None, frame_len=1024, search=256, decimate=4, dtype=np.float32):
+        """frame_len: WSOLA frame, overlapped by half with a Hann window --> longer suits low voices, shorter transients
+        search: Largest shift from the nominal position the similarity search tries, in samples"""
+        assert frame_len % 2 == 0 and search % decimate == 0, "Even frame and a search divisible by the decimation"
+        self.STRIDE = stride
+        self.FRAME_LEN = frame_len
+        self.HOP = frame_len // 2       #synthesis hop
+        self.OVERLAP = frame_len - self.HOP
+        self.SEARCH = search
+        self.DECIMATE = decimate
+        self.channels = channels
+        lead = () if channels is None else (channels,)
+        #frame centres are mapped onto the input timeline, so the newest frame needs this much input past the output
+        self.DELAY = search + frame_len // 2 + ceil((TAPS//2 + frame_len//2) / MIN_RATIO) + 1
+        self.X_LEN = self.DELAY + stride + 2*search + 2*frame_len + ceil(self.HOP / MIN_RATIO)
+        self.Y_LEN = ceil(stride * MAX_RATIO) + TAPS + 2*frame_len
+        self.window = (0.5 - 0.5*np.cos(2*np.pi*np.arange(frame_len)/frame_len)).astype(dtype) #periodic --> sums to 1
+        self.x = np.zeros(lead + (self.X_LEN,), dtype)      #input history, x[..., 0] is input sample x_start
+        self.mix = self.x if channels is None else np.zeros(self.X_LEN, dtype) #what the search correlates
+        self.y = np.zeros(lead + (self.Y_LEN,), dtype)      #stretched signal, y[..., 0] is stretched sample y_start
+        self.segment = np.zeros(frame_len, dtype)
+        self.x_start = -self.X_LEN
+        self.y_start = -TAPS
+        self.y_read = 0.0       #stretched position of the next output sample
+        self.time = 0           #input samples consumed
+        self.next_frame = 0     #frame k covers stretched samples [k*HOP, k*HOP + frame_len)
+        self.prev_pos = None    #input position of the previous frame
+        self.positions = np.zeros(stride)   #fractional read positions, see resample
+        self.floor = np.zeros(stride)
+        self.base = np.zeros((stride, 1), np.intp)
+        self.phase = np.zeros(stride, np.intp)
+        #full shape, adding a broadcast (TAPS,) row makes NumPy buffer the whole index array
+        self.offsets = np.zeros((stride, TAPS), np.intp) + np.arange(TAPS) - (TAPS//2 - 1)
+        self.idx = np.zeros((stride, TAPS), np.intp)
+        self.gathered = np.zeros((stride, TAPS), dtype)
+        self.coeffs = np.zeros((stride, TAPS), np.float32)
+        for step in STEPS:
+            filter_bank(step)
+        self.update(shift_factor)
+
+    def update(self, shift_factor):
+        """New pitch ratio, from the next hop on --> picks the nearest semitone's filter bank"""
+        self.ratio = min(max(shift_factor, MIN_RATIO), MAX_RATIO)
+        self.bank = filter_bank(min(max(round(12*log2(self.ratio)), STEPS[0]), STEPS[-1]))
+        self.steps = np.arange(self.STRIDE) * self.ratio
+
+    def reset(self):
+        """Forgets all history, e.g. after a seek --> output restarts from silence """
+        self.x[:] = 0
+        self.y[:] = 0
+        self.mix[:] = 0
+        self.prev_pos = None
+
+    def search_frame(self, nominal):
+        """Input position within SEARCH of nominal whose segment best continues the previous frame --> cross-correlation
+        over every shift of the overlap, coarse on every DECIMATE-th sample, then refined at full rate"""
+        if self.prev_pos is None or self.prev_pos + self.HOP < self.x_start: #nothing to continue, e.g. after a jump
+            return nominal
+        d, L = self.DECIMATE, self.OVERLAP
+        start = nominal - self.SEARCH - self.x_start
+        region = self.mix[start:start + 2*self.SEARCH + L]
+        template = self.mix[self.prev_pos + self.HOP - self.x_start:][:L]
+        best = int(np.argmax(np.correlate(region[::d], template[::d], 'valid'))) * d
+        lo, hi = max(best - d + 1, 0), min(best + d, 2*self.SEARCH + 1)
+        best = lo + int(np.argmax(np.correlate(region[lo:hi - 1 + L], template, 'valid')))
+        return nominal - self.SEARCH + best
+
+    def add_frame(self):
+        """Overlap-adds the next stretched frame --> its centre lands where the output timeline expects that input"""
+        k = self.next_frame
+        centre = (self.time - self.STRIDE - self.DELAY) + (k*self.HOP + self.FRAME_LEN//2 - self.y_read) / self.ratio
+        nominal = int(round(centre)) - self.FRAME_LEN//2
+        nominal = min(max(nominal, self.x_start + self.SEARCH), self.time - self.FRAME_LEN - self.SEARCH)
+        pos = self.search_frame(nominal)
+        src, dst = pos - self.x_start, k*self.HOP - self.y_start
+        for x, y in zip(self.x, self.y) if self.channels is not None else ((self.x, self.y),):
+            np.multiply(x[src:src + self.FRAME_LEN], self.window, out=self.segment)
+            y[dst:dst + self.FRAME_LEN] += self.segment
+        self.prev_pos = pos
+        self.next_frame += 1
+
+    def resample(self, out):
+        """Reads STRIDE samples of the stretched signal from y_read on, ratio apart --> one TAPS-tap filter each,
+        picked from the bank by the fractional position"""
+        np.add(self.steps, self.y_read - self.y_start, out=self.positions)
+        np.floor(self.positions, out=self.floor)
+        np.copyto(self.base[:, 0], self.floor, casting='unsafe')
+        self.positions -= self.floor
+        self.positions *= PHASES
+        np.rint(self.positions, out=self.positions)
+        np.copyto(self.phase, self.positions, casting='unsafe')
+        np.copyto(self.idx, self.base)
+        self.idx += self.offsets
+        np.take(self.bank, self.phase, axis=0, out=self.coeffs, mode='clip')
+        for y, row in zip(self.y, out) if self.channels is not None else ((self.y, out),):
+            np.take(y, self.idx, out=self.gathered, mode='clip')
+            self.gathered *= self.coeffs
+            np.sum(self.gathered, axis=1, out=row)
+
+    def process(self, input_buffer, out):
+        """Shifts one hop --> input_buffer (STRIDE,) or (STRIDE, channels), out (STRIDE,) or (channels, STRIDE)"""
+        S = self.STRIDE
+        for x, samples in zip(self.x, input_buffer.T) if self.channels is not None else ((self.x, input_buffer),):
+            x[:-S] = x[S:]
+            x[-S:] = samples
+        if self.channels is not None:
+            self.mix[:-S] = self.mix[S:]
+            mix = self.mix[-S:]
+            np.copyto(mix, self.x[0, -S:])
+            for x in self.x[1:]: #row by row, np.mean over the strided 2-D block buffers it
+                mix += x[-S:]
+            mix *= 1 / self.channels
+        self.x_start += S
+        self.time += S
+        last = self.y_read + (S - 1) * self.ratio + TAPS//2
+        while self.next_frame * self.HOP <= last:
+            self.add_frame()
+        self.resample(out)
+        self.y_read += S * self.ratio
+        drop = floor(self.y_read) - (TAPS//2 - 1) - self.y_start
+        if drop > 0:
+            for y in self.y if self.channels is not None else (self.y,):
+                y[:-drop] = y[drop:]
+                y[-drop:] = 0
+            self.y_start += drop